@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import argparse
+import time
+
+from lib.cache_artifacts import cache_status, rebuild_cache
+from utils.utils import load_movies
+
+
+def print_status(status):
+    for name, artifact in status.items():
+        created = ""
+        if artifact["created"] is not None:
+            created = time.strftime(
+                " (built %Y-%m-%d %H:%M)", time.localtime(artifact["created"])
+            )
+        state = "fresh" if artifact["stale"] is None else f"stale: {artifact['stale']}"
+        print(f"{name:<28} {state}{created}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Cache CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    status_parser = subparsers.add_parser(
+        "status", help="show which cached artifacts are stale"
+    )
+    status_parser.add_argument(
+        "--verify", action="store_true", help="re-hash every file"
+    )
+
+    rebuild_parser = subparsers.add_parser("rebuild", help="rebuild cached artifacts")
+    rebuild_parser.add_argument(
+        "--only-stale", action="store_true", help="skip artifacts that are fresh"
+    )
+    rebuild_parser.add_argument(
+        "--verify", action="store_true", help="re-hash every file"
+    )
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "status":
+            print_status(cache_status(load_movies(), verify=args.verify))
+        case "rebuild":
+            movies = load_movies()
+            rebuilt = rebuild_cache(movies, args.only_stale, verify=args.verify)
+            if rebuilt:
+                print(f"Rebuilt {', '.join(rebuilt)}")
+            else:
+                print("Every artifact is fresh")
+            print_status(cache_status(movies))
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,13 @@
 import argparse
-from utils.utils import normalize
+
+from lib.hybrid_search import (
+    HYBRID_CANDIDATES,
+    RRF_K,
+    HybridSearch,
+    hybrid_benchmark_command,
+)
+from lib.search_client import find_server
+from utils.utils import load_movies, normalize
 
 
 def main() -> None:
@@ -14,7 +22,9 @@ def main() -> None:
     weighted_search_parser = subparsers.add_parser("weighted-search")
     weighted_search_parser.add_argument("query", type=str, help="query to search for")
     weighted_search_parser.add_argument(
+        "--alpha",
         "--aplha",
+        dest="alpha",
         type=float,
         default=0.5,
         help="dynamically control weight between two scores",
@@ -22,17 +32,110 @@ def main() -> None:
     weighted_search_parser.add_argument(
         "--limit", type=int, default=5, help="limit the number of results"
     )
+    weighted_search_parser.add_argument(
+        "--depth",
+        type=int,
+        default=HYBRID_CANDIDATES,
+        help="candidates taken from each retriever",
+    )
+    weighted_search_parser.add_argument(
+        "--local", action="store_true", help="search here even if a server is running"
+    )
+
+    rrf_search_parser = subparsers.add_parser("rrf-search")
+    rrf_search_parser.add_argument("query", type=str, help="query to search for")
+    rrf_search_parser.add_argument(
+        "-k", type=int, default=RRF_K, help="reciprocal rank fusion constant"
+    )
+    rrf_search_parser.add_argument(
+        "--limit", type=int, default=5, help="limit the number of results"
+    )
+    rrf_search_parser.add_argument(
+        "--depth",
+        type=int,
+        default=HYBRID_CANDIDATES,
+        help="candidates taken from each retriever",
+    )
+    rrf_search_parser.add_argument(
+        "--local", action="store_true", help="search here even if a server is running"
+    )
+
+    bench_parser = subparsers.add_parser("bench", help="time each hybrid stage")
+    bench_parser.add_argument("queries", type=str, nargs="*", help="queries to time")
+    bench_parser.add_argument(
+        "--limit", type=int, default=5, help="limit the number of results"
+    )
+    bench_parser.add_argument(
+        "--depth",
+        type=int,
+        default=HYBRID_CANDIDATES,
+        help="candidates taken from each retriever",
+    )
+    bench_parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per query to average over"
+    )
 
     args = parser.parse_args()
 
     match args.command:
         case "normalize":
-            normalize(args.scores)
-        case "weighted-search":
-
+            for score in normalize(args.scores):
+                print(f"* {score:.4f}")
+        case "weighted-search" | "rrf-search":
+            try:
+                results = search(args)
+            except (ValueError, ConnectionError) as e:
+                print(e)
+                return
+            i = 1
+            for result in results:
+                print(f"{i}. {result['title']}")
+                if args.command == "weighted-search":
+                    print(f"   Hybrid Score: {result['score']:.3f}")
+                else:
+                    print(f"   RRF Score: {result['score']:.3f}")
+                print(
+                    f"   BM25: {result['bm25_score']:.3f} (rank {result['bm25_rank']}),"
+                    f" Semantic: {result['semantic_score']:.3f}"
+                    f" (rank {result['semantic_rank']})"
+                )
+                print(f"   {result['document']}...")
+                i += 1
+        case "bench":
+            report = hybrid_benchmark_command(
+                args.queries, args.limit, args.depth, repeat=args.repeat
+            )
+            for method, stages in report.items():
+                print(
+                    f"{method:>8}: "
+                    + "  ".join(
+                        f"{stage.removesuffix('_ms')} {ms:.2f}ms"
+                        for stage, ms in stages.items()
+                    )
+                )
         case _:
             parser.print_help()
 
 
+def search(args):
+    client = None if args.local else find_server()
+    if client is not None:
+        method = "weighted" if args.command == "weighted-search" else "rrf"
+        response = client.hybrid(
+            args.query,
+            method,
+            args.limit,
+            getattr(args, "alpha", 0.5),
+            getattr(args, "k", RRF_K),
+            args.depth,
+        )
+        return response["results"]
+
+    hybrid = HybridSearch(load_movies())
+    if args.command == "weighted-search":
+        return hybrid.weighted_search(args.query, args.alpha, args.limit, args.depth)
+    return hybrid.rrf_search(args.query, args.k, args.limit, args.depth)
+
+
 if __name__ == "__main__":
     main()
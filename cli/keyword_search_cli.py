@@ -1,25 +1,57 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
+import os
 
 from lib.index_search import (
+    BUILD_BATCH_SIZE,
     InvertedIndex,
     bm25_idf_command,
+    bm25_batch_benchmark_command,
+    bm25_benchmark_command,
     BM25_K1,
     bm25_tf_command,
     BM25_B,
 )
-from utils.utils import tokenize
+from lib.search_client import find_server
+from utils.utils import load_movies, tokenizer_benchmark
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
-    search_parser = subparsers.add_parser("search", help="Search movies using BM25")
-    search_parser.add_argument("query", type=str, help="Search query")
+    search_parser = subparsers.add_parser(
+        "search", help="Find movies matching a boolean query"
+    )
+    search_parser.add_argument(
+        "query",
+        type=str,
+        help="terms joined by AND, OR and NOT, with parentheses and title:term;"
+        " terms without an operator between them are ORed",
+    )
+    search_parser.add_argument(
+        "--all",
+        action="store_true",
+        help="AND terms without an operator between them instead, so every one"
+        " must match",
+    )
+    search_parser.add_argument("--limit", type=int, default=5, help="number of results")
 
-    subparsers.add_parser("build", help="build inverted index")
+    build_parser = subparsers.add_parser("build", help="build inverted index")
+    build_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of processes used to tokenize documents",
+    )
+    build_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=BUILD_BATCH_SIZE,
+        help="documents handed to a worker at a time",
+    )
 
     tf_parser = subparsers.add_parser(
         "tf", help="Get the term frequency for an ID and a term"
@@ -60,6 +92,101 @@ def main() -> None:
         "bm25search", help="Search movies using full BM25 scoring"
     )
     bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_mode = bm25search_parser.add_mutually_exclusive_group()
+    bm25search_mode.add_argument(
+        "--prune",
+        action="store_true",
+        help="read only the postings that can reach the top results (MaxScore);"
+        " fewer postings, but slower than the default vectorized scorer",
+    )
+    bm25search_mode.add_argument(
+        "--proximity",
+        action="store_true",
+        help="boost documents where the query terms appear close together",
+    )
+    bm25search_parser.add_argument(
+        "--cursor", type=str, help="the next page cursor printed by an earlier search"
+    )
+    bm25search_parser.add_argument(
+        "--where",
+        type=str,
+        help="boolean query results must match, e.g. 'title:dragon NOT comedy'",
+    )
+    bm25search_parser.add_argument(
+        "--local", action="store_true", help="search here even if a server is running"
+    )
+
+    phrase_parser = subparsers.add_parser(
+        "phrase", help="Search movies for an exact phrase"
+    )
+    phrase_parser.add_argument("phrase", type=str, help="Phrase to search for")
+    phrase_parser.add_argument("--limit", type=int, default=5, help="number of results")
+
+    add_parser = subparsers.add_parser("add", help="Add a document to the index")
+    add_parser.add_argument(
+        "document", type=str, help="JSON document with id, title and description"
+    )
+
+    update_parser = subparsers.add_parser(
+        "update", help="Replace an indexed document with the same id"
+    )
+    update_parser.add_argument(
+        "document", type=str, help="JSON document with id, title and description"
+    )
+
+    delete_parser = subparsers.add_parser(
+        "delete", help="Remove a document from the index"
+    )
+    delete_parser.add_argument("doc_id", type=int, help="Document ID")
+
+    subparsers.add_parser(
+        "compact", help="Fold pending adds, updates and deletes into the index"
+    )
+
+    subparsers.add_parser("segments", help="List the segments of the index")
+
+    merge_parser = subparsers.add_parser(
+        "merge", help="Merge segments the merge policy picks"
+    )
+    merge_parser.add_argument(
+        "--all", action="store_true", help="merge every segment into one"
+    )
+
+    bm25bench_parser = subparsers.add_parser(
+        "bm25bench", help="Compare posting-list BM25 against the exhaustive scan"
+    )
+    bm25bench_parser.add_argument(
+        "queries", type=str, nargs="*", help="Queries to benchmark"
+    )
+    bm25bench_parser.add_argument(
+        "--limit", type=int, default=5, help="number of results per query"
+    )
+    bm25bench_parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per query to average over"
+    )
+
+    bm25batch_parser = subparsers.add_parser(
+        "bm25batch", help="Compare one-at-a-time BM25 against batch scoring"
+    )
+    bm25batch_parser.add_argument(
+        "queries", type=str, nargs="*", help="Queries to score together"
+    )
+    bm25batch_parser.add_argument(
+        "--limit", type=int, default=5, help="number of results per query"
+    )
+    bm25batch_parser.add_argument(
+        "--repeat", type=int, default=3, help="runs to average over"
+    )
+
+    tokenbench_parser = subparsers.add_parser(
+        "tokenbench", help="Compare tokenizer throughput against the uncached path"
+    )
+    tokenbench_parser.add_argument(
+        "--docs", type=int, default=500, help="number of movies to tokenize"
+    )
+    tokenbench_parser.add_argument(
+        "--repeat", type=int, default=1, help="runs to average over"
+    )
 
     args = parser.parse_args()
 
@@ -73,23 +200,19 @@ def main() -> None:
                 print("Index not found. Please build first.")
                 return
             print(f"Searching for: {args.query}")
-            results = []
-            query_tokens = tokenize(args.query)
-            maxed = False
-            for token in query_tokens:
-                doc_ids = indexer.get_documents(token)
-                for id in doc_ids:
-                    results.append(indexer.docmap[id])
-                    if len(results) == 5:
-                        maxed = True
-                        break
-                if maxed:
-                    break
-
+            try:
+                doc_ids = indexer.boolean_search(
+                    args.query, default="and" if args.all else "or"
+                )
+            except ValueError as e:
+                print(e)
+                return
+            print(f"{len(doc_ids)} matching movies")
+            results = [indexer.docmap[id] for id in doc_ids[: args.limit]]
             for i in range(len(results)):
                 print(f"{i + 1}. {results[i]['title']} : {results[i]['id']}")
         case "build":
-            indexer.build()
+            indexer.build(args.workers, args.batch_size)
             indexer.save()
         case "tf":
             try:
@@ -135,18 +258,170 @@ def main() -> None:
             )
 
         case "bm25search":
+            if args.prune and (args.where is not None or args.cursor is not None):
+                parser.error("--where and --cursor cannot be combined with --prune")
+            client = None if args.local else find_server()
+            if client is not None:
+                try:
+                    response = client.keyword(
+                        args.query,
+                        5,
+                        args.prune,
+                        args.proximity,
+                        args.where,
+                        args.cursor,
+                    )
+                except (ValueError, ConnectionError) as e:
+                    print(e)
+                    return
+                bm25_results = response["results"]
+                stats = response["stats"]
+                next_cursor = response["cursor"]
+            else:
+                try:
+                    indexer.load()
+                except FileNotFoundError:
+                    print("Index not found. Please build first.")
+                    return
+                stats = None
+                next_cursor = None
+                if args.prune:
+                    results, stats = indexer.bm25_top_k(args.query, 5)
+                else:
+                    try:
+                        results, next_cursor = indexer.bm25_page(
+                            args.query, 5, args.cursor, args.proximity, args.where
+                        )
+                    except ValueError as e:
+                        print(e)
+                        return
+                bm25_results = [
+                    {
+                        "id": doc_id,
+                        "title": indexer.docmap[doc_id]["title"],
+                        "score": score,
+                    }
+                    for doc_id, score in results
+                ]
+            if stats is not None:
+                print(
+                    f"Fully scored {stats['scored']} documents,"
+                    f" skipped {stats['skipped']} matching documents"
+                )
+            i = 1
+            for result in bm25_results:
+                print(
+                    f"{i}. ({result['id']}) {result['title']} - Score: {result['score']:.2f}"
+                )
+                i += 1
+            if next_cursor is not None:
+                print(f"Next page: --cursor {next_cursor}")
+
+        case "phrase":
             try:
                 indexer.load()
             except FileNotFoundError:
                 print("Index not found. Please build first.")
                 return
-            bm25_results = indexer.bm25_search(args.query, 5)
-            i = 1
-            for result in bm25_results:
+            results = indexer.phrase_search(args.phrase, args.limit)
+            if not results:
+                print(f"No movies contain '{args.phrase}'")
+            for i, (doc_id, score) in enumerate(results, 1):
                 print(
-                    f"{i}. ({result[0]}) {indexer.docmap[result[0]]['title']} - Score: {result[1]:.2f}"
+                    f"{i}. ({doc_id}) {indexer.docmap[doc_id]['title']} - Score: {score:.2f}"
                 )
-                i += 1
+
+        case "add" | "update" | "delete":
+            try:
+                indexer.load()
+            except FileNotFoundError:
+                print("Index not found. Please build first.")
+                return
+            try:
+                if args.command == "add":
+                    indexer.add_document(json.loads(args.document))
+                elif args.command == "update":
+                    indexer.update_document(json.loads(args.document))
+                else:
+                    indexer.delete_document(args.doc_id)
+            except (KeyError, ValueError) as e:
+                print(f"Could not {args.command} document: {e}")
+                return
+            # a flush may have started merging in the background
+            indexer.wait_for_merges()
+            print(f"{indexer.pending_changes()} pending changes")
+
+        case "compact":
+            try:
+                indexer.load()
+            except FileNotFoundError:
+                print("Index not found. Please build first.")
+                return
+            pending = indexer.pending_changes()
+            if indexer.compact():
+                print(f"Compacted {pending} pending changes")
+            else:
+                print("Nothing to compact")
+
+        case "segments":
+            try:
+                indexer.load()
+            except FileNotFoundError:
+                print("Index not found. Please build first.")
+                return
+            for segment in indexer.segment_stats():
+                print(
+                    f"{segment['name']:<12} {segment['rows']:>8} rows"
+                    f"  {segment['deleted']:>6} deleted"
+                )
+
+        case "merge":
+            try:
+                indexer.load()
+            except FileNotFoundError:
+                print("Index not found. Please build first.")
+                return
+            merges = 0
+            while indexer.merge(force=args.all):
+                merges += 1
+                if args.all:
+                    break
+            print(f"Ran {merges} merges, {len(indexer.segments)} segments left")
+
+        case "bm25bench":
+            bench_results = bm25_benchmark_command(
+                args.queries, args.limit, args.repeat
+            )
+            if bench_results is None:
+                return
+            for result in bench_results:
+                speedup = result["exhaustive_ms"] / max(result["postings_ms"], 1e-9)
+                print(
+                    f"{result['query'][:40]:<40} exhaustive: {result['exhaustive_ms']:9.2f}ms"
+                    f"  postings: {result['postings_ms']:7.2f}ms  x{speedup:.0f}"
+                    f"  pruned: {result['pruned_ms']:7.2f}ms"
+                    f" ({result['scored']} scored, {result['skipped']} docs skipped)"
+                    f"  match: {result['match']}"
+                )
+
+        case "bm25batch":
+            bench = bm25_batch_benchmark_command(args.queries, args.limit, args.repeat)
+            if bench is None:
+                return
+            print(f"{bench['queries']} queries")
+            print(f"one at a time: {bench['loop_ms']:9.2f}ms")
+            print(f"batch:         {bench['batch_ms']:9.2f}ms")
+            print(f"identical results: {bench['match']}")
+
+        case "tokenbench":
+            texts = [
+                f"{movie['title']} {movie['description']}"
+                for movie in load_movies()[: args.docs]
+            ]
+            bench = tokenizer_benchmark(texts, args.repeat)
+            print(f"uncached:  {bench['uncached_tokens_per_sec']:12,.0f} tokens/sec")
+            print(f"tokenizer: {bench['tokenizer_tokens_per_sec']:12,.0f} tokens/sec")
+            print(f"identical output: {bench['match']}")
 
         case _:
             parser.print_help()
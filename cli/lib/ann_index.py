@@ -0,0 +1,86 @@
+import numpy as np
+
+from lib.compact_index import save_npz
+from lib.vectors import normalize_rows, top_k_indices
+
+ANN_NPROBE = 8
+ANN_KMEANS_ITERATIONS = 15
+ANN_ASSIGN_BATCH = 4096
+ANN_SEED = 42
+
+
+def default_list_count(num_rows):
+    return max(1, min(num_rows, int(round(4 * np.sqrt(num_rows)))))
+
+
+def assign_lists(vectors, centroids):
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ANN_ASSIGN_BATCH):
+        batch = vectors[start : start + ANN_ASSIGN_BATCH]
+        assignments[start : start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+class IVFIndex:
+    # IVF-flat over unit-length vectors: rows are clustered with spherical
+    # k-means, and a query only scores the rows in its nprobe closest lists
+    def __init__(self, centroids=None, list_offsets=None, list_rows=None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+
+    @property
+    def num_rows(self):
+        return len(self.list_rows)
+
+    def build(self, vectors, n_lists=None, iterations=ANN_KMEANS_ITERATIONS):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if n_lists is None:
+            n_lists = default_list_count(len(vectors))
+        n_lists = max(1, min(n_lists, len(vectors)))
+        rng = np.random.default_rng(ANN_SEED)
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignments = assign_lists(vectors, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+            empty = np.bincount(assignments, minlength=n_lists) == 0
+            # lists that lost all their rows are reseeded from random rows
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+            centroids = normalize_rows(sums)
+
+        assignments = assign_lists(vectors, centroids)
+        self.centroids = centroids
+        self.list_rows = np.argsort(assignments, kind="stable").astype(np.int64)
+        self.list_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(assignments, minlength=n_lists)))
+        ).astype(np.int64)
+        return self
+
+    def candidates(self, query_embedding, nprobe=ANN_NPROBE):
+        probes = top_k_indices(self.centroids @ query_embedding, max(1, nprobe))
+        return np.concatenate(
+            [
+                self.list_rows[self.list_offsets[i] : self.list_offsets[i + 1]]
+                for i in probes
+            ]
+        )
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def save(self, path):
+        save_npz(
+            path,
+            {
+                "centroids": self.centroids,
+                "list_offsets": self.list_offsets,
+                "list_rows": self.list_rows,
+            },
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_rows"])
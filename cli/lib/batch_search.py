@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import time
+
+BATCH_MAX_SIZE = 32
+BATCH_MAX_WAIT = 0.005
+
+
+class BatchingSemanticSearch:
+    # asyncio front end for ChunkedSemanticSearch: queries that arrive within
+    # max_wait seconds of each other are searched together, so a burst of
+    # clients costs one encode call and one matrix product per batch
+    def __init__(
+        self, searcher, max_batch_size=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT
+    ):
+        self.searcher = searcher
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.queries = 0
+        self.__queue = None
+        self.__worker = None
+
+    async def start(self):
+        if self.__worker is None:
+            self.__queue = asyncio.Queue()
+            self.__worker = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.__worker is None:
+            return
+        self.__worker.cancel()
+        try:
+            await self.__worker
+        except asyncio.CancelledError:
+            pass
+        self.__worker = None
+
+    async def search(self, query, limit=5):
+        if not query or not query.strip():
+            raise ValueError("text required to generate embedding")
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.__queue.put((query, limit, future))
+        return await future
+
+    async def __next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.__queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.__queue.empty():
+                batch.append(self.__queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.__queue.get(), timeout))
+            except TimeoutError:
+                break
+        return batch
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.__next_batch()
+            queries = [query for query, _, _ in batch]
+            limit = max(limit for _, limit, _ in batch)
+            # the search itself runs on a thread so new queries keep queueing
+            # up for the next batch meanwhile
+            try:
+                results = await loop.run_in_executor(
+                    None, self.searcher.search_chunks_batch, queries, limit
+                )
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.queries += len(batch)
+            for (_, limit, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result[:limit])
+
+
+class BatchingThread:
+    # runs a BatchingSemanticSearch on its own event loop so that threaded
+    # code, such as the HTTP server's request handlers, can submit queries
+    def __init__(
+        self, searcher, max_batch_size=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT
+    ):
+        self.batcher = BatchingSemanticSearch(searcher, max_batch_size, max_wait)
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, daemon=True)
+        self.__thread.start()
+
+    def search(self, query, limit=5):
+        return asyncio.run_coroutine_threadsafe(
+            self.batcher.search(query, limit), self.__loop
+        ).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.batcher.stop(), self.__loop).result()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+
+
+def batch_benchmark(
+    searcher,
+    queries,
+    clients=64,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait=BATCH_MAX_WAIT,
+    limit=5,
+):
+    # the same query stream, searched one at a time and then by `clients`
+    # concurrent callers through the batching front end
+    searcher.query_cache.clear()
+    start = time.perf_counter()
+    sequential = [searcher.search_chunks(query, limit) for query in queries]
+    sequential_seconds = time.perf_counter() - start
+
+    searcher.query_cache.clear()
+    batcher = BatchingSemanticSearch(searcher, max_batch_size, max_wait)
+
+    async def client(worker):
+        return [
+            (i, await batcher.search(queries[i], limit))
+            for i in range(worker, len(queries), clients)
+        ]
+
+    async def run():
+        await batcher.start()
+        try:
+            return await asyncio.gather(*(client(worker) for worker in range(clients)))
+        finally:
+            await batcher.stop()
+
+    start = time.perf_counter()
+    batched = dict(pair for pairs in asyncio.run(run()) for pair in pairs)
+    batched_seconds = time.perf_counter() - start
+
+    def ids(results):
+        return [result["id"] for result in results]
+
+    return {
+        "queries": len(queries),
+        "sequential_qps": len(queries) / sequential_seconds,
+        "batched_qps": len(queries) / batched_seconds,
+        "batches": batcher.batches,
+        "match": all(
+            ids(sequential[i]) == ids(batched[i]) for i in range(len(queries))
+        ),
+    }
@@ -0,0 +1,108 @@
+import re
+
+from utils.utils import tokenize
+
+# fields a term can be restricted to with "field:term"
+QUERY_FIELDS = ("title",)
+QUERY_OPERATORS = ("AND", "OR", "NOT")
+QUERY_TOKEN = re.compile(r"\(|\)|[^\s()]+")
+
+
+def field_term(field, term):
+    # the index term of a token that occurs in the given field; ":" never
+    # survives tokenization, so these cannot collide with ordinary terms
+    return f"{field}:{term}"
+
+
+def parse_query(query, default="or"):
+    # AND/OR/NOT with parentheses into nested tuples:
+    #   ("term", index_term), ("and", [...]), ("or", [...]), ("not", node)
+    # NOT binds tightest, then AND, then OR. Adjacent terms are joined by
+    # default: with "or" any of them may match, and a NOT next to them
+    # excludes from all of them ("dragon castle NOT comedy"); with "and"
+    # all must. Operators are upper case, so "and" is an ordinary
+    # (stop)word. Words that tokenize to nothing are dropped along with
+    # any NOT on them.
+    if default not in ("and", "or"):
+        raise ValueError(f"Unknown default operator {default!r}")
+    tokens = QUERY_TOKEN.findall(query)
+    node, end = parse_or(tokens, 0, default)
+    if end < len(tokens):
+        raise ValueError(f"Unexpected {tokens[end]!r} in query")
+    if node is None:
+        raise ValueError(f"No searchable terms in query {query!r}")
+    return node
+
+
+def combine(kind, nodes):
+    nodes = [node for node in nodes if node is not None]
+    if len(nodes) <= 1:
+        return nodes[0] if nodes else None
+    return (kind, nodes)
+
+
+def parse_or(tokens, i, default):
+    node, i = parse_and(tokens, i, default)
+    nodes = [node]
+    # whether each operand follows an explicit OR; only adjacency is
+    # left to parse_or when the default is "or"
+    explicit = [False]
+    while i < len(tokens) and tokens[i] != ")":
+        explicit.append(tokens[i] == "OR")
+        if tokens[i] == "OR":
+            i += 1
+        node, i = parse_and(tokens, i, default)
+        nodes.append(node)
+    explicit.append(False)
+    included = []
+    excluded = []
+    for j, node in enumerate(nodes):
+        if (
+            node is not None
+            and node[0] == "not"
+            and not (explicit[j] or explicit[j + 1])
+        ):
+            excluded.append(node)
+        else:
+            included.append(node)
+    return combine("and", [combine("or", included), *excluded]), i
+
+
+def parse_and(tokens, i, default):
+    node, i = parse_not(tokens, i, default)
+    nodes = [node]
+    while i < len(tokens) and (
+        tokens[i] == "AND" or (default == "and" and tokens[i] not in ("OR", ")"))
+    ):
+        if tokens[i] == "AND":
+            i += 1
+        node, i = parse_not(tokens, i, default)
+        nodes.append(node)
+    return combine("and", nodes), i
+
+
+def parse_not(tokens, i, default):
+    if i < len(tokens) and tokens[i] == "NOT":
+        node, i = parse_not(tokens, i + 1, default)
+        return (None if node is None else ("not", node)), i
+    return parse_atom(tokens, i, default)
+
+
+def parse_atom(tokens, i, default):
+    if i == len(tokens):
+        raise ValueError("Query ends where a term was expected")
+    token = tokens[i]
+    if token == "(":
+        node, i = parse_or(tokens, i + 1, default)
+        if i == len(tokens) or tokens[i] != ")":
+            raise ValueError("Missing ) in query")
+        return node, i + 1
+    if token == ")" or token in QUERY_OPERATORS:
+        raise ValueError(f"Unexpected {token!r} in query")
+    field, _, word = token.partition(":")
+    if field not in QUERY_FIELDS:
+        field, word = None, token
+    terms = tokenize(word)
+    if field is not None:
+        terms = [field_term(field, term) for term in terms]
+    return combine("and", [("term", term) for term in terms]), i + 1
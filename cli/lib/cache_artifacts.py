@@ -0,0 +1,96 @@
+from lib.cache_manifest import CacheManifest
+from lib.index_search import InvertedIndex
+from lib.semantic_search import (
+    MODEL_NAME,
+    ChunkedSemanticSearch,
+    SemanticSearch,
+    embedding_manifest,
+)
+
+# artifacts built straight from the corpus, in rebuild order; derived ones
+# (the IVF index and quantized copies) are rebuilt after their source
+PRIMARY_ARTIFACTS = ("keyword_index", "movie_embeddings", "chunk_embeddings")
+
+
+def check_primary(documents, model_name=MODEL_NAME, verify=False):
+    # name -> stale reason or None, by the same checks the searchers make
+    # before using their caches
+    manifest = CacheManifest()
+    return {
+        "keyword_index": InvertedIndex().cache_check(documents, verify),
+        "movie_embeddings": manifest.check(
+            "movie_embeddings", embedding_manifest(documents, model_name), verify
+        ),
+        "chunk_embeddings": ChunkedSemanticSearch(model_name).cache_check(
+            documents, verify
+        ),
+    }
+
+
+def derived_artifacts(manifest):
+    return [
+        name
+        for name, entry in manifest.entries().items()
+        if "source" in entry["params"]
+    ]
+
+
+def cache_status(documents, model_name=MODEL_NAME, verify=False):
+    # name -> {"stale": reason or None, "created": timestamp or None}
+    manifest = CacheManifest()
+    reasons = check_primary(documents, model_name, verify)
+    for name in derived_artifacts(manifest):
+        reasons[name] = manifest.check_derived(name, verify)
+    entries = manifest.entries()
+    return {
+        name: {"stale": reason, "created": entries.get(name, {}).get("created")}
+        for name, reason in reasons.items()
+    }
+
+
+def rebuild_cache(documents, only_stale=False, model_name=MODEL_NAME, verify=False):
+    # returns the names of the artifacts that were rebuilt
+    manifest = CacheManifest()
+    status = cache_status(documents, model_name, verify)
+    derived = {name: manifest.get(name) for name in derived_artifacts(manifest)}
+    rebuilt = []
+    searchers = dict()
+
+    def searcher(stem):
+        if stem not in searchers:
+            if stem == "movie_embeddings":
+                searchers[stem] = SemanticSearch(model_name)
+                searchers[stem].load_or_create_embeddings(documents)
+            else:
+                searchers[stem] = ChunkedSemanticSearch(model_name)
+                searchers[stem].load_or_create_chunk_embeddings(documents)
+        return searchers[stem]
+
+    for name in PRIMARY_ARTIFACTS:
+        if only_stale and status[name]["stale"] is None:
+            continue
+        if name == "keyword_index":
+            index = InvertedIndex()
+            index.build(documents=documents)
+            index.save()
+        elif name == "movie_embeddings":
+            searchers[name] = SemanticSearch(model_name)
+            searchers[name].build_embeddings(documents)
+        else:
+            searchers[name] = ChunkedSemanticSearch(model_name)
+            searchers[name].build_chunk_embeddings(documents)
+        rebuilt.append(name)
+
+    # rebuilding a source drops its derived entries, so they are checked
+    # again against the manifest as it is now
+    for name, entry in derived.items():
+        if only_stale and manifest.check_derived(name, verify) is None:
+            continue
+        manifest.remove(name)
+        if name == "chunk_ivf":
+            searcher("chunk_embeddings").build_ann_index(entry["params"]["n_lists"])
+        else:
+            stem, precision = name.rsplit(".", 1)
+            searcher(stem).use_precision(precision)
+        rebuilt.append(name)
+    return rebuilt
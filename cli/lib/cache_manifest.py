@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from utils.utils import PROJECT_ROOT
+
+MANIFEST_VERSION = 1
+CACHE_PATH = PROJECT_ROOT / "cache"
+# every cache directory (the main one, each shard's) has its own manifest
+MANIFEST_NAME = "manifest.json"
+MANIFEST_PATH = CACHE_PATH / MANIFEST_NAME
+HASH_BLOCK_SIZE = 1 << 20
+# per-document hashes are summed modulo the size of a sha1
+DIGEST_MODULUS = 1 << 160
+
+# one writer at a time per process; every write replaces the whole file
+manifest_lock = threading.Lock()
+
+
+def corpus_hash(documents):
+    digest = hashlib.sha1()
+    for document in documents:
+        digest.update(json.dumps(document, sort_keys=True).encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def document_digest(document):
+    data = json.dumps(document, sort_keys=True).encode("utf-8")
+    return int(hashlib.sha1(data).hexdigest(), 16)
+
+
+def corpus_digest(documents):
+    # an order-free corpus hash: the sum of per-document hashes, which a
+    # store that takes incremental changes keeps current one document at a
+    # time
+    return sum(document_digest(document) for document in documents) % DIGEST_MODULUS
+
+
+def digest_params(digest, doc_count):
+    return {"corpus_hash": f"{digest:040x}", "doc_count": doc_count}
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def artifact_files(paths):
+    # directories are recorded file by file
+    for path in paths:
+        if path.is_dir():
+            yield from sorted(child for child in path.iterdir() if child.is_file())
+        else:
+            yield path
+
+
+def logged_params(updates_path):
+    # the params the last change in a store's update log left it with; each
+    # logged change records them as "manifest"
+    try:
+        with open(updates_path, "rb") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    for line in reversed(lines):
+        if line.strip():
+            try:
+                return json.loads(line).get("manifest")
+            except json.JSONDecodeError:
+                # a change cut short by a crash is not replayed either
+                return None
+    return None
+
+
+class CacheManifest:
+    # cache/manifest.json records, for every artifact, the inputs it was
+    # built from (corpus hash, model, chunking, ...) and the size, mtime and
+    # content hash of each file it wrote. An artifact is fresh when its
+    # inputs match the expected ones and its files are the ones recorded.
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.root = path.parent
+
+    def entries(self):
+        try:
+            with open(self.path, "r") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return dict()
+        if manifest.get("version") != MANIFEST_VERSION:
+            return dict()
+        return manifest["artifacts"]
+
+    def get(self, name):
+        return self.entries().get(name)
+
+    def __write(self, entries):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "artifacts": entries}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def record(self, name, params, paths):
+        # called after the artifact's files have been swapped into place;
+        # files unchanged since the last record keep their hash
+        previous = (self.get(name) or {}).get("files", {})
+        files = dict()
+        for path in artifact_files(paths):
+            relative_path = str(path.relative_to(self.root))
+            stat = path.stat()
+            recorded = previous.get(relative_path)
+            if (
+                recorded is None
+                or recorded["size"] != stat.st_size
+                or recorded["mtime_ns"] != stat.st_mtime_ns
+            ):
+                recorded = {
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "sha1": file_hash(path),
+                }
+            files[relative_path] = recorded
+        with manifest_lock:
+            entries = self.entries()
+            entries[name] = {"params": params, "created": time.time(), "files": files}
+            self.__write(entries)
+
+    def remove(self, *names):
+        with manifest_lock:
+            entries = self.entries()
+            if not any(name in entries for name in names):
+                return
+            for name in names:
+                entries.pop(name, None)
+            self.__write(entries)
+
+    def recorded_hash(self, path):
+        relative_path = str(path.relative_to(self.root))
+        for entry in self.entries().values():
+            if relative_path in entry["files"]:
+                return entry["files"][relative_path]["sha1"]
+        return None
+
+    def source_params(self, source_path, **params):
+        # params of an artifact derived from another one, e.g. a quantized
+        # copy: it is stale as soon as its source file is rewritten
+        return {
+            "source": str(source_path.relative_to(self.root)),
+            "source_sha1": self.recorded_hash(source_path),
+            **params,
+        }
+
+    def check(self, name, params=None, verify=False):
+        # returns None when the artifact is fresh, otherwise the reason it
+        # is not; params=None only checks the files. Files are re-hashed
+        # when their size or mtime changed, or always with verify.
+        entry = self.get(name)
+        if entry is None:
+            return "not built"
+        if params is not None and entry["params"] != params:
+            changed = sorted(
+                key
+                for key in params.keys() | entry["params"].keys()
+                if params.get(key) != entry["params"].get(key)
+            )
+            return f"{', '.join(changed)} changed"
+        for relative_path, recorded in entry["files"].items():
+            path = self.root / relative_path
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                return f"{relative_path} is missing"
+            if stat.st_size != recorded["size"]:
+                return f"{relative_path} was modified"
+            if verify or stat.st_mtime_ns != recorded["mtime_ns"]:
+                if file_hash(path) != recorded["sha1"]:
+                    return f"{relative_path} was modified"
+        return None
+
+    def check_store(self, name, params, updates_path, verify=False):
+        # for stores that take incremental changes (the keyword index, the
+        # chunk embeddings): params describe the documents to be served,
+        # which the store can serve when they are the ones it was built
+        # from ("built_from"), holds as saved, or holds once the changes in
+        # its update log are replayed
+        entry = self.get(name)
+        if entry is None:
+            return "not built"
+        saved = dict(entry["params"])
+        built_from = saved.pop("built_from", None)
+        for content in (None, built_from, logged_params(updates_path)):
+            if params == {**saved, **(content or {})}:
+                return self.check(name, entry["params"], verify)
+        expected = dict(params)
+        if built_from is not None:
+            expected["built_from"] = built_from
+        return self.check(name, expected, verify)
+
+    def check_derived(self, name, verify=False):
+        # a derived artifact is checked against its source as it is now
+        entry = self.get(name)
+        if entry is None:
+            return "not built"
+        params = dict(entry["params"])
+        params["source_sha1"] = self.recorded_hash(self.root / params["source"])
+        return self.check(name, params, verify)
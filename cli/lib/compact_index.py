@@ -0,0 +1,279 @@
+import json
+import mmap
+import os
+import shutil
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+INDEX_FORMAT_VERSION = 4
+INDEX_ARRAYS = (
+    "terms",
+    "term_offsets",
+    "term_max_scores",
+    "postings_rows",
+    "postings_tfs",
+    "doc_ids",
+    "doc_lengths",
+    "sorted_doc_ids",
+    "sorted_doc_rows",
+)
+# kept apart from INDEX_ARRAYS so that BM25 queries, and map_all(), never
+# touch them; only phrase and proximity queries read positions
+POSITION_ARRAYS = ("positions", "position_offsets")
+
+
+def varint_lengths(values):
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        lengths += values >= (1 << shift)
+    return lengths
+
+
+def encode_varints(values):
+    # LEB128: 7 bits per byte, low bits first, the high bit set on every
+    # byte but a value's last
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = varint_lengths(values)
+    starts = np.cumsum(lengths) - lengths
+    data = np.zeros(int(lengths.sum()), dtype=np.uint8)
+    for byte in range(int(lengths.max(initial=0))):
+        has_byte = lengths > byte
+        bits = (values[has_byte] >> np.uint64(7 * byte)) & np.uint64(0x7F)
+        more = (lengths[has_byte] > byte + 1).astype(np.uint64) << np.uint64(7)
+        data[starts[has_byte] + byte] = bits | more
+    return data
+
+
+def decode_varints(data):
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    byte_index = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    bits = (data & 0x7F).astype(np.int64) << (7 * byte_index)
+    return np.add.reduceat(bits, starts)
+
+
+def encode_positions(positions, tfs):
+    # each posting's positions as varint gaps; returns the bytes and each
+    # posting's byte offset into them
+    positions = np.asarray(positions, dtype=np.int64)
+    starts = np.cumsum(tfs) - tfs
+    gaps = positions.copy()
+    gaps[1:] -= positions[:-1]
+    gaps[starts] = positions[starts]
+    data = encode_varints(gaps)
+    posting_bytes = np.zeros(len(tfs), dtype=np.int64)
+    if len(positions):
+        posting_bytes = np.add.reduceat(varint_lengths(gaps.astype(np.uint64)), starts)
+    return data, np.concatenate(([0], np.cumsum(posting_bytes))).astype(np.int64)
+
+
+def decode_positions(data):
+    return np.cumsum(decode_varints(data))
+
+
+def gather_slices(data, starts, lengths):
+    # data[starts[0]:starts[0] + lengths[0]], data[starts[1]:...], ... joined
+    ends = np.cumsum(lengths)
+    shifts = np.repeat(np.asarray(starts, dtype=np.int64) - (ends - lengths), lengths)
+    return np.asarray(data)[np.arange(int(ends[-1]) if len(ends) else 0) + shifts]
+
+
+def build_arrays(doc_ids, doc_lengths, postings):
+    # postings maps term -> [(row, positions), ...] with rows in ascending
+    # order; a posting's tf is its number of positions
+    terms = sorted(postings)
+    term_offsets = [0]
+    postings_rows = []
+    postings_tfs = []
+    all_positions = []
+    for term in terms:
+        for row, positions in postings[term]:
+            postings_rows.append(row)
+            postings_tfs.append(len(positions))
+            all_positions.extend(positions)
+        term_offsets.append(len(postings_rows))
+    postings_tfs = np.array(postings_tfs, dtype=np.int32)
+    positions, position_offsets = encode_positions(all_positions, postings_tfs)
+
+    term_width = max((len(term) for term in terms), default=1)
+    doc_id_array = np.array(doc_ids, dtype=np.int64)
+    sorted_doc_rows = np.argsort(doc_id_array, kind="stable")
+    return {
+        "terms": np.array(terms, dtype=f"<U{term_width}"),
+        "term_offsets": np.array(term_offsets, dtype=np.int64),
+        "postings_rows": np.array(postings_rows, dtype=np.int32),
+        "postings_tfs": postings_tfs,
+        "positions": positions,
+        "position_offsets": position_offsets,
+        "doc_ids": doc_id_array,
+        "doc_lengths": np.array(doc_lengths, dtype=np.int32),
+        "sorted_doc_ids": doc_id_array[sorted_doc_rows],
+        "sorted_doc_rows": sorted_doc_rows.astype(np.int64),
+    }
+
+
+def build_arrays_from_postings(
+    doc_ids, doc_lengths, terms, rows, tfs, positions, position_starts, position_bytes
+):
+    # the same arrays from one (term, row, tf) entry per posting in any
+    # order, e.g. the postings of several segments being merged; a
+    # posting's encoded positions are position_bytes bytes of positions
+    # from its position_starts
+    unique_terms, term_ids = np.unique(terms, return_inverse=True)
+    order = np.lexsort((rows, term_ids))
+    term_counts = np.bincount(term_ids, minlength=len(unique_terms))
+    position_starts = np.asarray(position_starts, dtype=np.int64)[order]
+    position_bytes = np.asarray(position_bytes, dtype=np.int64)[order]
+    doc_id_array = np.array(doc_ids, dtype=np.int64)
+    sorted_doc_rows = np.argsort(doc_id_array, kind="stable")
+    return {
+        "terms": unique_terms,
+        "term_offsets": np.concatenate(([0], np.cumsum(term_counts))).astype(np.int64),
+        "postings_rows": np.asarray(rows, dtype=np.int32)[order],
+        "postings_tfs": np.asarray(tfs, dtype=np.int32)[order],
+        "positions": gather_slices(positions, position_starts, position_bytes).astype(
+            np.uint8
+        ),
+        "position_offsets": np.concatenate(([0], np.cumsum(position_bytes))).astype(
+            np.int64
+        ),
+        "doc_ids": doc_id_array,
+        "doc_lengths": np.array(doc_lengths, dtype=np.int32),
+        "sorted_doc_ids": doc_id_array[sorted_doc_rows],
+        "sorted_doc_rows": sorted_doc_rows.astype(np.int64),
+    }
+
+
+def find_row(arrays, doc_id):
+    sorted_doc_ids = arrays["sorted_doc_ids"]
+    i = int(np.searchsorted(sorted_doc_ids, doc_id))
+    if i == len(sorted_doc_ids) or sorted_doc_ids[i] != doc_id:
+        raise KeyError(doc_id)
+    return int(arrays["sorted_doc_rows"][i])
+
+
+def write_segment(path, arrays, documents):
+    # a segment is written once under a new name and never modified, so
+    # files that are still memory-mapped by a reader are never truncated
+    tmp_path = path.with_name(path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+    doc_offsets = [0]
+    with open(tmp_path / "documents.jsonl", "wb") as f:
+        for document in documents:
+            line = (json.dumps(document) + "\n").encode("utf-8")
+            f.write(line)
+            doc_offsets.append(doc_offsets[-1] + len(line))
+    np.save(tmp_path / "doc_offsets.npy", np.array(doc_offsets, dtype=np.int64))
+    for name in INDEX_ARRAYS + POSITION_ARRAYS:
+        np.save(tmp_path / f"{name}.npy", arrays[name])
+    tmp_path.rename(path)
+
+
+def write_meta(path, meta):
+    # meta.json lists the live segments; replacing it commits a new state
+    tmp_path = path / "meta.json.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"format_version": INDEX_FORMAT_VERSION, **meta}, f)
+    os.replace(tmp_path, path / "meta.json")
+
+
+def write_arrays(path, arrays):
+    tmp_path = path.with_name(path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+    for name, array in arrays.items():
+        np.save(tmp_path / f"{name}.npy", array)
+    swap_directory(tmp_path, path)
+
+
+def save_array(path, array):
+    # same idea for a single .npy: a mapped file is replaced, never rewritten
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def save_npz(path, arrays):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def swap_directory(path, final_path):
+    old_path = final_path.with_name(final_path.name + ".old")
+    if old_path.exists():
+        shutil.rmtree(old_path)
+    if final_path.exists():
+        final_path.rename(old_path)
+    path.rename(final_path)
+    if old_path.exists():
+        shutil.rmtree(old_path)
+
+
+def read_meta(path):
+    with open(path / "meta.json", "r") as f:
+        meta = json.load(f)
+    if meta.get("format_version") != INDEX_FORMAT_VERSION:
+        raise FileNotFoundError("Index format is out of date")
+    return meta
+
+
+class IndexArrays(Mapping):
+    # each array is memory-mapped the first time it is used, so opening an
+    # index costs nothing and only the pages a query touches become resident
+    def __init__(self, path, names=INDEX_ARRAYS):
+        self.path = path
+        self.names = names
+        self.__arrays = dict()
+
+    def __getitem__(self, name):
+        if name not in self.__arrays:
+            array_path = self.path / f"{name}.npy"
+            if not array_path.exists():
+                raise KeyError(name)
+            self.__arrays[name] = np.load(array_path, mmap_mode="r")
+        return self.__arrays[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def map_all(self):
+        for name in self.names:
+            self[name]
+
+
+class DocumentStore(Sequence):
+    # a segment's documents by row, read lazily from documents.jsonl
+    def __init__(self, path):
+        self.documents_path = path / "documents.jsonl"
+        self.offsets_path = path / "doc_offsets.npy"
+        self.__data = None
+        self.__offsets = None
+
+    def open(self):
+        if self.__data is None:
+            with open(self.documents_path, "rb") as f:
+                self.__data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__offsets = np.load(self.offsets_path, mmap_mode="r")
+
+    def __getitem__(self, row):
+        self.open()
+        start = int(self.__offsets[row])
+        end = int(self.__offsets[row + 1])
+        return json.loads(self.__data[start:end])
+
+    def __len__(self):
+        self.open()
+        return len(self.__offsets) - 1
@@ -0,0 +1,36 @@
+import threading
+
+COMPACTION_INTERVAL = 30.0
+COMPACTION_MIN_CHANGES = 100
+
+
+class BackgroundCompactor:
+    # periodically folds pending adds/updates/deletes back into the saved
+    # store; works with anything that has pending_changes() and compact()
+    def __init__(
+        self, store, interval=COMPACTION_INTERVAL, min_changes=COMPACTION_MIN_CHANGES
+    ):
+        self.store = store
+        self.interval = interval
+        self.min_changes = min_changes
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is not None:
+            return
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+        self.__stopped.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def __run(self):
+        while not self.__stopped.wait(self.interval):
+            if self.store.pending_changes() >= self.min_changes:
+                self.store.compact()
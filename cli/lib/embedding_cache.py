@@ -0,0 +1,132 @@
+import hashlib
+import json
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lib.vectors import normalize_rows
+
+EMBED_BATCH_SIZE = 64
+EMBED_WORKERS = 1
+KEY_LENGTH = 40
+
+
+def text_key(model_name, text):
+    return hashlib.sha1(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    # append-only store of unit-length embeddings keyed by a hash of
+    # (model name, text); every batch is on disk as soon as it is encoded,
+    # so an interrupted build resumes where it stopped
+    def __init__(self, path, model_name):
+        self.model_name = model_name
+        self.path = path / re.sub(r"[^\w.-]", "_", model_name)
+        self.keys_path = self.path / "keys.txt"
+        self.vectors_path = self.path / "vectors.f32"
+        self.meta_path = self.path / "meta.json"
+        self.lock = threading.Lock()
+        self.__rows = None
+        self.__dim = None
+
+    def __load(self):
+        if self.__rows is not None:
+            return
+        self.__rows = dict()
+        if not self.meta_path.exists():
+            return
+        with open(self.meta_path, "r") as f:
+            self.__dim = json.load(f)["dim"]
+        keys = []
+        lines = [""]
+        if self.keys_path.exists():
+            with open(self.keys_path, "r") as f:
+                lines = f.read().split("\n")
+            keys = [key for key in lines if len(key) == KEY_LENGTH]
+        # vectors are written before their keys, so a crash can only leave
+        # vectors without keys or a half-written key; both are dropped here
+        row_bytes = self.__dim * np.dtype(np.float32).itemsize
+        size = self.vectors_path.stat().st_size if self.vectors_path.exists() else 0
+        keys = keys[: size // row_bytes]
+        if size != len(keys) * row_bytes or len(lines) != len(keys) + 1:
+            with open(self.vectors_path, "a+b") as f:
+                f.truncate(len(keys) * row_bytes)
+            with open(self.keys_path, "w") as f:
+                f.writelines(f"{key}\n" for key in keys)
+        self.__rows = {key: row for row, key in enumerate(keys)}
+
+    def __contains__(self, key):
+        self.__load()
+        return key in self.__rows
+
+    def __len__(self):
+        self.__load()
+        return len(self.__rows)
+
+    def put(self, keys, vectors):
+        with self.lock:
+            self.__load()
+            vectors = np.asarray(vectors, dtype=np.float32)
+            if self.__dim is None:
+                self.path.mkdir(parents=True, exist_ok=True)
+                self.__dim = vectors.shape[1]
+                with open(self.meta_path, "w") as f:
+                    json.dump({"model": self.model_name, "dim": self.__dim}, f)
+            with open(self.vectors_path, "ab") as f:
+                vectors.tofile(f)
+            with open(self.keys_path, "a") as f:
+                for key in keys:
+                    self.__rows[key] = len(self.__rows)
+                    f.write(f"{key}\n")
+
+    def get(self, keys):
+        self.__load()
+        rows = np.array([self.__rows[key] for key in keys], dtype=np.int64)
+        if len(rows) == 0:
+            return np.zeros((0, self.__dim or 0), dtype=np.float32)
+        vectors = np.memmap(
+            self.vectors_path,
+            dtype=np.float32,
+            mode="r",
+            shape=(len(self.__rows), self.__dim),
+        )
+        return np.array(vectors[rows])
+
+
+def embed_texts(
+    model, cache, texts, batch_size=EMBED_BATCH_SIZE, workers=EMBED_WORKERS
+):
+    # only texts missing from the cache are encoded; they are sorted by
+    # length first so each batch pads its texts to a similar size
+    workers = max(1, workers)
+    keys = [text_key(cache.model_name, text) for text in texts]
+    missing = dict()
+    for key, text in zip(keys, texts):
+        if key not in missing and key not in cache:
+            missing[key] = text
+    pending = sorted(missing.items(), key=lambda item: len(item[1]))
+    batches = [
+        pending[start : start + batch_size]
+        for start in range(0, len(pending), batch_size)
+    ]
+
+    def encode(batch):
+        texts = [text for _, text in batch]
+        return normalize_rows(
+            model.encode(texts, batch_size=len(texts), show_progress_bar=False)
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for batch in batches:
+            in_flight.append((batch, executor.submit(encode, batch)))
+            if len(in_flight) >= workers * 2:
+                done, future = in_flight.popleft()
+                cache.put([key for key, _ in done], future.result())
+        while in_flight:
+            done, future = in_flight.popleft()
+            cache.put([key for key, _ in done], future.result())
+    return cache.get(keys)
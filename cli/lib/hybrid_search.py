@@ -1,41 +1,264 @@
-import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
-from cli.utils.utils import normalize
-from index_search import InvertedIndex
-from semantic_search import ChunkedSemanticSearch
+from lib.hybrid_scores_cli import hybrid_score
+from lib.index_search import InvertedIndex
+from lib.semantic_search import ChunkedSemanticSearch
+from lib.vectors import normalize_rows
+from utils.utils import load_movies, normalize
+
+HYBRID_CANDIDATES = 100
+RRF_K = 60
 
 
 class HybridSearch:
-    def __init__(self, documents):
+    def __init__(self, documents, idx=None, semantic_search=None):
+        # an already loaded index and chunk searcher can be shared, e.g. by
+        # the search server
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
-        self.semantic_search.load_or_create_chunk_embeddings(documents)
+        self.semantic_search = semantic_search
+        if self.semantic_search is None:
+            self.semantic_search = ChunkedSemanticSearch()
+            self.semantic_search.load_or_create_chunk_embeddings(documents)
+
+        # the keyword index stays resident between queries; it is only
+        # reloaded when the index on disk changes, and queries keep using
+        # the current snapshot until the new one is ready
+        self.__index_lock = threading.Lock()
+        self.__reload = None
+        self.idx = idx
+        if self.idx is None:
+            self.idx = self.__open_index()
+        self.__index_mtime = self.__get_index_mtime()
+        self.__executor = ThreadPoolExecutor(max_workers=2)
+
+    def __get_index_mtime(self):
+        try:
+            return self.idx.index_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def __open_index(self):
+        # a missing index, one built from other documents or with another
+        # tokenizer is rebuilt; save() swaps the new files in atomically
+        idx = InvertedIndex()
+        idx.load_or_create(self.documents)
+        idx.map_all()
+        return idx
+
+    def __reload_index(self):
+        idx = self.__open_index()
+        with self.__index_lock:
+            self.idx = idx
+            self.__index_mtime = self.__get_index_mtime()
+
+    def refresh(self, wait=False):
+        # reloads, or rebuilds if stale, the keyword index on a background
+        # thread; at most one reload runs at a time
+        with self.__index_lock:
+            if self.__reload is None or not self.__reload.is_alive():
+                self.__reload = threading.Thread(
+                    target=self.__reload_index, daemon=True
+                )
+                self.__reload.start()
+            reload = self.__reload
+        if wait:
+            reload.join()
 
-        self.idx = InvertedIndex()
-        if not os.path.exists(self.idx.index_path):
-            self.idx.build()
-            self.idx.save()
+    def check_index(self):
+        # a few stats per query; meta.json is rewritten whenever the index
+        # is committed, and changes in between only reach the update logs,
+        # whose new records are replayed. The chunk store is checked the
+        # same way.
+        if self.__get_index_mtime() != self.__index_mtime:
+            self.refresh()
+        else:
+            idx = self.idx
+            if idx.update_log.changed():
+                idx.replay_updates()
+        self.semantic_search.check_updates()
+
+    def pending_changes(self):
+        return self.idx.pending_changes()
+
+    def compact(self):
+        # folds the resident index's pending changes in; the files it
+        # rewrites are the ones it already serves, so they need no reload
+        with self.__index_lock:
+            idx = self.idx
+            committed_elsewhere = self.__get_index_mtime() != self.__index_mtime
+        if committed_elsewhere:
+            # another process committed changes; compacting this copy over
+            # them would drop them, so the index is reloaded instead
+            self.refresh()
+            return False
+        compacted = idx.compact()
+        with self.__index_lock:
+            if self.idx is idx:
+                self.__index_mtime = self.__get_index_mtime()
+        return compacted
 
     def _bm25_search(self, query, limit):
-        self.idx.load()
-        return self.idx.bm25_search(query, limit)
-
-    def weighted_search(self, query, alpha, limit=5):
-        bm25_results = self._bm25_search(query, limit * 500)
-        semantic_search_results = self.semantic_search.search(query, limit * 500)
-        bm25_scores = []
-        for item in bm25_results:
-            bm25_scores.append(item[1])
-        normalized_bm25_scores = normalize(bm25_scores)
-
-        semantic_scores = []
-        for item in semantic_search_results:
-            semantic_scores.append(item["score"])
-        normalized_semantic_scores = normalize(semantic_scores)
-
-        doc_dict = dict()
-        for i in range(len(bm25_results)):
-            doc_dict[bm25_results[i][0]] = self.documents[bm25_results[i][0]]
-
-    def rrf_search(self, query, k, limit=10):
-        raise NotImplementedError("RRF hybrid search is not implemented yet.")
+        start = time.perf_counter()
+        results = self.idx.bm25_search(query, limit)
+        # bm25_search pads with documents that match no query term; those
+        # must not get a keyword rank or a normalized score
+        results = [(doc_id, score) for doc_id, score in results if score > 0]
+        return results, {"bm25_ms": (time.perf_counter() - start) * 1000}
+
+    def _semantic_search(self, query, limit):
+        start = time.perf_counter()
+        query_embedding = normalize_rows(self.semantic_search.generate_embedding(query))
+        embedded = time.perf_counter()
+        movie_scores = self.semantic_search.search_chunk_embedding(
+            query_embedding, limit
+        )
+        results = [
+            (self.semantic_search.documents[movie_idx]["id"], float(score))
+            for movie_idx, score in movie_scores
+        ]
+        return results, {
+            "embed_ms": (embedded - start) * 1000,
+            "semantic_ms": (time.perf_counter() - embedded) * 1000,
+        }
+
+    def candidates(self, query, depth=HYBRID_CANDIDATES):
+        # both retrievers run at the same time to the same depth; their
+        # results are joined on document id
+        start = time.perf_counter()
+        self.check_index()
+        bm25 = self.__executor.submit(self._bm25_search, query, depth)
+        semantic = self.__executor.submit(self._semantic_search, query, depth)
+        bm25_results, bm25_timings = bm25.result()
+        semantic_results, semantic_timings = semantic.result()
+        retrieved = time.perf_counter()
+
+        candidates = dict()
+        for source, results in (("bm25", bm25_results), ("semantic", semantic_results)):
+            normalized = normalize([score for _, score in results])
+            for rank, ((doc_id, score), norm_score) in enumerate(
+                zip(results, normalized), 1
+            ):
+                candidate = candidates.setdefault(
+                    doc_id,
+                    {
+                        "id": doc_id,
+                        "bm25_score": 0.0,
+                        "bm25_norm": 0.0,
+                        "bm25_rank": None,
+                        "semantic_score": 0.0,
+                        "semantic_norm": 0.0,
+                        "semantic_rank": None,
+                    },
+                )
+                candidate[f"{source}_score"] = float(score)
+                candidate[f"{source}_norm"] = norm_score
+                candidate[f"{source}_rank"] = rank
+
+        timings = {
+            **bm25_timings,
+            **semantic_timings,
+            "retrieve_ms": (retrieved - start) * 1000,
+            "join_ms": (time.perf_counter() - retrieved) * 1000,
+        }
+        return list(candidates.values()), timings
+
+    def __top_results(self, candidates, limit):
+        # ties keep the order candidates were first retrieved in
+        ranked = sorted(candidates, key=lambda candidate: -candidate["score"])
+        final_results = []
+        for candidate in ranked[:limit]:
+            # documents added since the caches were built are only known to
+            # the searcher that has them
+            document = self.semantic_search.document_map.get(candidate["id"])
+            if document is None:
+                with self.idx.lock:
+                    document = self.idx.docmap[candidate["id"]]
+            final_results.append(
+                {
+                    **candidate,
+                    "title": document["title"],
+                    "document": (document["description"] or "")[:100],
+                }
+            )
+        return final_results
+
+    def weighted_search_with_timings(
+        self, query, alpha=0.5, limit=5, depth=HYBRID_CANDIDATES
+    ):
+        candidates, timings = self.candidates(query, max(depth, limit))
+        start = time.perf_counter()
+        for candidate in candidates:
+            candidate["score"] = hybrid_score(
+                candidate["bm25_norm"], candidate["semantic_norm"], alpha
+            )
+        results = self.__top_results(candidates, limit)
+        timings["fuse_ms"] = (time.perf_counter() - start) * 1000
+        return results, timings
+
+    def rrf_search_with_timings(
+        self, query, k=RRF_K, limit=10, depth=HYBRID_CANDIDATES
+    ):
+        candidates, timings = self.candidates(query, max(depth, limit))
+        start = time.perf_counter()
+        for candidate in candidates:
+            candidate["score"] = sum(
+                1 / (k + candidate[f"{source}_rank"])
+                for source in ("bm25", "semantic")
+                if candidate[f"{source}_rank"] is not None
+            )
+        results = self.__top_results(candidates, limit)
+        timings["fuse_ms"] = (time.perf_counter() - start) * 1000
+        return results, timings
+
+    def weighted_search(self, query, alpha, limit=5, depth=HYBRID_CANDIDATES):
+        results, _ = self.weighted_search_with_timings(query, alpha, limit, depth)
+        return results
+
+    def rrf_search(self, query, k=RRF_K, limit=10, depth=HYBRID_CANDIDATES):
+        results, _ = self.rrf_search_with_timings(query, k, limit, depth)
+        return results
+
+
+HYBRID_STAGES = (
+    "bm25_ms",
+    "embed_ms",
+    "semantic_ms",
+    "retrieve_ms",
+    "join_ms",
+    "fuse_ms",
+)
+
+
+def hybrid_benchmark_command(
+    queries=None, limit=5, depth=HYBRID_CANDIDATES, alpha=0.5, k=RRF_K, repeat=3
+):
+    # average latency of every stage per query; retrieve_ms is wall time for
+    # BM25 and semantic retrieval running side by side
+    movies = load_movies()
+    hybrid = HybridSearch(movies)
+    if not queries:
+        queries = [movie["title"] for movie in islice(movies, 20)]
+
+    report = dict()
+    for method in ("weighted", "rrf"):
+        totals = dict.fromkeys(HYBRID_STAGES + ("total_ms",), 0.0)
+        for _ in range(repeat):
+            for query in queries:
+                # the first pass fills the query cache, later passes show the
+                # cost without the encoder
+                start = time.perf_counter()
+                if method == "weighted":
+                    _, timings = hybrid.weighted_search_with_timings(
+                        query, alpha, limit, depth
+                    )
+                else:
+                    _, timings = hybrid.rrf_search_with_timings(query, k, limit, depth)
+                timings["total_ms"] = (time.perf_counter() - start) * 1000
+                for stage in totals:
+                    totals[stage] += timings[stage]
+        runs = repeat * len(queries)
+        report[method] = {stage: total / runs for stage, total in totals.items()}
+    return report
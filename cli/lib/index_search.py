@@ -1,11 +1,75 @@
+from bisect import bisect_left, bisect_right
 from collections import Counter
-import json
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import heapq
 import math
-from pickle import dump, load
-from utils.utils import get_data_file, tokenize, PROJECT_ROOT
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from lib.boolean_query import field_term, parse_query
+from lib.cache_manifest import (
+    CACHE_PATH,
+    DIGEST_MODULUS,
+    MANIFEST_NAME,
+    CacheManifest,
+    digest_params,
+    document_digest,
+)
+from lib.compact_index import (
+    POSITION_ARRAYS,
+    DocumentStore,
+    IndexArrays,
+    build_arrays,
+    build_arrays_from_postings,
+    decode_positions,
+    find_row,
+    read_meta,
+    save_array,
+    write_meta,
+    write_segment,
+)
+from lib.result_pages import PAGE_DEPTH, ResultPages, iter_pages
+from lib.update_log import UpdateLog
+from lib.vectors import top_k_indices
+from utils.utils import (
+    iter_movies,
+    tokenize,
+    tokenize_many,
+    TOKENIZER_VERSION,
+)
 
 BM25_K1 = 1.5
 BM25_B = 0.75
+BUILD_BATCH_SIZE = 500
+# queries scored together by bm25_search_batch; each holds a row of scores
+SCORE_BATCH_QUERIES = 64
+# documents per segment written by build()
+BUILD_SEGMENT_ROWS = 50000
+# added documents held in memory before they are flushed as a segment
+FLUSH_ROWS = 1000
+# tiered merging: MERGE_FACTOR segments of one size tier make one of the next
+MERGE_FACTOR = 4
+MERGE_MIN_ROWS = 1000
+# a segment with at least this share of deleted rows is rewritten
+MERGE_DELETED_RATIO = 0.5
+EMPTY_POSTINGS = np.zeros(0, dtype=np.int64)
+# slack for floating point drift between upper bounds and summed scores
+PRUNE_TOLERANCE = 1e-9
+# postings bm25_top_k scores at once when it reads into an essential list
+TOP_K_BLOCK = 64
+# bm25_search(proximity=True) reranks this many top documents, adding up to
+# PROXIMITY_WEIGHT times the mean idf of each pair of adjacent query terms
+PROXIMITY_DEPTH = 100
+PROXIMITY_WEIGHT = 1.0
+# boolean AND merges two row lists linearly unless one is this many times
+# longer, when galloping through it skips most of its rows instead
+GALLOP_RATIO = 32
 
 
 def bm25_idf_command(term):
@@ -28,96 +92,1147 @@ def bm25_tf_command(doc_id, term, k1=BM25_K1, b=BM25_B):
     return indexer.get_bm25_tf(doc_id, term, k1, b)
 
 
-class InvertedIndex:
+def bm25_benchmark_command(queries=None, limit=5, repeat=3):
+    indexer = InvertedIndex()
+    try:
+        indexer.load()
+    except FileNotFoundError:
+        print("Index not found. Please build first.")
+        return
+    if not queries:
+        queries = [movie["title"] for movie in islice(indexer.docmap.values(), 5)]
+
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            expected = indexer.bm25_search_exhaustive(query, limit)
+        exhaustive_time = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            actual = indexer.bm25_search(query, limit)
+        postings_time = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            pruned, stats = indexer.bm25_top_k(query, limit)
+        pruned_time = (time.perf_counter() - start) / repeat
+
+        results.append(
+            {
+                "query": query,
+                "exhaustive_ms": exhaustive_time * 1000,
+                "postings_ms": postings_time * 1000,
+                "pruned_ms": pruned_time * 1000,
+                "scored": stats["scored"],
+                "skipped": stats["skipped"],
+                "match": expected == actual == pruned,
+            }
+        )
+    return results
+
+
+def bm25_batch_benchmark_command(queries=None, limit=5, repeat=3):
+    # per-query bm25_search against scoring every query in one batch
+    indexer = InvertedIndex()
+    try:
+        indexer.load()
+    except FileNotFoundError:
+        print("Index not found. Please build first.")
+        return
+    if not queries:
+        queries = [movie["title"] for movie in islice(indexer.docmap.values(), 200)]
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        expected = [indexer.bm25_search(query, limit) for query in queries]
+    loop_time = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        actual = indexer.bm25_search_batch(queries, limit)
+    batch_time = (time.perf_counter() - start) / repeat
+
+    return {
+        "queries": len(queries),
+        "loop_ms": loop_time * 1000,
+        "batch_ms": batch_time * 1000,
+        "match": expected == actual,
+    }
+
+
+def document_text(movie):
+    return f"{movie['title']} {movie['description']}"
+
+
+def digest_manifest(digest, doc_count):
+    return {**digest_params(digest, doc_count), "tokenizer_version": TOKENIZER_VERSION}
+
+
+def index_manifest(documents):
+    # what a saved index was built from; an index whose manifest differs
+    # from the documents being searched is stale. The corpus hash is a sum
+    # of per-document hashes, so the index keeps it current one added or
+    # deleted document at a time.
+    digest = 0
+    doc_count = 0
+    for document in documents:
+        digest += document_digest(document)
+        doc_count += 1
+    return digest_manifest(digest % DIGEST_MODULUS, doc_count)
+
+
+def tokenize_batch(batch):
+    # postings map term -> [(row, positions), ...]; positions count tokens
+    # after stopwords are dropped, so phrases match across them. The title
+    # leads the document text, so its tokens are the first title_length
+    # positions, and they are also posted under "title:<term>".
+    start_row, documents = batch
+    texts = tokenize_many(document_text(movie) for movie in documents)
+    titles = tokenize_many(movie["title"] for movie in documents)
+    doc_lengths = []
+    postings = dict()
+    for row, (tokens, title) in enumerate(zip(texts, titles), start_row):
+        doc_lengths.append(len(tokens))
+        positions = dict()
+        for position, token in enumerate(tokens):
+            if token not in positions:
+                positions[token] = []
+            positions[token].append(position)
+            if position < len(title):
+                term = field_term("title", token)
+                if term not in positions:
+                    positions[term] = []
+                positions[term].append(position)
+        for token, token_positions in positions.items():
+            if token not in postings:
+                postings[token] = []
+            postings[token].append((row, token_positions))
+    return doc_lengths, postings
+
+
+def map_batches(function, batches, workers=1):
+    # results come back in submission order, and at most two batches per
+    # worker are in flight so the input is never read far ahead
+    if workers <= 1:
+        for batch in batches:
+            yield function(batch)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(function, batch))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def bm25_tf_score(tf, doc_length, avg_doc_length, k1=BM25_K1, b=BM25_B):
+    length_norm = 1 - b + b * (doc_length / avg_doc_length)
+    return (tf * (k1 + 1)) / (tf + k1 * length_norm)
+
+
+def bm25_idf_score(total_docs, doc_freq):
+    return math.log((total_docs - doc_freq + 0.5) / (doc_freq + 0.5) + 1)
+
+
+def compute_term_max_scores(arrays, total_docs, avg_doc_length):
+    term_offsets = arrays["term_offsets"]
+    if len(term_offsets) <= 1:
+        return np.zeros(0, dtype=np.float64)
+    tf_scores = bm25_tf_score(
+        arrays["postings_tfs"],
+        arrays["doc_lengths"][arrays["postings_rows"]],
+        avg_doc_length,
+    )
+    doc_freqs = np.diff(term_offsets)
+    idfs = np.log((total_docs - doc_freqs + 0.5) / (doc_freqs + 0.5) + 1)
+    return np.maximum.reduceat(tf_scores, term_offsets[:-1]) * idfs
+
+
+def segment_tier(live_rows):
+    if live_rows < MERGE_MIN_ROWS:
+        return 0
+    return int(math.log(live_rows / MERGE_MIN_ROWS, MERGE_FACTOR)) + 1
+
+
+def pick_merge(segments, force=False):
+    # returns the [start, end) run of adjacent segments to merge next, or
+    # None. Only adjacent segments are merged, so rows keep their order.
+    if force:
+        if len(segments) > 1 or any(segment.deleted for segment in segments):
+            return 0, len(segments)
+        return None
+    # a segment that is mostly tombstones is rewritten on its own
+    for i, segment in enumerate(segments):
+        if len(segment.deleted) >= MERGE_DELETED_RATIO * max(1, segment.num_rows):
+            return i, i + 1
+    # otherwise MERGE_FACTOR neighbours of the same size tier become one
+    # segment of the next tier, so each row is rewritten O(log n) times
+    tiers = [segment_tier(segment.live_rows) for segment in segments]
+    run_start = 0
+    for i in range(1, len(tiers) + 1):
+        if i == len(tiers) or tiers[i] != tiers[run_start]:
+            if i - run_start >= MERGE_FACTOR:
+                return run_start, run_start + MERGE_FACTOR
+            run_start = i
+    return None
+
+
+def merge_segments(segments, deleted):
+    # the live rows of adjacent segments, in order, as the arrays and
+    # documents of one segment; row_maps give each old row's new row (-1
+    # for dropped rows)
+    doc_ids = []
+    doc_lengths = []
+    terms = []
+    rows = []
+    tfs = []
+    positions = []
+    position_starts = []
+    position_bytes = []
+    positions_size = 0
+    row_maps = []
+    for segment, dead in zip(segments, deleted):
+        arrays = segment.arrays
+        live = np.ones(segment.num_rows, dtype=bool)
+        live[list(dead)] = False
+        row_map = np.where(live, np.cumsum(live) - 1 + len(doc_ids), -1)
+        row_maps.append(row_map)
+        doc_ids.extend(arrays["doc_ids"][live].tolist())
+        doc_lengths.extend(arrays["doc_lengths"][live].tolist())
+        postings_rows = arrays["postings_rows"]
+        kept = live[postings_rows]
+        term_ids = np.repeat(
+            np.arange(len(arrays["terms"])), np.diff(arrays["term_offsets"])
+        )
+        terms.append(arrays["terms"][term_ids[kept]])
+        rows.append(row_map[postings_rows[kept]])
+        tfs.append(arrays["postings_tfs"][kept])
+        position_offsets = segment.positions["position_offsets"]
+        positions.append(segment.positions["positions"])
+        position_starts.append(position_offsets[:-1][kept] + positions_size)
+        position_bytes.append(np.diff(position_offsets)[kept])
+        positions_size += len(positions[-1])
+    merged = build_arrays_from_postings(
+        doc_ids,
+        doc_lengths,
+        np.concatenate(terms),
+        np.concatenate(rows),
+        np.concatenate(tfs),
+        np.concatenate(positions),
+        np.concatenate(position_starts),
+        np.concatenate(position_bytes),
+    )
+
+    def documents():
+        for segment, row_map in zip(segments, row_maps):
+            for row in np.flatnonzero(row_map >= 0).tolist():
+                yield segment.document(row)
+
+    return merged, documents(), row_maps
+
+
+def gallop_to(values, target, lo=0):
+    # first index at or after lo whose value is >= target: the step doubles
+    # until it passes target, then a binary search narrows the last step
+    step = 1
+    hi = lo
+    while hi < len(values) and values[hi] < target:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect_left(values, target, lo, min(hi, len(values)))
+
+
+def gallop_intersect(lists):
+    # rows in every sorted list. The shortest list drives, and the others
+    # are galloped through, so a rare term costs about its own length
+    # times the log of the gaps it skips in the common ones.
+    lists = sorted(lists, key=len)
+    if not lists:
+        return []
+    cursors = [0] * len(lists)
+    matches = []
+    for value in lists[0]:
+        for i in range(1, len(lists)):
+            cursors[i] = gallop_to(lists[i], value, cursors[i])
+            if cursors[i] == len(lists[i]):
+                return matches
+            if lists[i][cursors[i]] != value:
+                break
+        else:
+            matches.append(value)
+    return matches
+
+
+def intersect_rows(rows, other_rows):
+    small, large = sorted((rows, other_rows), key=len)
+    if len(small) * GALLOP_RATIO >= len(large):
+        return np.intersect1d(small, large, assume_unique=True)
+    return np.array(gallop_intersect([small, large]), dtype=np.int64)
+
+
+class IndexSegment:
+    # an immutable run of rows with its own postings, positions, doc lengths
+    # and documents; only its set of deleted rows changes once it is written
+    def __init__(
+        self, name, arrays, positions, documents, deleted=(), deleted_file=None
+    ):
+        self.name = name
+        self.arrays = arrays
+        self.positions = positions
+        self.documents = documents
+        self.deleted = set(deleted)
+        self.deleted_file = deleted_file
+        self.__deleted_rows = None
+
+    @property
+    def num_rows(self):
+        return len(self.arrays["doc_ids"])
+
+    @property
+    def live_rows(self):
+        return self.num_rows - len(self.deleted)
+
+    def delete(self, row):
+        self.deleted.add(row)
+        self.__deleted_rows = None
+
+    def live(self, rows):
+        if self.__deleted_rows is None:
+            self.__deleted_rows = np.array(sorted(self.deleted), dtype=np.int64)
+        return ~np.isin(rows, self.__deleted_rows)
+
+    def term_id(self, term):
+        terms = self.arrays["terms"]
+        i = int(np.searchsorted(terms, term))
+        if i < len(terms) and terms[i] == term:
+            return i
+        return None
+
+    def postings(self, term):
+        term_id = self.term_id(term)
+        if term_id is None:
+            return EMPTY_POSTINGS, EMPTY_POSTINGS
+        start, end = self.arrays["term_offsets"][term_id : term_id + 2]
+        return (
+            self.arrays["postings_rows"][start:end],
+            self.arrays["postings_tfs"][start:end],
+        )
+
+    def term_positions(self, term, row):
+        # where term occurs in the row's document, or None if it doesn't
+        term_id = self.term_id(term)
+        if term_id is None:
+            return None
+        start, end = self.arrays["term_offsets"][term_id : term_id + 2]
+        i = start + int(np.searchsorted(self.arrays["postings_rows"][start:end], row))
+        if i == end or self.arrays["postings_rows"][i] != row:
+            return None
+        position_offsets = self.positions["position_offsets"]
+        data = self.positions["positions"][
+            position_offsets[i] : position_offsets[i + 1]
+        ]
+        return decode_positions(data)
+
+    def doc_id(self, row):
+        return int(self.arrays["doc_ids"][row])
+
+    def doc_ids(self):
+        return self.arrays["doc_ids"].tolist()
+
+    def doc_lengths(self, rows):
+        return self.arrays["doc_lengths"][rows]
+
+    def find_row(self, doc_id):
+        row = find_row(self.arrays, doc_id)
+        if row in self.deleted:
+            raise KeyError(doc_id)
+        return row
+
+    def document(self, row):
+        return self.documents[row]
+
+    def map_all(self):
+        if isinstance(self.arrays, IndexArrays):
+            self.arrays.map_all()
+        if isinstance(self.documents, DocumentStore):
+            self.documents.open()
+
+
+class MemorySegment:
+    # documents added since the last flush, indexed as they arrive
     def __init__(self):
-        self.index = dict()
-        self.docmap = dict()
-        self.term_frequencies = dict()
-        self.doc_lengths = dict()
-        self.cache_path = PROJECT_ROOT / "cache"
-        self.index_path = self.cache_path / "index.pkl"
-        self.map_path = self.cache_path / "docmap.pkl"
-        self.freq_path = self.cache_path / "term_frequencies.pkl"
-        self.doc_lengths_path = self.cache_path / "doc_lengths.pkl"
-
-    def __add_document(self, doc_id, text):
-        tokens = tokenize(text)
-        self.doc_lengths[doc_id] = len(tokens)
-        if doc_id not in self.term_frequencies:
-            self.term_frequencies[doc_id] = Counter()
-        for token in tokens:
-            if token not in self.index:
-                self.index[token] = set()
-            self.index[token].add(doc_id)
-            self.term_frequencies[doc_id][token] += 1
+        self.name = None
+        self.doc_id_list = []
+        self.doc_length_list = []
+        self.documents = []
+        self.postings_lists = dict()
+        self.rows = dict()
+        self.deleted = set()
+
+    @property
+    def num_rows(self):
+        return len(self.doc_id_list)
+
+    def add(self, document):
+        row = self.num_rows
+        (doc_length,), postings = tokenize_batch((row, [document]))
+        self.doc_id_list.append(document["id"])
+        self.doc_length_list.append(doc_length)
+        self.documents.append(document)
+        self.rows[document["id"]] = row
+        for term, entries in postings.items():
+            if term not in self.postings_lists:
+                self.postings_lists[term] = ([], [], [])
+            for entry_row, positions in entries:
+                self.postings_lists[term][0].append(entry_row)
+                self.postings_lists[term][1].append(len(positions))
+                self.postings_lists[term][2].append(positions)
+        return doc_length
+
+    def delete(self, row):
+        self.deleted.add(row)
+        self.rows.pop(self.doc_id_list[row], None)
+
+    def live(self, rows):
+        return ~np.isin(rows, list(self.deleted))
+
+    def postings(self, term):
+        if term not in self.postings_lists:
+            return EMPTY_POSTINGS, EMPTY_POSTINGS
+        rows, tfs, _ = self.postings_lists[term]
+        return np.array(rows, dtype=np.int64), np.array(tfs, dtype=np.int32)
+
+    def term_positions(self, term, row):
+        if term not in self.postings_lists:
+            return None
+        rows, _, positions = self.postings_lists[term]
+        i = bisect_left(rows, row)
+        if i == len(rows) or rows[i] != row:
+            return None
+        return np.array(positions[i], dtype=np.int64)
+
+    def doc_id(self, row):
+        return self.doc_id_list[row]
+
+    def doc_ids(self):
+        return self.doc_id_list
+
+    def doc_lengths(self, rows):
+        return np.array(self.doc_length_list, dtype=np.int32)[rows]
+
+    def find_row(self, doc_id):
+        return self.rows[doc_id]
+
+    def document(self, row):
+        return self.documents[row]
+
+    def arrays(self):
+        return build_arrays(
+            self.doc_id_list,
+            self.doc_length_list,
+            {
+                term: list(zip(rows, positions))
+                for term, (rows, _, positions) in self.postings_lists.items()
+            },
+        )
+
+
+class DocumentMap(Mapping):
+    # doc_id -> document across every segment of an index
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, doc_id):
+        return self.index.get_document(doc_id)
+
+    def __contains__(self, doc_id):
+        return self.index.has_document(doc_id)
+
+    def __iter__(self):
+        return self.index.iter_doc_ids()
+
+    def __len__(self):
+        return self.index.total_docs
+
+
+class InvertedIndex:
+    # the index is a list of immutable on-disk segments plus an in-memory
+    # segment for documents added since the last flush. Rows are numbered
+    # across segments in order, and BM25 uses collection-wide statistics, so
+    # scores match a single-segment index of the same documents exactly.
+    def __init__(self, flush_rows=FLUSH_ROWS, cache_path=CACHE_PATH):
+        self.docmap = DocumentMap(self)
+        self.segments = []
+        self.memory = MemorySegment()
+        self.total_docs = 0
+        self.total_length = 0
+        self.source_manifest = None
+        self.flush_rows = flush_rows
+        self.cache_path = cache_path
+        self.index_dir = self.cache_path / "index"
+        self.index_path = self.index_dir / "meta.json"
+        self.segments_dir = self.index_dir / "segments"
+        self.updates_path = self.index_dir / "updates.jsonl"
+        self.update_log = UpdateLog(self.updates_path)
+        self.lock = threading.RLock()
+        # ranked bm25_page lists that cursors resume
+        self.pages = ResultPages()
+        self.__merge_lock = threading.Lock()
+        self.__merge_thread = None
+        self.__writing = set()
+        self.__digest = 0
+        self.__next_segment = 0
+        self.__seq = 0
+        self.__committed = False
+        self.__log_updates = False
+        self.__reset_updates()
+
+    def __reset_updates(self):
+        # changes since the last commit; each is logged with a sequence
+        # number so a log that outlived its commit is not replayed twice
+        self.__updates = []
+        self.__dirty = set()
+        self.__max_scores = dict()
+        self.__update_offsets()
+
+    def __update_offsets(self):
+        self.__columns = None
+        self.__offsets = [0]
+        for segment in self.segments:
+            self.__offsets.append(self.__offsets[-1] + segment.num_rows)
+
+    @property
+    def manifest(self):
+        return digest_manifest(self.__digest, self.total_docs)
+
+    def __all_segments(self):
+        return [*self.segments, self.memory]
+
+    def __total_rows(self):
+        return self.__offsets[-1] + self.memory.num_rows
+
+    def __locate(self, row):
+        i = bisect_right(self.__offsets, row) - 1
+        return self.__all_segments()[i], row - self.__offsets[i]
+
+    def __get_positions(self, term, row):
+        segment, local_row = self.__locate(row)
+        return segment.term_positions(term, local_row)
+
+    def __has_phrase(self, terms, row):
+        # the phrase starts wherever term i sits i positions after term 0
+        starts = None
+        for i, term in enumerate(terms):
+            positions = self.__get_positions(term, row) - i
+            if starts is None:
+                starts = positions
+            else:
+                starts = np.intersect1d(starts, positions, assume_unique=True)
+            if len(starts) == 0:
+                return False
+        return True
 
     def __get_avg_doc_length(self) -> float:
-        if len(self.doc_lengths) == 0:
+        if self.total_docs == 0:
             return 0.0
-        total_lengths = 0
-        for value in self.doc_lengths.values():
-            total_lengths += value
-        return total_lengths / len(self.doc_lengths)
+        return self.total_length / self.total_docs
 
-    def get_documents(self, term):
-        term_lower = term.lower()
-        if term_lower not in self.index:
-            print(f"{term} not found in index")
+    def __get_postings(self, term):
+        rows, tfs = self.__get_posting_arrays(term)
+        return rows.tolist(), tfs.tolist()
+
+    def __get_posting_arrays(self, term):
+        # the term's column of the term frequency matrix: each segment's
+        # postings are a term-major (CSC) slice, offset to global rows
+        all_rows = []
+        all_tfs = []
+        for segment, offset in zip(self.__all_segments(), self.__offsets):
+            rows, tfs = segment.postings(term)
+            if len(rows) == 0:
+                continue
+            if segment.deleted:
+                live = segment.live(rows)
+                rows = rows[live]
+                tfs = tfs[live]
+            all_rows.append(rows.astype(np.int64) + offset)
+            all_tfs.append(tfs)
+        if not all_rows:
+            return EMPTY_POSTINGS, EMPTY_POSTINGS
+        return np.concatenate(all_rows), np.concatenate(all_tfs)
+
+    def __get_dense_rows(self):
+        # doc lengths and a live mask for every row, rebuilt after changes
+        if self.__columns is None:
+            segments = self.__all_segments()
+            lengths = [
+                np.asarray(segment.doc_lengths(slice(None)), dtype=np.int64)
+                for segment in segments
+            ]
+            live = np.ones(self.__total_rows(), dtype=bool)
+            for segment, offset in zip(segments, self.__offsets):
+                live[[offset + row for row in segment.deleted]] = False
+            self.__columns = (np.concatenate(lengths), live)
+        return self.__columns
+
+    def __collection_stats(self, stats):
+        # (total_docs, avg_doc_length, doc_freqs) BM25 is scored with: this
+        # index's own, or the whole collection's when it is one shard of it
+        if stats is None:
+            return self.total_docs, self.__get_avg_doc_length(), None
+        avg_doc_length = 0.0
+        if stats["total_docs"]:
+            avg_doc_length = stats["total_length"] / stats["total_docs"]
+        return stats["total_docs"], avg_doc_length, stats["doc_freqs"]
+
+    def term_stats(self, query):
+        # this index's share of the statistics bm25_search(query) uses
+        terms = [self.__get_term(token) for token in tokenize(query)]
+        with self.lock:
+            return {
+                "total_docs": self.total_docs,
+                "total_length": self.total_length,
+                "doc_freqs": {
+                    term: len(self.__get_postings(term)[0]) for term in terms
+                },
+            }
+
+    def __compute_max_score(self, rows, tfs, total_docs, avg_doc_length, doc_freq):
+        lengths, _ = self.__get_dense_rows()
+        max_tf_score = float(
+            np.max(bm25_tf_score(np.asarray(tfs), lengths[rows], avg_doc_length))
+        )
+        return max_tf_score * bm25_idf_score(total_docs, doc_freq)
+
+    def __get_term_max_score(self, term, rows, tfs, stats=None):
+        # a segment's stored bounds hold for its own statistics, which are
+        # the collection's only when it is the whole index
+        if stats is not None:
+            total_docs, avg_doc_length, doc_freqs = self.__collection_stats(stats)
+            return self.__compute_max_score(
+                rows, tfs, total_docs, avg_doc_length, doc_freqs[term]
+            )
+        if len(self.segments) == 1 and not self.memory.num_rows:
+            segment = self.segments[0]
+            if not segment.deleted:
+                return float(segment.arrays["term_max_scores"][segment.term_id(term)])
+        if term not in self.__max_scores:
+            self.__max_scores[term] = self.__compute_max_score(
+                rows, tfs, self.total_docs, self.__get_avg_doc_length(), len(rows)
+            )
+        return self.__max_scores[term]
+
+    def __lookup_tf(self, rows, tfs, row):
+        i = bisect_left(rows, row)
+        if i < len(rows) and rows[i] == row:
+            return tfs[i]
+        return 0
+
+    def __find_document(self, doc_id):
+        # (segment, local row) of a live document; a document lives in at
+        # most one segment, and newer segments are the likelier place
+        for segment in reversed(self.__all_segments()):
+            try:
+                return segment, segment.find_row(doc_id)
+            except KeyError:
+                continue
+        raise KeyError(doc_id)
+
+    def __find_row(self, doc_id):
+        for i in range(len(self.segments), -1, -1):
+            segment = self.__all_segments()[i]
+            try:
+                return self.__offsets[i] + segment.find_row(doc_id)
+            except KeyError:
+                continue
+        raise KeyError(doc_id)
+
+    def __is_deleted(self, row):
+        segment, row = self.__locate(row)
+        return row in segment.deleted
+
+    def __get_doc_id(self, row):
+        segment, row = self.__locate(row)
+        return segment.doc_id(row)
+
+    def __get_doc_lengths(self, rows):
+        if len(rows) == 0:
             return []
-        doc_ids = list(self.index[term_lower])
-        return sorted(doc_ids)
+        rows = np.asarray(rows, dtype=np.int64)
+        lengths = np.empty(len(rows), dtype=np.int64)
+        positions = np.searchsorted(self.__offsets, rows, side="right") - 1
+        segments = self.__all_segments()
+        for i in np.unique(positions).tolist():
+            in_segment = positions == i
+            lengths[in_segment] = segments[i].doc_lengths(
+                rows[in_segment] - self.__offsets[i]
+            )
+        return lengths.tolist()
 
-    def build(self):
-        with open(get_data_file("movies.json"), "r") as f:
-            data = json.load(f)
-        for movie in data["movies"]:
-            input_text = f"{movie['title']} {movie['description']}"
-            self.__add_document(movie["id"], input_text)
-            self.docmap[movie["id"]] = movie
+    def get_document(self, doc_id):
+        with self.lock:
+            segment, row = self.__find_document(doc_id)
+            return segment.document(row)
+
+    def has_document(self, doc_id):
+        with self.lock:
+            try:
+                self.__find_document(doc_id)
+            except KeyError:
+                return False
+            return True
+
+    def iter_doc_ids(self):
+        for segment in self.__all_segments():
+            for row, doc_id in enumerate(segment.doc_ids()):
+                if row not in segment.deleted:
+                    yield doc_id
+
+    def __get_term(self, term):
+        tokens = tokenize(term)
+        if len(tokens) != 1:
+            raise Exception("bm25 only accepts 1 term")
+        return tokens[0]
+
+    def get_documents(self, term):
+        with self.lock:
+            term_lower = term.lower()
+            rows, _ = self.__get_postings(term_lower)
+            if not rows:
+                print(f"{term} not found in index")
+                return []
+            doc_ids = [self.__get_doc_id(row) for row in rows]
+            return sorted(doc_ids)
+
+    def __iter_batches(self, documents, batch_size, segment_rows, pending):
+        # documents of each batch wait in `pending` until its postings are
+        # back. A batch never spans two segments, so a segment is written at
+        # exactly segment_rows documents whatever the batch size.
+        batch = []
+        segment_size = 0
+        for movie in documents:
+            batch.append(movie)
+            segment_size += 1
+            if len(batch) == batch_size or segment_size == segment_rows:
+                pending.append(batch)
+                yield 0, batch
+                batch = []
+            if segment_size == segment_rows:
+                segment_size = 0
+        if batch:
+            pending.append(batch)
+            yield 0, batch
+
+    def __new_segment_name(self):
+        # names are never reused, even by a rebuild, while files remain
+        self.__next_segment += 1
+        name = f"seg_{self.__next_segment:06d}"
+        while (self.segments_dir / name).exists():
+            self.__next_segment += 1
+            name = f"seg_{self.__next_segment:06d}"
+        self.__writing.add(name)
+        return name
+
+    def __write_segment(self, name, arrays, documents, deleted=()):
+        num_rows = len(arrays["doc_ids"])
+        arrays["term_max_scores"] = compute_term_max_scores(
+            arrays, num_rows, float(np.sum(arrays["doc_lengths"])) / max(1, num_rows)
+        )
+        path = self.segments_dir / name
+        write_segment(path, arrays, documents)
+        return IndexSegment(
+            name,
+            IndexArrays(path),
+            IndexArrays(path, POSITION_ARRAYS),
+            DocumentStore(path),
+            deleted,
+        )
+
+    def build(
+        self,
+        workers=1,
+        batch_size=BUILD_BATCH_SIZE,
+        documents=None,
+        segment_rows=BUILD_SEGMENT_ROWS,
+    ):
+        # documents defaults to streaming movies.json. A segment is written
+        # out once it holds segment_rows documents, so memory use is bounded
+        # by one segment rather than the whole corpus; save() commits them.
+        if documents is None:
+            documents = iter_movies()
+        with self.lock:
+            try:
+                self.__next_segment = read_meta(self.index_dir)["next_segment"]
+            except FileNotFoundError:
+                pass
+            self.segments = []
+            self.memory = MemorySegment()
+            self.total_docs = 0
+            self.total_length = 0
+            self.__digest = 0
+            self.__committed = False
+            self.__log_updates = False
+            self.__seq = 0
+            self.__reset_updates()
+
+            segment = ([], [], [], dict())
+            pending = deque()
+            batches = self.__iter_batches(documents, batch_size, segment_rows, pending)
+            # batches are merged in order, so the result matches a serial build
+            for batch_lengths, batch_postings in map_batches(
+                tokenize_batch, batches, workers
+            ):
+                batch = pending.popleft()
+                doc_ids, doc_lengths, segment_documents, postings = segment
+                start_row = len(doc_ids)
+                doc_ids.extend(movie["id"] for movie in batch)
+                doc_lengths.extend(batch_lengths)
+                segment_documents.extend(batch)
+                for term, entries in batch_postings.items():
+                    if term not in postings:
+                        postings[term] = []
+                    postings[term].extend(
+                        (start_row + row, positions) for row, positions in entries
+                    )
+                for movie in batch:
+                    self.__digest += document_digest(movie)
+                self.total_docs += len(batch)
+                self.total_length += sum(batch_lengths)
+                if len(doc_ids) >= segment_rows:
+                    self.__add_built_segment(*segment)
+                    segment = ([], [], [], dict())
+            if segment[0]:
+                self.__add_built_segment(*segment)
+            self.__digest %= DIGEST_MODULUS
+            self.source_manifest = self.manifest
+            self.__update_offsets()
+
+    def __add_built_segment(self, doc_ids, doc_lengths, documents, postings):
+        name = self.__new_segment_name()
+        arrays = build_arrays(doc_ids, doc_lengths, postings)
+        self.segments.append(self.__write_segment(name, arrays, documents))
+
+    def __commit(self):
+        # writes the in-memory segment and new deletions, then replaces
+        # meta.json; the update log is only cleared once meta.json names
+        # everything it held. Segments nothing refers to are removed.
+        if self.memory.num_rows:
+            name = self.__new_segment_name()
+            self.segments.append(
+                self.__write_segment(
+                    name,
+                    self.memory.arrays(),
+                    self.memory.documents,
+                    self.memory.deleted,
+                )
+            )
+            self.__dirty.add(name)
+            self.__writing.discard(name)
+        self.memory = MemorySegment()
+        self.segments_dir.mkdir(parents=True, exist_ok=True)
+        for segment in self.segments:
+            self.__writing.discard(segment.name)
+            if segment.name in self.__dirty and segment.deleted:
+                segment.deleted_file = f"{segment.name}.{self.__seq}.deleted.npy"
+                save_array(
+                    self.segments_dir / segment.deleted_file,
+                    np.array(sorted(segment.deleted), dtype=np.int64),
+                )
+        write_meta(
+            self.index_dir,
+            {
+                "segments": [
+                    {"name": segment.name, "deleted": segment.deleted_file}
+                    for segment in self.segments
+                ],
+                "next_segment": self.__next_segment,
+                "flushed_seq": self.__seq,
+                "total_docs": self.total_docs,
+                "total_length": self.total_length,
+                "manifest": self.manifest,
+                "source_manifest": self.source_manifest,
+            },
+        )
+        # a fresh build replaces whatever the log changed. Otherwise changes
+        # another process logged since this one last read the log are not
+        # in this commit; they stay for the next replay
+        pending = []
+        if self.__committed:
+            pending = [
+                update
+                for update in self.update_log.read()
+                if update["seq"] > self.__seq
+            ]
+        self.update_log.rewrite(pending)
+        self.__committed = True
+        self.__log_updates = True
+        self.__reset_updates()
+
+        live_files = {self.segments_dir / segment.name for segment in self.segments}
+        live_files.update(
+            self.segments_dir / segment.deleted_file
+            for segment in self.segments
+            if segment.deleted_file is not None
+        )
+        for path in self.segments_dir.iterdir():
+            if path in live_files or path.name.split(".")[0] in self.__writing:
+                continue
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+        CacheManifest(self.cache_path / MANIFEST_NAME).record(
+            "keyword_index",
+            {**self.manifest, "built_from": self.source_manifest},
+            [self.index_path, *sorted(live_files)],
+        )
+
+    def cache_check(self, documents, verify=False):
+        # None when the saved index can serve these documents, otherwise the
+        # reason it cannot; cache status reports the same
+        return CacheManifest(self.cache_path / MANIFEST_NAME).check_store(
+            "keyword_index", index_manifest(documents), self.updates_path, verify
+        )
+
+    def load_or_create(self, documents):
+        # the saved index is used if it was built from these documents or
+        # holds them, before or after its logged changes; anything else is
+        # rebuilt
+        documents = list(documents)
+        if self.cache_check(documents) is None:
+            self.load()
+        else:
+            self.build(documents=documents)
+            self.save()
 
     def save(self):
-        self.cache_path.mkdir(parents=True, exist_ok=True)
-        with open(self.index_path, "wb") as index:
-            dump(self.index, index)
-        with open(self.map_path, "wb") as docmap:
-            dump(self.docmap, docmap)
-        with open(self.freq_path, "wb") as term_freq:
-            dump(self.term_frequencies, term_freq)
-        with open(self.doc_lengths_path, "wb") as doc_lengths:
-            dump(self.doc_lengths, doc_lengths)
+        # commits a fresh build; a loaded index is compacted into one segment
+        with self.lock:
+            committed = self.__committed
+            if not committed:
+                self.__commit()
+        if committed:
+            self.compact()
 
     def load(self):
-        if (
-            not self.index_path.exists()
-            or not self.map_path.exists()
-            or not self.freq_path.exists()
-        ):
-            raise FileNotFoundError("Cache file not found")
-        with open(self.index_path, "rb") as f:
-            self.index = load(f)
-        with open(self.map_path, "rb") as f:
-            self.docmap = load(f)
-        with open(self.freq_path, "rb") as f:
-            self.term_frequencies = load(f)
-        with open(self.doc_lengths_path, "rb") as f:
-            self.doc_lengths = load(f)
+        with self.lock:
+            if not self.index_path.exists():
+                raise FileNotFoundError("Cache file not found")
+            meta = read_meta(self.index_dir)
+            self.segments = []
+            for entry in meta["segments"]:
+                path = self.segments_dir / entry["name"]
+                deleted = ()
+                if entry["deleted"] is not None:
+                    deleted = np.load(self.segments_dir / entry["deleted"]).tolist()
+                self.segments.append(
+                    IndexSegment(
+                        entry["name"],
+                        IndexArrays(path),
+                        IndexArrays(path, POSITION_ARRAYS),
+                        DocumentStore(path),
+                        deleted,
+                        entry["deleted"],
+                    )
+                )
+            self.memory = MemorySegment()
+            self.total_docs = meta["total_docs"]
+            self.total_length = meta["total_length"]
+            self.__digest = int(meta["manifest"]["corpus_hash"], 16)
+            self.source_manifest = meta["source_manifest"]
+            self.__next_segment = meta["next_segment"]
+            self.__seq = meta["flushed_seq"]
+            self.__committed = True
+            self.__reset_updates()
+            self.update_log.reset()
+            self.__replay_log()
+
+    def __replay_log(self):
+        # applies the changes logged since the log was last read, by this
+        # process or another one; those this index already holds are skipped
+        applied = 0
+        self.__log_updates = False
+        try:
+            for update in self.update_log.read():
+                if update["seq"] > self.__seq:
+                    self.__apply_update(update)
+                    applied += 1
+        finally:
+            self.__log_updates = True
+        return applied
+
+    def replay_updates(self):
+        with self.lock:
+            return self.__replay_log()
+
+    def map_all(self):
+        # maps every saved file up front; a fully mapped index keeps working
+        # after merges remove the segments it was loaded from
+        with self.lock:
+            for segment in self.segments:
+                segment.map_all()
+
+    def __apply_update(self, update):
+        op = update["op"]
+        if op == "delete":
+            doc_id = update["id"]
+        else:
+            doc_id = update["document"]["id"]
+        if op == "add" and self.has_document(doc_id):
+            raise ValueError(f"Document {doc_id} is already indexed")
+
+        if op in ("update", "delete"):
+            segment, row = self.__find_document(doc_id)
+            document = segment.document(row)
+            self.total_docs -= 1
+            self.total_length -= int(segment.doc_lengths([row])[0])
+            self.__digest -= document_digest(document)
+            segment.delete(row)
+            self.__dirty.add(segment.name)
+
+        if op in ("add", "update"):
+            document = update["document"]
+            self.total_docs += 1
+            self.total_length += self.memory.add(document)
+            self.__digest += document_digest(document)
+
+        self.__digest %= DIGEST_MODULUS
+        self.__max_scores = dict()
+        self.__columns = None
+        self.__seq = update.setdefault("seq", self.__seq + 1)
+        self.__updates.append(update)
+        if self.__log_updates:
+            # what the index holds once the log is replayed, for cache_check
+            update["manifest"] = self.manifest
+            self.update_log.append(update)
+
+    def __record_update(self, update):
+        with self.lock:
+            # changes other processes logged first, so sequence numbers
+            # keep increasing
+            self.__replay_log()
+            self.__apply_update(update)
+            if self.__committed and self.memory.num_rows >= self.flush_rows:
+                self.flush()
+
+    def add_document(self, document):
+        self.__record_update({"op": "add", "document": document})
+
+    def update_document(self, document):
+        self.__record_update({"op": "update", "document": document})
+
+    def delete_document(self, doc_id):
+        self.__record_update({"op": "delete", "id": doc_id})
+
+    def pending_changes(self):
+        return len(self.__updates)
+
+    def flush(self):
+        # writes pending changes out as a new segment and starts merging in
+        # the background if the merge policy finds work
+        with self.lock:
+            if not self.__updates:
+                return False
+            self.__commit()
+        self.schedule_merges()
+        return True
+
+    def merge(self, force=False):
+        # one step of the merge policy; force merges everything into one
+        # segment. The merged segment is written without holding the lock,
+        # so searches and updates carry on meanwhile.
+        with self.__merge_lock:
+            with self.lock:
+                if force:
+                    self.flush()
+                picked = pick_merge(self.segments, force)
+                if picked is None:
+                    return False
+                sources = self.segments[picked[0] : picked[1]]
+                deleted = [set(segment.deleted) for segment in sources]
+                name = self.__new_segment_name()
+
+            arrays, documents, row_maps = merge_segments(sources, deleted)
+            merged = []
+            # a run with no live rows is dropped rather than written empty
+            if len(arrays["doc_ids"]):
+                merged.append(self.__write_segment(name, arrays, documents))
+
+            with self.lock:
+                # rows deleted while the merge ran stay deleted
+                for source, dead, row_map in zip(sources, deleted, row_maps):
+                    for row in source.deleted - dead:
+                        merged[0].delete(int(row_map[row]))
+                start = self.segments.index(sources[0])
+                self.segments[start : start + len(sources)] = merged
+                self.__dirty.add(name)
+                self.__writing.discard(name)
+                self.__commit()
+            return True
+
+    def schedule_merges(self):
+        with self.lock:
+            if self.__merge_thread is not None and self.__merge_thread.is_alive():
+                return
+            if pick_merge(self.segments) is None:
+                return
+            self.__merge_thread = threading.Thread(
+                target=self.__merge_until_done, daemon=True
+            )
+            self.__merge_thread.start()
+
+    def __merge_until_done(self):
+        while self.merge():
+            pass
+
+    def wait_for_merges(self):
+        thread = self.__merge_thread
+        if thread is not None:
+            thread.join()
+
+    def segment_stats(self):
+        with self.lock:
+            return [
+                {
+                    "name": segment.name or "memory",
+                    "rows": segment.num_rows,
+                    "deleted": len(segment.deleted),
+                }
+                for segment in self.__all_segments()
+                if segment.num_rows
+            ]
+
+    def compact(self):
+        # folds pending changes in, including the ones other processes
+        # logged since this index last read the log, and merges every
+        # segment into one
+        self.replay_updates()
+        flushed = self.flush()
+        merged = self.merge(force=True)
+        return flushed or merged
 
     def get_tf(self, doc_id, term):
         tokens = tokenize(term)
         if len(tokens) != 1:
             raise Exception("get_tf only accepts 1 term")
         token = tokens[0]
-        if self.term_frequencies[doc_id].get(token) is None:
-            return 0
-        return self.term_frequencies[doc_id][token]
+        with self.lock:
+            row = self.__find_row(doc_id)
+            rows, tfs = self.__get_postings(token)
+            return self.__lookup_tf(rows, tfs, row)
 
     def get_idf(self, term):
         tokens = tokenize(term)
         if len(tokens) != 1:
             raise Exception("get_tf only accepts 1 term")
         token = tokens[0]
-        total_docs = len(self.docmap)
-        total_match = len(self.get_documents(token))
+        with self.lock:
+            total_docs = self.total_docs
+            total_match = len(self.get_documents(token))
         idf = math.log((total_docs + 1) / (total_match + 1))
         return idf
 
@@ -126,30 +1241,407 @@ class InvertedIndex:
         if len(tokens) != 1:
             raise Exception("get_bm25_idf only accepts 1 term")
         token = tokens[0]
-        n = len(self.docmap)
-        df = len(self.get_documents(token))
-        return math.log((n - df + 0.5) / (df + 0.5) + 1)
+        with self.lock:
+            n = self.total_docs
+            df = len(self.get_documents(token))
+        return bm25_idf_score(n, df)
 
     def get_bm25_tf(self, doc_id, term, k1=BM25_K1, b=BM25_B):
-        tf = self.get_tf(doc_id, term)
-        doc_length = self.doc_lengths[doc_id]
-        avg_doc_length = self.__get_avg_doc_length()
-        length_norm = 1 - b + b * (doc_length / avg_doc_length)
-        return (tf * (k1 + 1)) / (tf + k1 * length_norm)
+        with self.lock:
+            tf = self.get_tf(doc_id, term)
+            doc_length = self.__get_doc_lengths([self.__find_row(doc_id)])[0]
+            avg_doc_length = self.__get_avg_doc_length()
+        return bm25_tf_score(tf, doc_length, avg_doc_length, k1, b)
 
     def bm25(self, doc_id, term):
         bm25tf = self.get_bm25_tf(doc_id, term)
         bm25idf = self.get_bm25_idf(term)
         return bm25tf * bm25idf
 
-    def bm25_search(self, query, limit=5):
+    def __top_results(self, scores, limit):
+        # ties are broken by row, which is the order documents were indexed in
+        top_scores = heapq.nsmallest(
+            limit, scores.items(), key=lambda item: (-item[1], item[0])
+        )
+        results = [(self.__get_doc_id(row), score) for row, score in top_scores]
+        # documents without any query term still fill the list with a zero score
+        row = 0
+        total_rows = self.__total_rows()
+        while len(results) < limit and row < total_rows:
+            if row not in scores and not self.__is_deleted(row):
+                results.append((self.__get_doc_id(row), 0.0))
+            row += 1
+        return results
+
+    def __score_queries(self, queries, stats=None):
+        # one row of BM25 scores per query over every row of the index. A
+        # term's column is scored once, as a vector, however many queries
+        # use it, and each row sums its terms in query order like bm25().
+        total_docs, avg_doc_length, doc_freqs = self.__collection_stats(stats)
+        lengths, _ = self.__get_dense_rows()
+        columns = dict()
+        scores = np.zeros((len(queries), len(lengths)))
+        for i, terms in enumerate(queries):
+            for term in terms:
+                if term not in columns:
+                    rows, tfs = self.__get_posting_arrays(term)
+                    doc_freq = len(rows) if doc_freqs is None else doc_freqs[term]
+                    idf = bm25_idf_score(total_docs, doc_freq)
+                    tf_scores = bm25_tf_score(tfs, lengths[rows], avg_doc_length)
+                    columns[term] = (rows, tf_scores * idf)
+                rows, term_scores = columns[term]
+                scores[i, rows] += term_scores
+        return scores
+
+    def __top_row_ids(self, scores, limit):
+        # ties are broken by row, and documents without any query term fill
+        # the list with a zero score, as in __top_results
+        _, live = self.__get_dense_rows()
+        scores = np.where(live, scores, -1.0)
+        rows = top_k_indices(scores, limit)
+        return rows[scores[rows] >= 0]
+
+    def __top_rows(self, scores, limit):
+        rows = self.__top_row_ids(scores, limit)
+        return [(self.__get_doc_id(row), float(scores[row])) for row in rows.tolist()]
+
+    def __proximity_scores(self, terms, scores, depth, stats):
+        # the top rows gain weight * mean idf / distance^2 for each pair of
+        # adjacent query terms, by the closest the two come in the document.
+        # Boosts only raise scores, so rows below the depth cannot overtake.
+        pairs = [(a, b) for a, b in zip(terms, terms[1:]) if a != b]
+        if not pairs:
+            return scores
+        total_docs, _, doc_freqs = self.__collection_stats(stats)
+        idfs = dict()
+        for term in {term for pair in pairs for term in pair}:
+            if doc_freqs is None:
+                doc_freq = len(self.__get_posting_arrays(term)[0])
+            else:
+                doc_freq = doc_freqs[term]
+            idfs[term] = bm25_idf_score(total_docs, doc_freq)
+        scores = scores.copy()
+        for row in self.__top_row_ids(scores, depth).tolist():
+            for a, b in pairs:
+                a_positions = self.__get_positions(a, row)
+                b_positions = self.__get_positions(b, row)
+                if a_positions is None or b_positions is None:
+                    continue
+                # each position of a against its neighbours among b's
+                i = np.searchsorted(b_positions, a_positions)
+                after = b_positions[np.minimum(i, len(b_positions) - 1)]
+                before = b_positions[np.maximum(i - 1, 0)]
+                distance = min(
+                    np.min(np.abs(after - a_positions)),
+                    np.min(np.abs(a_positions - before)),
+                )
+                scores[row] += (
+                    PROXIMITY_WEIGHT * (idfs[a] + idfs[b]) / 2 / float(distance) ** 2
+                )
+        return scores
+
+    def bm25_search(self, query, limit=5, stats=None, proximity=False, where=None):
+        # query tokens go through the same single-term normalization as bm25();
+        # stats are the collection's term_stats() when this index is a shard.
+        # With proximity, documents where the query terms appear close
+        # together are boosted. where is a boolean query (see parse_query)
+        # that documents must match to be ranked at all.
+        terms = [self.__get_term(token) for token in tokenize(query)]
+        node = None if where is None else parse_query(where)
+        with self.lock:
+            scores = self.__score_queries([terms], stats)[0]
+            if node is not None:
+                scores = self.__restrict_scores(scores, node)
+            if proximity:
+                scores = self.__proximity_scores(
+                    terms, scores, max(limit, PROXIMITY_DEPTH), stats
+                )
+            return self.__top_rows(scores, limit)
+
+    def __match_rows(self, node, postings):
+        # sorted live rows matching a parse_query node; postings memoizes
+        # the term columns already read
+        kind = node[0]
+        if kind == "term":
+            if node[1] not in postings:
+                postings[node[1]] = self.__get_posting_arrays(node[1])[0]
+            return postings[node[1]]
+        if kind == "or":
+            children = [self.__match_rows(child, postings) for child in node[1]]
+            return np.unique(np.concatenate(children))
+        _, live = self.__get_dense_rows()
+        if kind == "not":
+            return np.setdiff1d(
+                np.flatnonzero(live),
+                self.__match_rows(node[1], postings),
+                assume_unique=True,
+            )
+        # and: the rarest operand goes first and the rows left only shrink,
+        # so each longer operand is mostly skipped over; NOT operands are
+        # subtracted from the result rather than complemented
+        include = [
+            self.__match_rows(child, postings) for child in node[1] if child[0] != "not"
+        ]
+        rows = np.flatnonzero(live)
+        if include:
+            include.sort(key=len)
+            rows = include[0]
+            for other_rows in include[1:]:
+                if len(rows) == 0:
+                    break
+                rows = intersect_rows(rows, other_rows)
+        for child in node[1]:
+            if child[0] == "not" and len(rows):
+                rows = np.setdiff1d(
+                    rows, self.__match_rows(child[1], postings), assume_unique=True
+                )
+        return rows
+
+    def boolean_search(self, query, limit=None, default="or"):
+        # ids of the documents matching a boolean query, e.g.
+        # 'title:dragon AND (castle OR knight) NOT comedy', in index order;
+        # default joins adjacent terms (see parse_query)
+        node = parse_query(query, default)
+        with self.lock:
+            rows = self.__match_rows(node, dict())[:limit]
+            return [self.__get_doc_id(row) for row in rows.tolist()]
+
+    def __restrict_scores(self, scores, node):
+        # rows that don't match the boolean query can never be ranked
+        matches = np.zeros(len(scores), dtype=bool)
+        matches[self.__match_rows(node, dict())] = True
+        return np.where(matches, scores, -1.0)
+
+    def bm25_page(self, query, limit=5, cursor=None, proximity=False, where=None):
+        # a page of bm25_search results and the cursor of the next page (or
+        # None). The ranking is cached, so following pages are slices of it
+        # until the index changes, which expires the cursors.
+        terms = [self.__get_term(token) for token in tokenize(query)]
+        with self.lock:
+            key = ["bm25", terms, proximity, where, self.manifest]
+        return self.pages.page(
+            key,
+            lambda depth: self.bm25_search(
+                query, depth, proximity=proximity, where=where
+            ),
+            limit,
+            cursor,
+        )
+
+    def bm25_iter(self, query, proximity=False, where=None, page_size=PAGE_DEPTH):
+        # the (doc_id, score) pairs of bm25_search, best first, produced as
+        # they are read rather than ranked up front. Changing the index while
+        # they are read expires the cursor underneath, raising ValueError.
+        return iter_pages(
+            lambda limit, cursor: self.bm25_page(
+                query, limit, cursor, proximity, where
+            ),
+            page_size,
+        )
+
+    def phrase_search(self, phrase, limit=5):
+        # documents containing the phrase's terms consecutively, ranked by
+        # their BM25 score for those terms. Stopwords are not indexed, so
+        # "lord of the rings" matches "lord rings" wherever it appears.
+        terms = [self.__get_term(token) for token in tokenize(phrase)]
+        if not terms or limit <= 0:
+            return []
+        with self.lock:
+            candidates = gallop_intersect(
+                [self.__get_posting_arrays(term)[0].tolist() for term in set(terms)]
+            )
+            matches = [row for row in candidates if self.__has_phrase(terms, row)]
+            if not matches:
+                return []
+            scores = self.__score_queries([terms])[0]
+            rows = np.array(matches, dtype=np.int64)
+            rows = rows[np.lexsort((rows, -scores[rows]))[:limit]]
+            return [
+                (self.__get_doc_id(row), float(scores[row])) for row in rows.tolist()
+            ]
+
+    def bm25_search_batch(self, queries, limit=5):
+        # bm25_search for many queries, e.g. an evaluation run; queries are
+        # scored SCORE_BATCH_QUERIES at a time to bound the score matrix
+        term_lists = [
+            [self.__get_term(token) for token in tokenize(query)] for query in queries
+        ]
+        results = []
+        with self.lock:
+            for start in range(0, len(term_lists), SCORE_BATCH_QUERIES):
+                block = term_lists[start : start + SCORE_BATCH_QUERIES]
+                scores = self.__score_queries(block)
+                results.extend(self.__top_rows(row, limit) for row in scores)
+        return results
+
+    def bm25_top_k(self, query, limit=5, stats=None):
+        # MaxScore: terms are ordered by their score upper bound, and the
+        # cheapest terms whose bounds together cannot reach the current k-th
+        # score become non-essential. Only documents from essential posting
+        # lists are visited, and a candidate is dropped as soon as its partial
+        # score plus the remaining bounds falls below the threshold.
+        terms = [self.__get_term(token) for token in tokenize(query)]
+        if limit <= 0:
+            return [], {"scored": 0, "skipped": 0}
+        with self.lock:
+            return self.__bm25_top_k(terms, limit, stats)
+
+    def __bm25_top_k(self, terms, limit, stats):
+        total_docs, avg_doc_length, doc_freqs = self.__collection_stats(stats)
+        lengths, _ = self.__get_dense_rows()
+
+        query_terms = []
+        by_term = dict()
+        # the documents containing any query term, for the stats
+        matching = np.zeros(len(lengths), dtype=bool)
+        for term, count in Counter(terms).items():
+            rows, tfs = self.__get_posting_arrays(term)
+            if len(rows) == 0:
+                continue
+            matching[rows] = True
+            doc_freq = len(rows) if doc_freqs is None else doc_freqs[term]
+            query_term = {
+                "term": term,
+                "rows": rows,
+                "tfs": tfs,
+                "idf": bm25_idf_score(total_docs, doc_freq),
+                "upper_bound": count
+                * self.__get_term_max_score(term, rows, tfs, stats),
+                "count": count,
+                # the postings an essential list has read are scored a block
+                # at a time; block_rows/block_scores cover rows[start:end]
+                "cursor": 0,
+                "start": 0,
+                "end": 0,
+                "block_rows": [],
+                "block_scores": [],
+            }
+            query_terms.append(query_term)
+            by_term[term] = query_term
+        query_terms.sort(key=lambda query_term: query_term["upper_bound"])
+        prefix_bounds = []
+        running_bound = 0.0
+        for query_term in query_terms:
+            running_bound += query_term["upper_bound"]
+            prefix_bounds.append(running_bound)
+
+        def load_block(query_term):
+            # score the next block of an essential list in one pass, so a
+            # document's length is read per block rather than per posting
+            start = query_term["cursor"]
+            end = min(start + TOP_K_BLOCK, len(query_term["rows"]))
+            rows = query_term["rows"][start:end]
+            tf_scores = bm25_tf_score(
+                query_term["tfs"][start:end], lengths[rows], avg_doc_length
+            )
+            query_term["start"] = start
+            query_term["end"] = end
+            query_term["block_rows"] = rows.tolist()
+            query_term["block_scores"] = (tf_scores * query_term["idf"]).tolist()
+
+        def probe(query_term, row):
+            # the score of a non-essential term: its cursor gallops forward,
+            # since candidates only ever increase
+            rows = query_term["rows"]
+            cursor = gallop_to(rows, row, query_term["cursor"])
+            query_term["cursor"] = cursor
+            if cursor == len(rows) or rows[cursor] != row:
+                return 0.0
+            if query_term["start"] <= cursor < query_term["end"]:
+                return query_term["block_scores"][cursor - query_term["start"]]
+            tf_score = bm25_tf_score(
+                int(query_term["tfs"][cursor]), int(lengths[row]), avg_doc_length
+            )
+            return tf_score * query_term["idf"]
+
+        heap = []
+        threshold = 0.0
+        first_essential = 0
+        scored = 0
+        while first_essential < len(query_terms):
+            essential = query_terms[first_essential:]
+            candidate = None
+            for query_term in essential:
+                cursor = query_term["cursor"]
+                if cursor == len(query_term["rows"]):
+                    continue
+                if not query_term["start"] <= cursor < query_term["end"]:
+                    load_block(query_term)
+                row = query_term["block_rows"][cursor - query_term["start"]]
+                if candidate is None or row < candidate:
+                    candidate = row
+            if candidate is None:
+                break
+
+            contributions = dict()
+            bound = prefix_bounds[first_essential - 1] if first_essential else 0.0
+            for query_term in essential:
+                cursor = query_term["cursor"]
+                if cursor == len(query_term["rows"]):
+                    continue
+                i = cursor - query_term["start"]
+                if query_term["block_rows"][i] == candidate:
+                    score = query_term["block_scores"][i]
+                    contributions[query_term["term"]] = score
+                    bound += query_term["count"] * score
+                    query_term["cursor"] += 1
+            for i in range(first_essential - 1, -1, -1):
+                if bound + PRUNE_TOLERANCE < threshold:
+                    break
+                query_term = query_terms[i]
+                score = probe(query_term, candidate)
+                contributions[query_term["term"]] = score
+                bound += query_term["count"] * score - query_term["upper_bound"]
+            if bound + PRUNE_TOLERANCE < threshold:
+                continue
+
+            # the final score is summed in query order, exactly as bm25_search
+            score = 0
+            for term in terms:
+                query_term = by_term.get(term)
+                if query_term is None:
+                    continue
+                if term not in contributions:
+                    contributions[term] = probe(query_term, candidate)
+                if contributions[term]:
+                    score += contributions[term]
+            scored += 1
+            entry = (score, -candidate)
+            if len(heap) < limit:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+            else:
+                continue
+            if len(heap) == limit:
+                threshold = heap[0][0]
+                while (
+                    first_essential < len(query_terms)
+                    and prefix_bounds[first_essential] + PRUNE_TOLERANCE < threshold
+                ):
+                    first_essential += 1
+
+        # matching documents that were never fully scored: pruned by the
+        # bound as candidates, or only in lists that became non-essential
+        stats = {
+            "scored": scored,
+            "skipped": int(np.count_nonzero(matching)) - scored,
+        }
+
+        # a heap that never filled up holds every matching row, so padding
+        # only ever adds documents that contain none of the query terms
+        scores = {-negative_row: score for score, negative_row in heap}
+        return self.__top_results(scores, limit), stats
+
+    def bm25_search_exhaustive(self, query, limit=5):
         tokens = tokenize(query)
         scores_dict = dict()
-        for id in self.docmap:
-            running_score = 0
-            for token in tokens:
-                running_score += self.bm25(id, token)
-            scores_dict[id] = running_score
+        with self.lock:
+            for id in self.docmap:
+                running_score = 0
+                for token in tokens:
+                    running_score += self.bm25(id, token)
+                scores_dict[id] = running_score
         sort_scores = sorted(
             scores_dict.items(), key=lambda item: item[1], reverse=True
         )
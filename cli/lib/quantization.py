@@ -0,0 +1,226 @@
+import numpy as np
+
+from lib.cache_manifest import MANIFEST_NAME, CacheManifest
+from lib.compact_index import save_npz
+
+PRECISIONS = ("float32", "float16", "int8", "pq")
+SCORE_BLOCK_ROWS = 8192
+PQ_SUBSPACE_DIMS = 8
+PQ_CENTROIDS = 256
+PQ_TRAINING_ROWS = 20000
+PQ_KMEANS_ITERATIONS = 10
+PQ_SEED = 42
+
+
+def quantized_name(embed_path, precision):
+    return f"{embed_path.stem}.{precision}"
+
+
+def quantized_path(embed_path, precision):
+    return embed_path.with_name(f"{quantized_name(embed_path, precision)}.npz")
+
+
+def blocked_scores(num_rows, score_block, query_embedding):
+    # scores are computed a block of rows at a time so the float32 copy of
+    # a compressed matrix never has to exist in full. Like a float32 matrix
+    # product, a query matrix (one column per query) gets a column of scores
+    # per query, and each block is decoded once for all of them
+    scores = np.empty((num_rows, *query_embedding.shape[1:]), dtype=np.float32)
+    for start in range(0, num_rows, SCORE_BLOCK_ROWS):
+        stop = min(start + SCORE_BLOCK_ROWS, num_rows)
+        scores[start:stop] = score_block(start, stop)
+    return scores
+
+
+class Float16Matrix:
+    precision = "float16"
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    @classmethod
+    def encode(cls, vectors):
+        return cls(np.asarray(vectors, dtype=np.float16))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes
+
+    def scores(self, query_embedding):
+        return blocked_scores(
+            len(self.vectors),
+            lambda start, stop: (
+                self.vectors[start:stop].astype(np.float32) @ query_embedding
+            ),
+            query_embedding,
+        )
+
+    def arrays(self):
+        return {"vectors": self.vectors}
+
+
+class Int8Matrix:
+    # symmetric scalar quantization with one scale per dimension
+    precision = "int8"
+
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def encode(cls, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        scales = np.abs(vectors).max(axis=0) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(vectors / scales), -127, 127).astype(np.int8)
+        return cls(codes, scales.astype(np.float32))
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def scores(self, query_embedding):
+        scaled_query = (query_embedding.T * self.scales).T.astype(np.float32)
+        return blocked_scores(
+            len(self.codes),
+            lambda start, stop: (
+                self.codes[start:stop].astype(np.float32) @ scaled_query
+            ),
+            query_embedding,
+        )
+
+    def arrays(self):
+        return {"codes": self.codes, "scales": self.scales}
+
+
+def train_codebook(vectors, n_centroids, rng):
+    centroids = vectors[rng.choice(len(vectors), n_centroids, replace=False)]
+    for _ in range(PQ_KMEANS_ITERATIONS):
+        assignments = assign_codes(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_centroids)
+        empty = counts == 0
+        # centroids that lost all their rows are reseeded from random rows
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+    return centroids.astype(np.float32)
+
+
+def assign_codes(vectors, centroids):
+    # nearest centroid by euclidean distance; |v|^2 is the same for every
+    # centroid so it is left out
+    distances = (centroids**2).sum(axis=1) - 2 * (vectors @ centroids.T)
+    return np.argmin(distances, axis=1)
+
+
+class ProductQuantizedMatrix:
+    # rows are split into subspaces of PQ_SUBSPACE_DIMS and each piece is
+    # replaced by the one-byte id of its nearest codebook centroid
+    precision = "pq"
+
+    def __init__(self, codes, codebooks):
+        self.codes = codes
+        self.codebooks = codebooks
+
+    @classmethod
+    def encode(cls, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        subspaces = cls.__split(vectors, -(-vectors.shape[1] // PQ_SUBSPACE_DIMS))
+        rng = np.random.default_rng(PQ_SEED)
+        sample = rng.choice(
+            len(vectors), min(len(vectors), PQ_TRAINING_ROWS), replace=False
+        )
+        n_centroids = min(PQ_CENTROIDS, len(vectors))
+        codebooks = np.stack(
+            [train_codebook(part[sample], n_centroids, rng) for part in subspaces]
+        )
+        codes = np.empty((len(vectors), len(subspaces)), dtype=np.uint8)
+        for start in range(0, len(vectors), SCORE_BLOCK_ROWS):
+            stop = start + SCORE_BLOCK_ROWS
+            for j, part in enumerate(subspaces):
+                codes[start:stop, j] = assign_codes(part[start:stop], codebooks[j])
+        return cls(codes, codebooks)
+
+    @staticmethod
+    def __split(vectors, n_subspaces):
+        padding = n_subspaces * PQ_SUBSPACE_DIMS - vectors.shape[-1]
+        if padding:
+            pad_width = [(0, 0)] * (vectors.ndim - 1) + [(0, padding)]
+            vectors = np.pad(vectors, pad_width)
+        return np.split(vectors, n_subspaces, axis=-1)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.codebooks.nbytes
+
+    def scores(self, query_embedding):
+        # one lookup table per query: the dot product of every centroid with
+        # the matching piece of the query, summed along each row's codes
+        pieces = self.__split(query_embedding.T, self.codes.shape[1])
+        table = np.einsum("mkd,m...d->mk...", self.codebooks, np.stack(pieces))
+        subspaces = np.arange(self.codes.shape[1])
+        return blocked_scores(
+            len(self.codes),
+            lambda start, stop: table[subspaces, self.codes[start:stop]].sum(axis=1),
+            query_embedding,
+        )
+
+    def arrays(self):
+        return {"codes": self.codes, "codebooks": self.codebooks}
+
+
+QUANTIZERS = {
+    quantizer.precision: quantizer
+    for quantizer in (Float16Matrix, Int8Matrix, ProductQuantizedMatrix)
+}
+
+
+def quantize(vectors, precision):
+    if precision not in QUANTIZERS:
+        raise ValueError(f"Unknown precision {precision!r}")
+    return QUANTIZERS[precision].encode(vectors)
+
+
+def save_quantized(path, matrix):
+    save_npz(path, matrix.arrays())
+
+
+def load_quantized(path, precision):
+    with np.load(path) as data:
+        return QUANTIZERS[precision](**{name: data[name] for name in data.files})
+
+
+def remove_quantized(embed_path):
+    for precision in PRECISIONS:
+        quantized_path(embed_path, precision).unlink(missing_ok=True)
+    CacheManifest(embed_path.parent / MANIFEST_NAME).remove(
+        *(quantized_name(embed_path, precision) for precision in PRECISIONS)
+    )
+
+
+def load_or_create_quantized(embed_path, vectors, precision):
+    # the compressed copy is rebuilt whenever the float32 cache it was made
+    # from has been rewritten or has a different number of rows
+    if precision == "float32":
+        return None
+    manifest = CacheManifest(embed_path.parent / MANIFEST_NAME)
+    name = quantized_name(embed_path, precision)
+    path = quantized_path(embed_path, precision)
+    params = manifest.source_params(embed_path, rows=len(vectors))
+    if manifest.check(name, params) is None:
+        return load_quantized(path, precision)
+    matrix = quantize(vectors, precision)
+    save_quantized(path, matrix)
+    manifest.record(name, params, [path])
+    return matrix
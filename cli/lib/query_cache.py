@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+QUERY_CACHE_SIZE = 4096
+QUERY_CACHE_TTL = 7 * 24 * 60 * 60.0
+
+
+def normalize_query(text):
+    # only whitespace is folded: case can change the embedding of cased models
+    return " ".join(text.split())
+
+
+class QueryEmbeddingCache:
+    # bounded LRU of query embeddings keyed on (model name, query text);
+    # entries older than ttl seconds are treated as misses
+    def __init__(self, max_size=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL, path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.__entries = OrderedDict()
+        if path is not None and path.exists():
+            self.load()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, model_name, text):
+        key = (model_name, normalize_query(text))
+        with self.lock:
+            entry = self.__entries.get(key)
+            if entry is not None and self.__expired(entry[1]):
+                del self.__entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, model_name, text, embedding, created=None):
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.setflags(write=False)
+        key = (model_name, normalize_query(text))
+        with self.lock:
+            self.__entries[key] = (
+                embedding,
+                time.time() if created is None else created,
+            )
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+        return embedding
+
+    def get_or_compute(self, model_name, text, compute):
+        embedding = self.get(model_name, text)
+        if embedding is None:
+            embedding = self.put(model_name, text, compute())
+        return embedding
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.__entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def clear(self):
+        with self.lock:
+            self.__entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def save(self, path=None):
+        path = path or self.path
+        with self.lock:
+            entries = [
+                (key, entry)
+                for key, entry in self.__entries.items()
+                if not self.__expired(entry[1])
+            ]
+        # entries are saved least recently used first, so load() restores
+        # the same eviction order
+        tmp_path = path.with_name(path.name + ".tmp")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                models=np.array([key[0] for key, _ in entries], dtype=str),
+                texts=np.array([key[1] for key, _ in entries], dtype=str),
+                embeddings=np.array(
+                    [entry[0] for _, entry in entries], dtype=np.float32
+                ),
+                created=np.array([entry[1] for _, entry in entries], dtype=np.float64),
+            )
+        os.replace(tmp_path, path)
+
+    def load(self, path=None):
+        path = path or self.path
+        with np.load(path) as data:
+            rows = zip(
+                data["models"].tolist(),
+                data["texts"].tolist(),
+                data["embeddings"],
+                data["created"].tolist(),
+            )
+            for model_name, text, embedding, created in rows:
+                if not self.__expired(created):
+                    self.put(model_name, text, embedding, created)
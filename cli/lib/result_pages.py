@@ -0,0 +1,110 @@
+import base64
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+# ranked lists kept for cursors to resume
+PAGE_CACHE_SIZE = 256
+# results ranked when a query is first paged; a page past the end of the
+# list ranks it again twice as deep
+PAGE_DEPTH = 100
+
+
+def query_digest(key):
+    data = json.dumps(key, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+def encode_cursor(digest, offset):
+    data = json.dumps([digest, offset]).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        digest, offset = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError("Invalid cursor") from None
+    if not isinstance(digest, str) or not isinstance(offset, int) or offset < 0:
+        raise ValueError("Invalid cursor")
+    return digest, offset
+
+
+def iter_pages(page, page_size=PAGE_DEPTH):
+    # the results of a paged search one at a time, best first; page(limit,
+    # cursor) is e.g. bm25_page. Pages are fetched as the reader gets to
+    # them, so one that stops early never has the rest of the list ranked.
+    cursor = None
+    while True:
+        results, cursor = page(page_size, cursor)
+        yield from results
+        if cursor is None:
+            return
+
+
+class ResultPages:
+    # best-first result lists by query, so page 2..N of a query is a slice
+    # of the list page 1 ranked instead of another pass over the corpus.
+    # A cursor is the query's digest and an offset: it resumes the list
+    # while the key (the query and the state of the data it ran on) is
+    # unchanged, and is refused once that state moves on.
+    def __init__(self, max_size=PAGE_CACHE_SIZE, depth=PAGE_DEPTH):
+        self.max_size = max_size
+        self.depth = depth
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def page(self, key, rank, limit, cursor=None):
+        # rank(depth) returns at most depth (id, ...) results, best first.
+        # Returns the page at the cursor (the first page without one) and
+        # the cursor of the next page, or None after the last.
+        digest = query_digest(key)
+        offset = 0
+        if cursor is not None:
+            cursor_digest, offset = decode_cursor(cursor)
+            if cursor_digest != digest:
+                raise ValueError("Cursor is for another query or has expired")
+        end = offset + limit
+        # one result past the page tells whether another page follows
+        with self.lock:
+            entry = self.__entries.get(digest)
+            shallow = None
+            if entry is not None and (len(entry[0]) > end or entry[1]):
+                self.hits += 1
+                self.__entries.move_to_end(digest)
+            else:
+                self.misses += 1
+                shallow, entry = entry, None
+        if entry is None:
+            entry = self.__rank(rank, end + 1, shallow)
+            with self.lock:
+                self.__entries[digest] = entry
+                self.__entries.move_to_end(digest)
+                while len(self.__entries) > self.max_size:
+                    self.__entries.popitem(last=False)
+        results, _ = entry
+        next_cursor = None
+        if len(results) > end:
+            next_cursor = encode_cursor(digest, end)
+        return results[offset:end], next_cursor
+
+    def __rank(self, rank, needed, entry):
+        # (results, complete); the pages already read keep their order,
+        # and the deeper ranking only adds the results after them
+        depth = max(needed, self.depth)
+        if entry is not None:
+            depth = max(depth, 2 * len(entry[0]))
+        ranked = rank(depth)
+        complete = len(ranked) < depth
+        if entry is None:
+            return ranked, complete
+        results = list(entry[0])
+        seen = {result[0] for result in results}
+        results.extend(result for result in ranked if result[0] not in seen)
+        return results, complete
@@ -0,0 +1,109 @@
+import http.client
+import json
+import urllib.error
+import urllib.request
+
+from utils.utils import PROJECT_ROOT
+
+SERVER_INFO_PATH = PROJECT_ROOT / "cache" / "server.json"
+CLIENT_TIMEOUT = 30.0
+HEALTH_TIMEOUT = 0.5
+
+
+class SearchClient:
+    # thin JSON client for a running search server; it only needs the
+    # standard library, so forwarding a query skips the model and index load
+    def __init__(self, host, port, timeout=CLIENT_TIMEOUT):
+        self.url = f"http://{host}:{port}"
+        self.timeout = timeout
+
+    def request(self, path, payload=None, timeout=None):
+        data = None if payload is None else json.dumps(payload).encode("utf-8")
+        request = urllib.request.Request(
+            self.url + path, data=data, headers={"Content-Type": "application/json"}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=timeout or self.timeout) as f:
+                return json.load(f)
+        except urllib.error.HTTPError as e:
+            raise ValueError(json.load(e).get("error", str(e))) from None
+        except (OSError, http.client.HTTPException) as e:
+            # refused, timed out or dropped mid-response
+            raise ConnectionError(f"Search server {self.url} failed: {e}") from None
+
+    def health(self):
+        return self.request("/health", timeout=HEALTH_TIMEOUT)
+
+    def keyword(
+        self, query, limit=5, prune=False, proximity=False, where=None, cursor=None
+    ):
+        return self.request(
+            "/search/keyword",
+            {
+                "query": query,
+                "limit": limit,
+                "prune": prune,
+                "proximity": proximity,
+                "where": where,
+                "cursor": cursor,
+            },
+        )
+
+    def semantic(self, query, limit=5, rescore=None, cursor=None):
+        return self.request(
+            "/search/semantic",
+            {"query": query, "limit": limit, "rescore": rescore, "cursor": cursor},
+        )
+
+    def chunked(
+        self,
+        query,
+        limit=5,
+        nprobe=None,
+        rescore=None,
+        ids=None,
+        where=None,
+        cursor=None,
+    ):
+        return self.request(
+            "/search/chunked",
+            {
+                "query": query,
+                "limit": limit,
+                "nprobe": nprobe,
+                "rescore": rescore,
+                "ids": ids,
+                "where": where,
+                "cursor": cursor,
+            },
+        )
+
+    def hybrid(self, query, method="weighted", limit=5, alpha=0.5, k=60, depth=100):
+        return self.request(
+            "/search/hybrid",
+            {
+                "query": query,
+                "method": method,
+                "limit": limit,
+                "alpha": alpha,
+                "k": k,
+                "depth": depth,
+            },
+        )
+
+
+def find_server(precision="float32"):
+    # returns a client when a server is up and serving the same precision,
+    # otherwise None so the caller searches locally
+    if not SERVER_INFO_PATH.exists():
+        return None
+    try:
+        with open(SERVER_INFO_PATH, "r") as f:
+            info = json.load(f)
+        client = SearchClient(info["host"], info["port"])
+        health = client.health()
+    except (OSError, ValueError, KeyError):
+        return None
+    if health.get("precision") != precision:
+        return None
+    return client
@@ -0,0 +1,211 @@
+import json
+import os
+import signal
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lib.batch_search import BATCH_MAX_SIZE, BatchingThread
+from lib.compaction import BackgroundCompactor
+from lib.hybrid_search import HYBRID_CANDIDATES, RRF_K, HybridSearch
+from lib.search_client import SERVER_INFO_PATH
+from lib.semantic_search import ChunkedSemanticSearch, SemanticSearch
+from utils.utils import load_movies
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+
+
+class SearchService:
+    # the index, caches and model are loaded once and shared by every
+    # request thread; the searchers take their own locks
+    def __init__(self, precision="float32", batch_wait=None, batch_size=BATCH_MAX_SIZE):
+        self.precision = precision
+        movies = load_movies()
+        self.semantic = SemanticSearch(precision=precision)
+        self.semantic.load_or_create_embeddings(movies)
+        self.chunked = ChunkedSemanticSearch(precision=precision)
+        self.chunked.load_or_create_chunk_embeddings(movies)
+        # keyword searches share the hybrid searcher's resident index
+        self.hybrid = HybridSearch(movies, semantic_search=self.chunked)
+        # concurrent chunked queries can be micro-batched; None searches
+        # each request on its own thread
+        self.batcher = None
+        if batch_wait is not None:
+            self.batcher = BatchingThread(self.chunked, batch_size, batch_wait)
+        # changes replayed from the update logs are folded into the saved
+        # stores in the background rather than on the next rebuild
+        self.compactors = [
+            BackgroundCompactor(self.chunked),
+            BackgroundCompactor(self.hybrid),
+        ]
+        for compactor in self.compactors:
+            compactor.start()
+
+    def close(self):
+        for compactor in self.compactors:
+            compactor.stop()
+        if self.batcher is not None:
+            self.batcher.stop()
+
+    def health(self):
+        return {"status": "ok", "pid": os.getpid(), "precision": self.precision}
+
+    def keyword(
+        self, query, limit=5, prune=False, proximity=False, where=None, cursor=None
+    ):
+        # cursor is the "cursor" of a previous response, for the next page
+        if prune and (proximity or where is not None or cursor is not None):
+            raise ValueError("prune cannot be combined with proximity, where or cursor")
+        self.hybrid.check_index()
+        index = self.hybrid.idx
+        stats = None
+        next_cursor = None
+        if prune:
+            results, stats = index.bm25_top_k(query, limit)
+        else:
+            results, next_cursor = index.bm25_page(
+                query, limit, cursor, proximity, where
+            )
+        with index.lock:
+            results = [
+                {
+                    "id": doc_id,
+                    "title": index.docmap[doc_id]["title"],
+                    "score": float(score),
+                }
+                for doc_id, score in results
+            ]
+        return {"results": results, "stats": stats, "cursor": next_cursor}
+
+    def semantic_search(self, query, limit=5, rescore=None, cursor=None):
+        results, next_cursor = self.semantic.search_page(query, limit, cursor, rescore)
+        for result in results:
+            result["score"] = float(result["score"])
+        return {"results": results, "cursor": next_cursor}
+
+    def chunked_search(
+        self,
+        query,
+        limit=5,
+        nprobe=None,
+        rescore=None,
+        ids=None,
+        where=None,
+        cursor=None,
+    ):
+        # ids and a boolean keyword query (where) restrict the movies ranked
+        self.hybrid.check_index()
+        doc_ids = ids
+        if where is not None:
+            matches = self.hybrid.idx.boolean_search(where)
+            doc_ids = matches if ids is None else set(ids).intersection(matches)
+        if (
+            self.batcher is not None
+            and nprobe is None
+            and rescore is None
+            and doc_ids is None
+            and cursor is None
+        ):
+            # first pages are batched; the next page is ranked on request.
+            # One result past the page tells whether there is a next page
+            results = self.batcher.search(query, limit + 1)
+            next_cursor = None
+            if len(results) > limit:
+                results = results[:limit]
+                next_cursor = self.chunked.page_cursor(query, limit)
+        else:
+            results, next_cursor = self.chunked.search_chunks_page(
+                query, limit, cursor, nprobe, rescore, doc_ids
+            )
+        for result in results:
+            result["score"] = float(result["score"])
+        return {"results": results, "cursor": next_cursor}
+
+    def hybrid_search(
+        self,
+        query,
+        method="weighted",
+        limit=5,
+        alpha=0.5,
+        k=RRF_K,
+        depth=HYBRID_CANDIDATES,
+    ):
+        if method == "rrf":
+            return {"results": self.hybrid.rrf_search(query, k, limit, depth)}
+        return {"results": self.hybrid.weighted_search(query, alpha, limit, depth)}
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    routes = {
+        "/search/keyword": "keyword",
+        "/search/semantic": "semantic_search",
+        "/search/chunked": "chunked_search",
+        "/search/hybrid": "hybrid_search",
+    }
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.__respond(200, self.server.service.health())
+        else:
+            self.__respond(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path not in self.routes:
+            self.__respond(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(length) or b"{}")
+            handler = getattr(self.server.service, self.routes[self.path])
+            self.__respond(200, handler(**params))
+        except (KeyError, TypeError, ValueError) as e:
+            self.__respond(400, {"error": str(e)})
+        except Exception as e:
+            # anything else is the server's fault, but the client still gets
+            # an answer rather than a dropped connection
+            self.__respond(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def __respond(self, status, body):
+        data = json.dumps(body, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SearchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service, host=SERVER_HOST, port=SERVER_PORT):
+        super().__init__((host, port), SearchRequestHandler)
+        self.service = service
+
+
+def serve(
+    host=SERVER_HOST,
+    port=SERVER_PORT,
+    precision="float32",
+    batch_wait=None,
+    batch_size=BATCH_MAX_SIZE,
+):
+    service = SearchService(precision, batch_wait, batch_size)
+    server = SearchServer(service, host, port)
+    host, port = server.server_address[:2]
+    # clients find the server through this file; it is removed on shutdown
+    SERVER_INFO_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(SERVER_INFO_PATH, "w") as f:
+        json.dump({"host": host, "port": port, "pid": os.getpid()}, f)
+    print(f"Serving searches on http://{host}:{port}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        SERVER_INFO_PATH.unlink(missing_ok=True)
@@ -1,10 +1,74 @@
 import json
 import re
+import threading
+import time
+from functools import cache
+from itertools import islice
+
 import numpy as np
 
+from lib.ann_index import IVFIndex
+from lib.cache_manifest import (
+    CACHE_PATH,
+    DIGEST_MODULUS,
+    MANIFEST_NAME,
+    CacheManifest,
+    corpus_digest,
+    corpus_hash,
+    digest_params,
+    document_digest,
+)
+from lib.compact_index import IndexArrays, save_array, write_arrays
+from lib.embedding_cache import (
+    EMBED_BATCH_SIZE,
+    EMBED_WORKERS,
+    EmbeddingCache,
+    embed_texts,
+)
+from lib.query_cache import QueryEmbeddingCache, normalize_query
+from lib.quantization import PRECISIONS, load_or_create_quantized, remove_quantized
+from lib.result_pages import ResultPages, encode_cursor, query_digest
+from lib.update_log import UpdateLog
+from lib.vectors import normalize_rows, top_k_indices
+from utils.utils import PROJECT_ROOT, get_data_file, clean_text, load_movies
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+CHUNK_SIZE = 4
+CHUNK_OVERLAP = 1
+NORM_CHECK_ROWS = 100
+CHUNK_METADATA_FIELDS = ("movie_id", "movie_idx", "chunk_idx", "total_chunks")
+QUERY_CACHE_PATH = PROJECT_ROOT / "cache" / "query_embeddings.npz"
+# a filtered search only scores the chunks of the movies that pass when
+# they are at most this share of the catalog; above it, scoring every chunk
+# in one product and dropping the rest costs less than gathering them
+PREFILTER_SELECTIVITY = 0.05
+
+
+@cache
+def get_model(model_name):
+    # each model is loaded once per process however many searchers use it.
+    # sentence_transformers (and torch) take seconds to import, so they are
+    # only imported once something has to be encoded
+    import transformers
+    from sentence_transformers import SentenceTransformer
+
+    transformers.logging.set_verbosity_error()
+    return SentenceTransformer(model_name)
 
-from utils.utils import PROJECT_ROOT, get_data_file, clean_text
-from sentence_transformers import SentenceTransformer
+
+@cache
+def get_query_cache():
+    return QueryEmbeddingCache()
+
+
+def load_persisted_query_cache():
+    # opt-in: queries cached by earlier runs are loaded, and save() on the
+    # returned cache writes them back
+    query_cache = get_query_cache()
+    query_cache.path = QUERY_CACHE_PATH
+    if QUERY_CACHE_PATH.exists():
+        query_cache.load()
+    return query_cache
 
 
 def verify_model():
@@ -90,20 +154,255 @@ def semantic_chunk(text, max_chunk_size, overlap):
     return final_chunks
 
 
+def ann_benchmark_command(queries=None, limit=5, nprobes=(1, 4, 8, 16), repeat=3):
+    movies = load_movies()
+    chunker = ChunkedSemanticSearch()
+    chunker.load_or_create_chunk_embeddings(movies)
+    chunker.load_or_create_ann_index()
+    if not queries:
+        queries = [movie["title"] for movie in islice(movies, 20)]
+    query_embeddings = [
+        normalize_rows(chunker.generate_embedding(query)) for query in queries
+    ]
+
+    def run(nprobe):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            results = [
+                chunker.search_chunk_embedding(embedding, limit, nprobe)
+                for embedding in query_embeddings
+            ]
+        elapsed = (time.perf_counter() - start) / (repeat * len(queries))
+        return results, elapsed * 1000
+
+    exact, exact_ms = run(None)
+    report = []
+    for nprobe in nprobes:
+        approximate, ann_ms = run(nprobe)
+        found = 0
+        for expected, actual in zip(exact, approximate):
+            found += len({i for i, _ in expected} & {i for i, _ in actual})
+        report.append(
+            {
+                "nprobe": nprobe,
+                "recall": found / max(1, sum(len(expected) for expected in exact)),
+                "exact_ms": exact_ms,
+                "ann_ms": ann_ms,
+            }
+        )
+    return report
+
+
+def load_embeddings(path):
+    # caches are memory-mapped, so worker processes share the page cache and
+    # opening one costs the same whatever its size
+    embeddings = np.load(path, mmap_mode="r")
+    norms = np.linalg.norm(embeddings[:NORM_CHECK_ROWS], axis=1)
+    if not np.allclose(norms, 1.0, atol=1e-3):
+        # caches written before rows were normalized are converted once
+        save_array(path, normalize_rows(embeddings))
+        embeddings = np.load(path, mmap_mode="r")
+    return embeddings
+
+
+def embedding_manifest(documents, model_name):
+    documents = list(documents)
+    return {
+        "corpus_hash": corpus_hash(documents),
+        "doc_count": len(documents),
+        "model": model_name,
+    }
+
+
+def chunk_manifest(documents, model_name):
+    # chunks are matched to movies by id, so the corpus hash is order-free
+    # and kept current as movies are added, updated and deleted
+    documents = {document["id"]: document for document in documents}.values()
+    return {
+        **digest_params(corpus_digest(documents), len(documents)),
+        "model": model_name,
+        "chunk_size": CHUNK_SIZE,
+        "overlap": CHUNK_OVERLAP,
+    }
+
+
+def chunk_metadata_rows(movie_id, movie_idx, total_chunks):
+    return {
+        "movie_id": np.full(total_chunks, movie_id, dtype=np.int64),
+        "movie_idx": np.full(total_chunks, movie_idx, dtype=np.int64),
+        "chunk_idx": np.arange(total_chunks, dtype=np.int64),
+        "total_chunks": np.full(total_chunks, total_chunks, dtype=np.int64),
+    }
+
+
+def concat_chunk_metadata(parts):
+    return {
+        name: np.concatenate(
+            [np.zeros(0, dtype=np.int64)] + [part[name] for part in parts]
+        )
+        for name in CHUNK_METADATA_FIELDS
+    }
+
+
+def grow_rows(array, capacity):
+    # a copy of array with room for capacity rows; the spare rows are zero
+    grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[: len(array)] = array
+    return grown
+
+
+def filter_groups(rows, starts, movies, doc_filter):
+    # the movie groups of ChunkedSemanticSearch.__group_rows whose movie
+    # passes the filter: a mask over rows, and the kept groups' starts/movies
+    lengths = np.diff(np.append(starts, len(rows)))
+    kept = doc_filter[movies]
+    row_mask = np.repeat(kept, lengths)
+    lengths = lengths[kept]
+    return row_mask, np.cumsum(lengths) - lengths, movies[kept]
+
+
+def format_chunk_results(documents, movie_scores):
+    final_results = []
+    for movie_idx, score in movie_scores:
+        document = documents[movie_idx]
+        final_results.append(
+            {
+                "id": document["id"],
+                "title": document["title"],
+                "document": document["description"][:100],
+                "score": round(score, 2),
+                "metadata": document or {},
+            }
+        )
+    return final_results
+
+
+def rescore_rows(embeddings, query_embedding, rows):
+    # rows are read in file order so a mapped cache is paged in sequentially
+    order = np.argsort(rows, kind="stable")
+    scores = np.empty(len(rows), dtype=np.float32)
+    scores[order] = embeddings[rows[order]] @ query_embedding
+    return scores
+
+
+def quantization_benchmark_command(
+    queries=None, limit=5, precisions=PRECISIONS, rescore=50, repeat=3
+):
+    movies = load_movies()
+    chunker = ChunkedSemanticSearch()
+    chunker.load_or_create_chunk_embeddings(movies)
+    if not queries:
+        queries = [movie["title"] for movie in islice(movies, 20)]
+    query_embeddings = [
+        normalize_rows(chunker.generate_embedding(query)) for query in queries
+    ]
+
+    def run(shortlist):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            results = [
+                chunker.search_chunk_embedding(embedding, limit, rescore=shortlist)
+                for embedding in query_embeddings
+            ]
+        elapsed = (time.perf_counter() - start) / (repeat * len(queries))
+        return results, elapsed * 1000
+
+    def recall(expected_results, actual_results):
+        found = 0
+        for expected, actual in zip(expected_results, actual_results):
+            found += len({i for i, _ in expected} & {i for i, _ in actual})
+        return found / max(1, sum(len(expected) for expected in expected_results))
+
+    exact, _ = run(None)
+    report = []
+    for precision in precisions:
+        chunker.use_precision(precision)
+        matrix = (
+            chunker.chunk_embeddings if chunker.quantized is None else chunker.quantized
+        )
+        compressed, compressed_ms = run(None)
+        rescored, rescored_ms = run(rescore)
+        report.append(
+            {
+                "precision": precision,
+                "bytes": matrix.nbytes,
+                "ms": compressed_ms,
+                "recall": recall(exact, compressed),
+                "rescored_ms": rescored_ms,
+                "rescored_recall": recall(exact, rescored),
+            }
+        )
+    return report
+
+
 class SemanticSearch:
-    def __init__(self, model_name="all-MiniLM-L6-v2"):
-        self.model = SentenceTransformer(model_name)
+    def __init__(
+        self,
+        model_name=MODEL_NAME,
+        precision="float32",
+        embed_batch_size=EMBED_BATCH_SIZE,
+        embed_workers=EMBED_WORKERS,
+        cache_path=CACHE_PATH,
+    ):
+        self.model_name = model_name
+        self.query_cache = get_query_cache()
+        # encoded texts are shared by every cache directory
+        self.embedding_cache = EmbeddingCache(CACHE_PATH / "embeddings", model_name)
+        self.embed_batch_size = embed_batch_size
+        self.embed_workers = embed_workers
         self.embeddings = None
         self.documents = None
         self.document_map = dict()
+        self.precision = precision
+        self.quantized = None
+        self.cache_path = cache_path
+        self.cache_manifest = CacheManifest(cache_path / MANIFEST_NAME)
+        self.movie_embed_path = cache_path / "movie_embeddings.npy"
+        # ranked lists that the cursors of search_page (search_chunks_page
+        # for chunks) resume
+        self.pages = ResultPages()
+        # bumped whenever the embeddings are built or loaded, which expires
+        # cursors
+        self.__version = 0
+
+    @property
+    def model(self):
+        # loaded on first use, so searches whose embeddings are all cached
+        # never load it
+        return get_model(self.model_name)
 
     def generate_embedding(self, text):
         if not text or not text.strip():
             raise ValueError("text required to generate embedding")
-        input = []
-        input.append(text)
-        embedding = self.model.encode(input)
-        return embedding[0]
+        return self.query_cache.get_or_compute(
+            self.model_name, text, lambda: self.model.encode([text])[0]
+        )
+
+    def generate_embeddings(self, texts):
+        # cached queries are reused; the rest are encoded in one call
+        for text in texts:
+            if not text or not text.strip():
+                raise ValueError("text required to generate embedding")
+        embeddings = [self.query_cache.get(self.model_name, text) for text in texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            encoded = self.model.encode(
+                [texts[i] for i in missing], batch_size=len(missing)
+            )
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = self.query_cache.put(
+                    self.model_name, texts[i], embedding
+                )
+        return np.stack(embeddings)
+
+    def encode_texts(self, texts):
+        return embed_texts(
+            self.model,
+            self.embedding_cache,
+            texts,
+            self.embed_batch_size,
+            self.embed_workers,
+        )
 
     def build_embeddings(self, documents):
         self.documents = documents
@@ -116,128 +415,698 @@ class SemanticSearch:
                 f"{self.document_map[doc_id]['title']}: {self.document_map[doc_id]['description']}"
             )
 
-        self.embeddings = self.model.encode(string_docs, show_progress_bar=False)
-        with open(PROJECT_ROOT / "cache" / "movie_embeddings.npy", "wb") as f:
-            np.save(f, self.embeddings)
+        self.embeddings = self.encode_texts(string_docs)
+        save_array(self.movie_embed_path, self.embeddings)
+        remove_quantized(self.movie_embed_path)
+        self.cache_manifest.record(
+            "movie_embeddings",
+            embedding_manifest(self.document_map.values(), self.model_name),
+            [self.movie_embed_path],
+        )
+        self.use_precision(self.precision)
         return self.embeddings
 
     def load_or_create_embeddings(self, documents):
+        # the cache is only used if it was built from these documents with
+        # this model; anything else is rebuilt
         self.documents = documents
         for doc in self.documents:
             self.document_map[doc["id"]] = doc
-        embed_path = PROJECT_ROOT / "cache" / "movie_embeddings.npy"
-        if embed_path.exists():
-            with open(embed_path, "rb") as f:
-                self.embeddings = np.load(f)
-            if len(self.embeddings) == len(documents):
-                return self.embeddings
+        params = embedding_manifest(self.document_map.values(), self.model_name)
+        if self.cache_manifest.check("movie_embeddings", params) is None:
+            self.embeddings = load_embeddings(self.movie_embed_path)
+            self.use_precision(self.precision)
+            return self.embeddings
         return self.build_embeddings(documents)
 
-    def search(self, query, limit):
+    def use_precision(self, precision):
+        self.precision = precision
+        self.quantized = load_or_create_quantized(
+            self.movie_embed_path, self.embeddings, precision
+        )
+        self.__version += 1
+
+    def search(self, query, limit, rescore=None):
+        return self.__format_results(self.__rank(query, limit, rescore))
+
+    def search_page(self, query, limit=5, cursor=None, rescore=None):
+        # a page of search results and the cursor of the next page (or
+        # None). The ranking is cached, so following pages are slices of it
+        # until the embeddings are reloaded, which expires the cursors.
+        key = [
+            "movies",
+            self.model_name,
+            self.precision,
+            normalize_query(query),
+            rescore,
+            self.__version,
+        ]
+        results, next_cursor = self.pages.page(
+            key, lambda depth: self.__rank(query, depth, rescore), limit, cursor
+        )
+        return self.__format_results(results), next_cursor
+
+    def __rank(self, query, limit, rescore):
+        # (document index, score) pairs, best first
         if self.embeddings is None:
             raise ValueError(
                 "No embeddings loaded. Call `load_or_create_embeddings` first."
             )
-        query_embedding = self.generate_embedding(query)
-        sim_score_docs = []
-        for i in range(len(self.embeddings)):
-            cos_similarilty = cosine_similarity(self.embeddings[i], query_embedding)
-            sim_score_docs.append((cos_similarilty, self.documents[i]))
-        sorted_docs = sorted(sim_score_docs, key=lambda t: t[0], reverse=True)
-        top_results = []
-        for i in range(limit):
-            top_results.append(
-                {
-                    "score": sorted_docs[i][0],
-                    "title": sorted_docs[i][1]["title"],
-                    "description": sorted_docs[i][1]["description"],
-                }
-            )
-        return top_results
+        query_embedding = normalize_rows(self.generate_embedding(query))
+        if self.quantized is None:
+            scores = self.embeddings @ query_embedding
+        else:
+            scores = self.quantized.scores(query_embedding)
+            if rescore:
+                # exact float32 scores for a shortlist of the best rows
+                shortlist = top_k_indices(scores, max(limit, rescore))
+                scores = np.full(len(scores), -np.inf, dtype=np.float32)
+                scores[shortlist] = rescore_rows(
+                    self.embeddings, query_embedding, shortlist
+                )
+        return [(i, scores[i]) for i in top_k_indices(scores, limit).tolist()]
+
+    def __format_results(self, ranked):
+        return [
+            {
+                "score": score,
+                "title": self.documents[i]["title"],
+                "description": self.documents[i]["description"],
+            }
+            for i, score in ranked
+        ]
 
 
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self, model_name="all-MiniLM-L6-v2") -> None:
-        super().__init__(model_name)
+    def __init__(
+        self,
+        model_name=MODEL_NAME,
+        precision="float32",
+        embed_batch_size=EMBED_BATCH_SIZE,
+        embed_workers=EMBED_WORKERS,
+        cache_path=CACHE_PATH,
+    ) -> None:
+        super().__init__(
+            model_name, precision, embed_batch_size, embed_workers, cache_path
+        )
         self.chunk_embeddings = None
         self.chunk_metadata = None
+        self.embed_path = cache_path / "chunk_embeddings.npy"
+        # parallel movie_id/movie_idx/chunk_idx/total_chunks arrays, one row
+        # per chunk embedding
+        self.meta_path = cache_path / "chunk_metadata"
+        # written by older versions; removed on the next save
+        self.legacy_meta_path = cache_path / "chunk_metadata.json"
+        # chunks added since the last build/compaction: their rows are appended
+        # to the delta file and each change is recorded in the updates log
+        self.delta_path = cache_path / "chunk_embeddings_delta.f32"
+        self.updates_path = cache_path / "chunk_updates.jsonl"
+        self.update_log = UpdateLog(self.updates_path)
+        # delta rows belonging to the log records read so far
+        self.__delta_rows = 0
+        # the saved rows this store was loaded from; another process that
+        # compacts or rebuilds the store replaces them
+        self.__saved_stat = None
+        # the documents the store was loaded for, to load it again with
+        self.__catalog = None
+        # the movies the saved chunks hold, once compaction has folded in
+        # changes that the catalog they were built from lacks
+        self.documents_path = cache_path / "chunk_documents.json"
+        self.ann_path = cache_path / "chunk_ivf.npz"
+        self.ann_index = None
+        self.lock = threading.RLock()
+        self.__doc_positions = dict()
+        # live chunk rows by movie id, and a tombstone mask over all rows
+        self.__doc_rows = dict()
+        self.__live = np.zeros(0, dtype=bool)
+        # rows added since the last save are appended to spare capacity in
+        # these copies of the saved rows (None until the first addition)
+        self.__row_buffer = None
+        self.__metadata_buffer = None
+        self.__updates = []
+        self.__segments = None
+        # corpus hash of document_map, and the params of the catalog the
+        # saved chunks were first built from
+        self.__digest = 0
+        self.__built_from = None
+        # bumped whenever the chunk rows change, which expires cursors
+        self.__version = 0
 
-    def build_chunk_embeddings(self, documents):
-        self.documents = documents
-        for doc in self.documents:
+    def __document_chunks(self, document):
+        if document["description"] is None:
+            return []
+        return semantic_chunk(document["description"], CHUNK_SIZE, CHUNK_OVERLAP)
+
+    def __index_documents(self, documents):
+        self.documents = list(documents)
+        self.document_map = dict()
+        self.__doc_positions = dict()
+        for i, doc in enumerate(self.documents):
             self.document_map[doc["id"]] = doc
+            self.__doc_positions[doc["id"]] = i
+        self.__digest = corpus_digest(self.document_map.values())
+
+    def __group_rows(self, rows):
+        # chunk rows grouped by movie, so a per-movie max is one reduceat
+        movie_idx = self.chunk_metadata["movie_idx"][rows]
+        order = np.argsort(movie_idx, kind="stable")
+        rows = rows[order]
+        sorted_movies = movie_idx[order]
+        starts = np.flatnonzero(
+            np.concatenate(([True], sorted_movies[1:] != sorted_movies[:-1]))
+        )
+        return rows, starts, sorted_movies[starts]
+
+    def __get_segments(self):
+        if self.__segments is None:
+            self.__segments = self.__group_rows(np.flatnonzero(self.__live_mask()))
+        return self.__segments
+
+    def __live_mask(self):
+        return self.__live[: len(self.chunk_embeddings)]
+
+    def __append_rows(self, embeddings, metadata):
+        # new rows go into the spare capacity after the last ones, which
+        # doubles when it runs out, so a change costs its own rows rather
+        # than a copy of the store; compact() folds them into the saved rows
+        start = len(self.chunk_embeddings)
+        end = start + len(embeddings)
+        if end == start:
+            return
+        if end > len(self.__live):
+            capacity = max(end, 2 * len(self.__live))
+            self.__row_buffer = grow_rows(self.chunk_embeddings, capacity)
+            self.__metadata_buffer = {
+                name: grow_rows(self.chunk_metadata[name], capacity)
+                for name in CHUNK_METADATA_FIELDS
+            }
+            self.__live = grow_rows(self.__live[:start], capacity)
+        self.__row_buffer[start:end] = embeddings
+        for name in CHUNK_METADATA_FIELDS:
+            self.__metadata_buffer[name][start:end] = metadata[name]
+        self.__live[start:end] = True
+        self.chunk_embeddings = self.__row_buffer[:end]
+        self.chunk_metadata = {
+            name: self.__metadata_buffer[name][:end] for name in CHUNK_METADATA_FIELDS
+        }
+
+    def __index_chunks(self):
+        # rows are matched to the catalog by movie id; rows whose movie is
+        # no longer in it are tombstoned
+        self.__segments = None
+        self.__version += 1
+        self.__updates = []
+        self.__row_buffer = None
+        self.__metadata_buffer = None
+        movie_ids = self.chunk_metadata["movie_id"]
+        doc_ids = np.array(list(self.__doc_positions), dtype=np.int64)
+        positions = np.array(list(self.__doc_positions.values()), dtype=np.int64)
+        order = np.argsort(doc_ids, kind="stable")
+        doc_ids = doc_ids[order]
+        positions = positions[order]
+        found = np.zeros(len(movie_ids), dtype=bool)
+        i = np.zeros(len(movie_ids), dtype=np.int64)
+        if len(doc_ids):
+            i = np.minimum(np.searchsorted(doc_ids, movie_ids), len(doc_ids) - 1)
+            found = doc_ids[i] == movie_ids
+        self.__live = found
+        self.__doc_rows = dict()
+        for row, movie_id in zip(
+            np.flatnonzero(found).tolist(), movie_ids[found].tolist()
+        ):
+            self.__doc_rows.setdefault(movie_id, []).append(row)
+        self.chunk_metadata["movie_idx"] = np.where(found, positions[i], -1)
+
+    def build_chunk_embeddings(self, documents):
+        self.__index_documents(documents)
         all_chunks = []
         chunk_meta = []
         for i in range(len(self.documents)):
-            if self.document_map[self.documents[i]["id"]]["description"] is None:
-                continue
-            chunks = semantic_chunk(
-                self.document_map[self.documents[i]["id"]]["description"], 4, 1
+            chunks = self.__document_chunks(self.documents[i])
+            all_chunks.extend(chunks)
+            chunk_meta.append(
+                chunk_metadata_rows(self.documents[i]["id"], i, len(chunks))
             )
-            for j in range(len(chunks)):
-                all_chunks.append(chunks[j])
-                chunk_meta.append(
-                    {"movie_idx": i, "chunk_idx": j, "total_chunks": len(chunks)}
-                )
 
-        self.chunk_embeddings = self.model.encode(all_chunks, show_progress_bar=False)
-        self.chunk_metadata = chunk_meta
-        with open(PROJECT_ROOT / "cache" / "chunk_embeddings.npy", "wb") as f:
-            np.save(f, self.chunk_embeddings)
-        with open(PROJECT_ROOT / "cache" / "chunk_metadata.json", "w") as f:
-            json.dump(chunk_meta, f)
+        self.chunk_embeddings = self.encode_texts(all_chunks)
+        self.chunk_metadata = concat_chunk_metadata(chunk_meta)
+        self.__built_from = None
+        self.__save_chunks()
+        self.__load_chunks()
 
         return self.chunk_embeddings
 
+    def __save_chunks(self, keep_log=False):
+        manifest = self.cache_manifest
+        params = chunk_manifest(self.document_map.values(), self.model_name)
+        content = digest_params(self.__digest, len(self.document_map))
+        if self.__built_from is None:
+            self.__built_from = content
+        self.embed_path.parent.mkdir(parents=True, exist_ok=True)
+        save_array(self.embed_path, self.chunk_embeddings)
+        write_arrays(
+            self.meta_path,
+            {name: self.chunk_metadata[name] for name in CHUNK_METADATA_FIELDS},
+        )
+        paths = [self.embed_path, self.meta_path]
+        if content != self.__built_from:
+            # loading with the catalog they were built from keeps the
+            # changes folded in, so the movies they hold are saved with them
+            with open(self.documents_path, "w") as f:
+                json.dump(list(self.document_map.values()), f)
+            paths.append(self.documents_path)
+        else:
+            self.documents_path.unlink(missing_ok=True)
+        self.legacy_meta_path.unlink(missing_ok=True)
+        self.__truncate_log(keep_log)
+        # saved rows are renumbered, so the IVF lists no longer apply
+        self.ann_path.unlink(missing_ok=True)
+        manifest.remove("chunk_ivf")
+        self.ann_index = None
+        remove_quantized(self.embed_path)
+        self.quantized = None
+        manifest.record(
+            "chunk_embeddings", {**params, "built_from": self.__built_from}, paths
+        )
+
+    def __truncate_log(self, keep):
+        # a rebuild replaces whatever the log changed. A compaction keeps
+        # the changes other processes logged since this store last read the
+        # log, and their rows, for the next replay
+        pending = self.update_log.read() if keep else []
+        rows = sum(update.get("rows", 0) for update in pending)
+        delta = self.__read_delta(rows)
+        if rows:
+            tmp_path = self.delta_path.with_name(self.delta_path.name + ".tmp")
+            delta.tofile(tmp_path)
+            tmp_path.replace(self.delta_path)
+        else:
+            self.delta_path.unlink(missing_ok=True)
+        self.update_log.rewrite(pending)
+        self.__delta_rows = 0
+
+    def __read_delta(self, rows):
+        # the next rows of the delta file after the ones already read; a log
+        # of deletes alone never wrote one
+        dim = self.chunk_embeddings.shape[1]
+        if rows == 0:
+            return np.zeros((0, dim), dtype=np.float32)
+        delta = np.fromfile(
+            self.delta_path,
+            dtype=np.float32,
+            count=rows * dim,
+            offset=self.__delta_rows * dim * np.dtype(np.float32).itemsize,
+        )
+        return delta.reshape(-1, dim)
+
+    def __load_chunks(self):
+        self.chunk_embeddings = load_embeddings(self.embed_path)
+        self.chunk_metadata = dict(IndexArrays(self.meta_path, CHUNK_METADATA_FIELDS))
+        self.__saved_stat = self.__stat_saved()
+        self.update_log.reset()
+        self.__delta_rows = 0
+        self.__index_chunks()
+        self.use_precision(self.precision)
+
+    def __stat_saved(self):
+        try:
+            st = self.embed_path.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def cache_check(self, documents, verify=False):
+        # None when the saved chunks can serve these documents, otherwise
+        # the reason they cannot; cache status reports the same
+        return self.cache_manifest.check_store(
+            "chunk_embeddings",
+            chunk_manifest(documents, self.model_name),
+            self.updates_path,
+            verify,
+        )
+
     def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
-        self.documents = documents
-        for doc in self.documents:
-            self.document_map[doc["id"]] = doc
+        # the saved chunks are used if they were built with this model and
+        # chunking from these documents, or hold them before or after the
+        # logged changes; anything else is rebuilt
+        documents = list(documents)
+        self.__catalog = documents
+        if self.cache_check(documents) is not None:
+            return self.build_chunk_embeddings(documents)
+        params = self.cache_manifest.get("chunk_embeddings")["params"]
+        self.__built_from = params.get("built_from")
+        if (
+            self.documents_path.exists()
+            and chunk_manifest(documents, self.model_name)["corpus_hash"]
+            != params["corpus_hash"]
+        ):
+            # not the movies the chunks hold; replaying the logged changes
+            # on those reaches the catalog if it is the one after them
+            with open(self.documents_path, "r") as f:
+                documents = json.load(f)
+        self.__index_documents(documents)
+        self.__load_chunks()
+        self.__replay_updates()
+        return self.chunk_embeddings
+
+    def check_updates(self):
+        # two stats per query. Changes other processes logged since this
+        # store last read the log are replayed; a store they compacted or
+        # rebuilt is loaded again
+        if self.__stat_saved() == self.__saved_stat and not self.update_log.changed():
+            return False
+        with self.lock:
+            if self.__stat_saved() != self.__saved_stat:
+                self.load_or_create_chunk_embeddings(self.__catalog)
+                # the IVF lists are loaded again for the new rows
+                self.ann_index = None
+            else:
+                self.__replay_updates()
+            return True
+
+    def __replay_updates(self):
+        # applies the changes logged since the log was last read, by this
+        # process or another one
+        updates = self.update_log.read()
+        rows = sum(update.get("rows", 0) for update in updates)
+        delta = self.__read_delta(rows)
+        self.__delta_rows += rows
+        next_row = 0
+        for update in updates:
+            rows = update.get("rows", 0)
+            try:
+                self.__apply_update(update, delta[next_row : next_row + rows])
+            except (KeyError, ValueError):
+                # the catalog passed in may already reflect this change
+                pass
+            next_row += rows
+        return len(updates)
+
+    def __apply_update(self, update, embeddings=None):
+        op = update["op"]
+        doc_id = update["id"] if op == "delete" else update["document"]["id"]
+        rows = self.__doc_rows.get(doc_id, [])
+        if op == "add" and rows:
+            raise ValueError(f"Document {doc_id} is already embedded")
+        if op == "delete" and not rows and doc_id not in self.document_map:
+            raise KeyError(doc_id)
+
+        if doc_id in self.document_map:
+            self.__digest -= document_digest(self.document_map[doc_id])
+
+        # deleted rows are only tombstoned; compact() drops them for good
+        self.__segments = None
+        self.__version += 1
+        self.__live[rows] = False
+        self.__doc_rows.pop(doc_id, None)
+
+        if op in ("add", "update"):
+            document = update["document"]
+            chunks = self.__document_chunks(document)
+            if embeddings is None:
+                embeddings = np.zeros(
+                    (0, self.chunk_embeddings.shape[1]), dtype=np.float32
+                )
+                if chunks:
+                    embeddings = self.encode_texts(chunks)
+
+            if doc_id in self.__doc_positions:
+                movie_idx = self.__doc_positions[doc_id]
+                self.documents[movie_idx] = document
+            else:
+                movie_idx = len(self.documents)
+                self.documents.append(document)
+                self.__doc_positions[doc_id] = movie_idx
+            self.document_map[doc_id] = document
+            self.__digest += document_digest(document)
+
+            start = len(self.chunk_embeddings)
+            self.__append_rows(
+                embeddings, chunk_metadata_rows(doc_id, movie_idx, len(chunks))
+            )
+            if chunks:
+                self.__doc_rows[doc_id] = list(range(start, start + len(chunks)))
+
+        if op == "delete":
+            self.document_map.pop(doc_id, None)
+
+        self.__digest %= DIGEST_MODULUS
+        self.__updates.append(update)
+        return embeddings
 
-        embed_path = PROJECT_ROOT / "cache" / "chunk_embeddings.npy"
-        meta_path = PROJECT_ROOT / "cache" / "chunk_metadata.json"
-        if embed_path.exists() and meta_path.exists():
-            with open(embed_path, "rb") as f:
-                self.chunk_embeddings = np.load(f)
-            with open(meta_path, "r") as f:
-                self.chunk_metadata = json.load(f)
-            return self.chunk_embeddings
-        return self.build_chunk_embeddings(documents)
-
-    def search_chunks(self, query: str, limit=10):
-        query_embedding = self.generate_embedding(query)
-        chunk_scores = []
-        for i in range(len(self.chunk_embeddings)):
-            cos_similarity = cosine_similarity(
-                query_embedding, self.chunk_embeddings[i]
+    def __record_update(self, update):
+        with self.lock:
+            # changes other processes logged first, so the log and the rows
+            # appended to the delta file stay in the same order
+            self.__replay_updates()
+            rows_before = len(self.chunk_embeddings)
+            embeddings = self.__apply_update(update)
+            update["rows"] = len(self.chunk_embeddings) - rows_before
+            # what the store holds once the log is replayed, for cache_check
+            update["manifest"] = digest_params(self.__digest, len(self.document_map))
+            self.updates_path.parent.mkdir(parents=True, exist_ok=True)
+            if embeddings is not None:
+                with open(self.delta_path, "ab") as f:
+                    embeddings.astype(np.float32).tofile(f)
+            if self.update_log.append(update):
+                self.__delta_rows += update["rows"]
+
+    def add_document(self, document):
+        self.__record_update({"op": "add", "document": document})
+
+    def update_document(self, document):
+        self.__record_update({"op": "update", "document": document})
+
+    def delete_document(self, doc_id):
+        self.__record_update({"op": "delete", "id": doc_id})
+
+    def pending_changes(self):
+        return len(self.__updates)
+
+    def compact(self):
+        # folds in the changes this store holds and those other processes
+        # logged since it last read the log
+        with self.lock:
+            if self.__stat_saved() != self.__saved_stat:
+                # another process compacted or rebuilt the store; saving
+                # this copy over it would drop that process's changes
+                return False
+            self.__replay_updates()
+            if not self.__updates and self.__live_mask().all():
+                return False
+            live = self.__live_mask()
+            self.chunk_embeddings = self.chunk_embeddings[live]
+            self.chunk_metadata = {
+                name: self.chunk_metadata[name][live] for name in CHUNK_METADATA_FIELDS
+            }
+            self.__save_chunks(keep_log=True)
+            self.__load_chunks()
+            self.__replay_updates()
+            return True
+
+    def use_precision(self, precision):
+        # the compressed copy covers the saved rows; rows added since the
+        # last save are few and stay float32
+        with self.lock:
+            self.precision = precision
+            saved_rows = len(self.chunk_embeddings) - sum(
+                update.get("rows", 0) for update in self.__updates
             )
-            chunk_scores.append(
-                {
-                    "chunk_idx": self.chunk_metadata[i]["chunk_idx"],
-                    "movie_idx": self.chunk_metadata[i]["movie_idx"],
-                    "score": cos_similarity,
-                }
+            self.quantized = load_or_create_quantized(
+                self.embed_path, self.chunk_embeddings[:saved_rows], precision
             )
-        movie_idx_scores = dict()
-        for score in chunk_scores:
+
+    def __chunk_scores(self, query_embedding):
+        # a query, or a matrix with one column per query
+        if self.quantized is None:
+            return self.chunk_embeddings @ query_embedding
+        return np.concatenate(
+            [
+                self.quantized.scores(query_embedding),
+                self.chunk_embeddings[len(self.quantized) :] @ query_embedding,
+            ]
+        )
+
+    def build_ann_index(self, n_lists=None):
+        with self.lock:
+            self.ann_index = IVFIndex().build(self.chunk_embeddings, n_lists)
+            self.ann_index.save(self.ann_path)
+            manifest = self.cache_manifest
+            manifest.record(
+                "chunk_ivf",
+                manifest.source_params(self.embed_path, n_lists=self.ann_index.n_lists),
+                [self.ann_path],
+            )
+            return self.ann_index
+
+    def load_or_create_ann_index(self, n_lists=None):
+        # the IVF lists cover the rows that existed when it was built; rows
+        # appended since then are scanned exactly until the next rebuild
+        with self.lock:
             if (
-                score["movie_idx"] not in movie_idx_scores
-                or score["score"] > movie_idx_scores[score["movie_idx"]]
+                n_lists is None
+                and self.cache_manifest.check_derived("chunk_ivf") is None
             ):
-                movie_idx_scores[score["movie_idx"]] = score["score"]
-        sorted_scores = sorted(
-            movie_idx_scores.items(), key=lambda x: x[1], reverse=True
-        )
-        limit_scores = sorted_scores[:limit]
-        final_results = []
-        for score in limit_scores:
-            final_results.append(
-                {
-                    "id": self.documents[score[0]]["id"],
-                    "title": self.documents[score[0]]["title"],
-                    "document": self.documents[score[0]]["description"][:100],
-                    "score": round(score[1], 2),
-                    "metadata": self.documents[score[0]] or {},
-                }
+                self.ann_index = IVFIndex.load(self.ann_path)
+                if self.ann_index.num_rows <= len(self.chunk_embeddings):
+                    return self.ann_index
+            return self.build_ann_index(n_lists)
+
+    def __ann_candidates(self, query_embedding, nprobe):
+        if self.ann_index is None:
+            self.load_or_create_ann_index()
+        rows = np.concatenate(
+            [
+                self.ann_index.candidates(query_embedding, nprobe),
+                np.arange(
+                    self.ann_index.num_rows, len(self.chunk_embeddings), dtype=np.int64
+                ),
+            ]
+        )
+        return self.__group_rows(rows[self.__live_mask()[rows]])
+
+    def document_filter(self, doc_ids):
+        # a bitmap over self.documents, i.e. by movie_idx, of the given ids;
+        # ids that are not in the catalog are ignored
+        with self.lock:
+            doc_filter = np.zeros(len(self.documents), dtype=bool)
+            doc_filter[
+                [
+                    self.__doc_positions[doc_id]
+                    for doc_id in doc_ids
+                    if doc_id in self.__doc_positions
+                ]
+            ] = True
+            return doc_filter
+
+    def search_chunk_embedding(
+        self, query_embedding, limit=10, nprobe=None, rescore=None, doc_filter=None
+    ):
+        # returns (movie_idx, score) pairs; nprobe switches to the IVF index
+        # and rescore re-ranks that many movies with exact float32 scores.
+        # Only movies set in doc_filter (see document_filter) are ranked:
+        # when few pass, just their chunks are scored, exactly and without
+        # the IVF index; otherwise all are scored and the rest dropped.
+        with self.lock:
+            prefilter = doc_filter is not None and (
+                np.count_nonzero(doc_filter) <= PREFILTER_SELECTIVITY * len(doc_filter)
             )
-        return final_results
+            if nprobe is None or prefilter:
+                rows, starts, movies = self.__get_segments()
+            else:
+                rows, starts, movies = self.__ann_candidates(query_embedding, nprobe)
+            if doc_filter is not None:
+                row_mask, starts, movies = filter_groups(
+                    rows, starts, movies, doc_filter
+                )
+                rows = rows[row_mask]
+            if len(movies) == 0:
+                return []
+            if prefilter:
+                chunk_scores = rescore_rows(
+                    self.chunk_embeddings, query_embedding, rows
+                )
+            elif nprobe is None:
+                chunk_scores = self.__chunk_scores(query_embedding)[rows]
+            else:
+                chunk_scores = self.chunk_embeddings[rows] @ query_embedding
+            movie_scores = np.maximum.reduceat(chunk_scores, starts)
+            if (
+                rescore
+                and nprobe is None
+                and not prefilter
+                and self.quantized is not None
+            ):
+                shortlist = np.sort(top_k_indices(movie_scores, max(limit, rescore)))
+                ends = np.append(starts[1:], len(rows))
+                shortlist_rows = [rows[starts[i] : ends[i]] for i in shortlist]
+                exact_scores = rescore_rows(
+                    self.chunk_embeddings,
+                    query_embedding,
+                    np.concatenate(shortlist_rows),
+                )
+                lengths = [len(movie_rows) for movie_rows in shortlist_rows]
+                movie_scores = np.maximum.reduceat(
+                    exact_scores, np.cumsum([0] + lengths[:-1])
+                )
+                movies = movies[shortlist]
+        return [
+            (int(movies[i]), movie_scores[i])
+            for i in top_k_indices(movie_scores, limit)
+        ]
+
+    def search_chunks(
+        self, query: str, limit=10, nprobe=None, rescore=None, doc_ids=None
+    ):
+        # doc_ids restricts the results to those movies
+        doc_filter = None
+        if doc_ids is not None:
+            doc_filter = self.document_filter(doc_ids)
+        query_embedding = normalize_rows(self.generate_embedding(query))
+        return self.__format_results(
+            self.search_chunk_embedding(
+                query_embedding, limit, nprobe, rescore, doc_filter
+            )
+        )
+
+    def __page_key(self, query, nprobe, rescore, doc_ids):
+        if doc_ids is not None:
+            doc_ids = sorted(doc_ids)
+        with self.lock:
+            state = [self.__version, len(self.documents), len(self.chunk_embeddings)]
+        return [
+            "chunks",
+            self.model_name,
+            self.precision,
+            normalize_query(query),
+            nprobe,
+            rescore,
+            doc_ids,
+            state,
+        ]
+
+    def search_chunks_page(
+        self, query, limit=10, cursor=None, nprobe=None, rescore=None, doc_ids=None
+    ):
+        # a page of search_chunks results and the cursor of the next page (or
+        # None). The ranking is cached, so following pages are slices of it
+        # until the chunks change, which expires the cursors.
+        def rank(depth):
+            doc_filter = None
+            if doc_ids is not None:
+                doc_filter = self.document_filter(doc_ids)
+            query_embedding = normalize_rows(self.generate_embedding(query))
+            return self.search_chunk_embedding(
+                query_embedding, depth, nprobe, rescore, doc_filter
+            )
+
+        movie_scores, next_cursor = self.pages.page(
+            self.__page_key(query, nprobe, rescore, doc_ids), rank, limit, cursor
+        )
+        return self.__format_results(movie_scores), next_cursor
+
+    def page_cursor(self, query, offset, nprobe=None, rescore=None, doc_ids=None):
+        # the cursor of the results after the first offset, for a first page
+        # ranked some other way, e.g. by a batched search
+        key = self.__page_key(query, nprobe, rescore, doc_ids)
+        return encode_cursor(query_digest(key), offset)
+
+    def search_chunks_batch(self, queries, limit=10):
+        # many queries at once: one encode call and one matrix-matrix product
+        query_embeddings = normalize_rows(self.generate_embeddings(queries))
+        with self.lock:
+            rows, starts, movies = self.__get_segments()
+            if len(rows) == 0:
+                return [[] for _ in queries]
+            chunk_scores = self.__chunk_scores(query_embeddings.T)
+            movie_scores = np.maximum.reduceat(chunk_scores[rows], starts, axis=0)
+        return [
+            self.__format_results(
+                (int(movies[i]), movie_scores[i, j])
+                for i in top_k_indices(movie_scores[:, j], limit)
+            )
+            for j in range(len(queries))
+        ]
+
+    def __format_results(self, movie_scores):
+        return format_chunk_results(self.documents, movie_scores)
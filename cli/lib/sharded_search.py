@@ -0,0 +1,233 @@
+import heapq
+import multiprocessing
+import threading
+import time
+from itertools import islice
+
+from lib.cache_manifest import CACHE_PATH
+from lib.index_search import InvertedIndex
+from lib.semantic_search import ChunkedSemanticSearch, format_chunk_results
+from lib.vectors import normalize_rows
+from utils.utils import load_movies
+
+SHARD_CACHE_PATH = CACHE_PATH / "shards"
+DEFAULT_SHARDS = 2
+
+
+def shard_ranges(num_docs, num_shards):
+    # contiguous [start, end) slices of the catalog: shard order is row
+    # order, so ties between shards break the way a single index breaks them
+    num_shards = max(1, min(num_shards, num_docs))
+    bounds = [num_docs * i // num_shards for i in range(num_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def shard_cache_path(shard, num_shards):
+    return SHARD_CACHE_PATH / f"{shard + 1}-of-{num_shards}"
+
+
+def merge_term_stats(shard_stats):
+    # BM25 statistics of the whole collection from each shard's share
+    doc_freqs = dict()
+    for stats in shard_stats:
+        for term, doc_freq in stats["doc_freqs"].items():
+            doc_freqs[term] = doc_freqs.get(term, 0) + doc_freq
+    return {
+        "total_docs": sum(stats["total_docs"] for stats in shard_stats),
+        "total_length": sum(stats["total_length"] for stats in shard_stats),
+        "doc_freqs": doc_freqs,
+    }
+
+
+def merge_top_k(shard_results, limit):
+    # k-way merge of per-shard (key, score) lists, each best first; equal
+    # scores keep shard order
+    merged = heapq.merge(*shard_results, key=lambda result: -result[1])
+    return list(islice(merged, limit))
+
+
+class SearchShard:
+    # one slice of the catalog with its own keyword index and chunk
+    # embeddings, cached under its own directory
+    def __init__(self, documents, cache_path, semantic=True):
+        self.index = InvertedIndex(cache_path=cache_path)
+        self.index.load_or_create(documents)
+        self.index.map_all()
+        self.chunked = None
+        if semantic:
+            self.chunked = ChunkedSemanticSearch(cache_path=cache_path)
+            self.chunked.load_or_create_chunk_embeddings(documents)
+
+    def term_stats(self, query):
+        return self.index.term_stats(query)
+
+    def bm25_search(self, query, limit, stats, prune=False):
+        if prune:
+            results, _ = self.index.bm25_top_k(query, limit, stats)
+            return results
+        return self.index.bm25_search(query, limit, stats)
+
+    def chunk_search(self, query, limit):
+        # (movie_idx within the shard, score) pairs, best first
+        query_embedding = normalize_rows(self.chunked.generate_embedding(query))
+        return self.chunked.search_chunk_embedding(query_embedding, limit)
+
+
+def serve_shard(connection, documents, cache_path, semantic, open_lock):
+    # worker process loop: (method, args) requests in, (ok, result) out,
+    # until None arrives. Shards share the embedding cache, so they are
+    # opened, and built if stale, one at a time.
+    try:
+        with open_lock:
+            shard = SearchShard(documents, cache_path, semantic)
+    except Exception as e:
+        connection.send((False, e))
+        return
+    connection.send((True, None))
+    while (request := connection.recv()) is not None:
+        method, args = request
+        try:
+            connection.send((True, getattr(shard, method)(*args)))
+        except Exception as e:
+            connection.send((False, e))
+
+
+class ShardedSearch:
+    # the catalog split into contiguous shards, each served by a worker
+    # process. A query is broadcast to every shard and the local top-k
+    # lists are merged; BM25 runs in two rounds, the first gathering the
+    # collection-wide N, avgdl and document frequencies, so the results
+    # equal those of a single index over the whole catalog.
+    def __init__(self, documents, num_shards=DEFAULT_SHARDS, semantic=True):
+        self.documents = documents
+        self.semantic = semantic
+        self.ranges = shard_ranges(len(documents), num_shards)
+        self.lock = threading.Lock()
+        self.__connections = []
+        self.__processes = []
+
+    def start(self):
+        open_lock = multiprocessing.Lock()
+        for shard, (start, end) in enumerate(self.ranges):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=serve_shard,
+                args=(
+                    worker_connection,
+                    self.documents[start:end],
+                    shard_cache_path(shard, len(self.ranges)),
+                    self.semantic,
+                    open_lock,
+                ),
+                daemon=True,
+            )
+            process.start()
+            worker_connection.close()
+            self.__connections.append(connection)
+            self.__processes.append(process)
+        try:
+            self.__gather()
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def close(self):
+        for connection in self.__connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.__processes:
+            process.join()
+        for connection in self.__connections:
+            connection.close()
+        self.__connections = []
+        self.__processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __gather(self):
+        # every reply is read before an error is raised, so the pipes stay
+        # in step for the next request
+        replies = [connection.recv() for connection in self.__connections]
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for _, result in replies]
+
+    def __scatter(self, method, *args):
+        with self.lock:
+            for connection in self.__connections:
+                connection.send((method, args))
+            return self.__gather()
+
+    def bm25_search(self, query, limit=5, prune=False):
+        # (doc_id, score) pairs, as InvertedIndex.bm25_search returns them
+        stats = merge_term_stats(self.__scatter("term_stats", query))
+        shard_results = self.__scatter("bm25_search", query, limit, stats, prune)
+        return merge_top_k(shard_results, limit)
+
+    def search_chunks(self, query, limit=10):
+        shard_results = [
+            [(start + movie_idx, score) for movie_idx, score in results]
+            for (start, _), results in zip(
+                self.ranges, self.__scatter("chunk_search", query, limit)
+            )
+        ]
+        return format_chunk_results(self.documents, merge_top_k(shard_results, limit))
+
+
+def shard_benchmark_command(
+    queries=None, num_shards=DEFAULT_SHARDS, limit=5, repeat=3, semantic=True
+):
+    # average latency of a single-process search against the sharded one,
+    # and whether both return the same results
+    movies = load_movies()
+    if not queries:
+        queries = [movie["title"] for movie in islice(movies, 20)]
+    index = InvertedIndex()
+    index.load_or_create(movies)
+    index.map_all()
+    searches = {
+        "bm25": (
+            lambda query: index.bm25_search(query, limit),
+            lambda sharded, query: sharded.bm25_search(query, limit),
+        ),
+        "bm25_prune": (
+            lambda query: index.bm25_top_k(query, limit)[0],
+            lambda sharded, query: sharded.bm25_search(query, limit, prune=True),
+        ),
+    }
+    if semantic:
+        chunked = ChunkedSemanticSearch()
+        chunked.load_or_create_chunk_embeddings(movies)
+        searches["chunks"] = (
+            lambda query: chunked.search_chunks(query, limit),
+            lambda sharded, query: sharded.search_chunks(query, limit),
+        )
+
+    def run(search):
+        results = []
+        start = time.perf_counter()
+        for _ in range(repeat):
+            results = [search(query) for query in queries]
+        return results, (time.perf_counter() - start) * 1000 / (repeat * len(queries))
+
+    report = dict()
+    with ShardedSearch(movies, num_shards, semantic) as sharded:
+        for name, (single_search, sharded_search) in searches.items():
+            single_results, single_ms = run(single_search)
+            sharded_results, sharded_ms = run(
+                lambda query: sharded_search(sharded, query)
+            )
+            report[name] = {
+                "single_ms": single_ms,
+                "sharded_ms": sharded_ms,
+                "match": single_results == sharded_results,
+            }
+    return report
@@ -0,0 +1,79 @@
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from utils.utils import PROJECT_ROOT
+
+CLI_PATH = PROJECT_ROOT / "cli"
+STARTUP_BUDGET_MS = 1000
+SAMPLE_TEXT = "A dragon guards the castle. The queen returns at dawn!"
+# commands that should never load the embedding model
+STARTUP_COMMANDS = (
+    ("keyword_search_cli.py", "--help"),
+    ("keyword_search_cli.py", "bm25search", "dragon castle", "--local"),
+    ("semantic_search_cli.py", "chunk", SAMPLE_TEXT),
+    ("semantic_search_cli.py", "semantic_chunk", SAMPLE_TEXT),
+    ("hybrid_search_cli.py", "normalize", "0.5", "2.3", "1.2"),
+    ("cache_cli.py", "--help"),
+)
+# "import time: <self us> | <cumulative us> | <indent><module>"
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
+
+
+def run_command(command, importtime=False):
+    # wall time in ms of one CLI run in a fresh interpreter, and the run
+    args = [sys.executable]
+    if importtime:
+        args += ["-X", "importtime"]
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [*args, *command], cwd=CLI_PATH, capture_output=True, text=True
+    )
+    return (time.perf_counter() - start) * 1000, completed
+
+
+def parse_importtime(stderr):
+    # total ms spent importing, and the top-level imports by cumulative ms
+    total_us = 0
+    top_level = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, module = match.groups()
+        total_us += int(self_us)
+        if len(indent) == 1:
+            top_level.append((module, int(cumulative_us) / 1000))
+    top_level.sort(key=lambda item: item[1], reverse=True)
+    return total_us / 1000, top_level
+
+
+def startup_benchmark_command(
+    commands=STARTUP_COMMANDS, repeat=3, budget_ms=STARTUP_BUDGET_MS, top=3
+):
+    # median wall time per command over repeat runs, plus one -X importtime
+    # run to show where the import time goes
+    report = []
+    for command in commands:
+        wall_times = []
+        returncode = 0
+        for _ in range(repeat):
+            wall_ms, completed = run_command(command)
+            wall_times.append(wall_ms)
+            returncode = returncode or completed.returncode
+        _, completed = run_command(command, importtime=True)
+        import_ms, top_level = parse_importtime(completed.stderr)
+        wall_ms = statistics.median(wall_times)
+        report.append(
+            {
+                "command": " ".join(command),
+                "wall_ms": wall_ms,
+                "import_ms": import_ms,
+                "slowest": top_level[:top],
+                "returncode": returncode,
+                "over_budget": wall_ms > budget_ms,
+            }
+        )
+    return report
@@ -0,0 +1,86 @@
+import json
+import os
+
+
+def file_stat(st):
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class UpdateLog:
+    # a store's append-only change log, which other processes (the add and
+    # delete CLIs) append to as well. read() returns the records written
+    # since the last read, whoever wrote them, so a process knows which
+    # changes it has applied and keeps the rest when it rewrites the log.
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.__file_id = None
+        # the log's stat when it was last read or appended to
+        self.__seen = None
+
+    def reset(self):
+        # the next read starts from the first record
+        self.offset = 0
+        self.__file_id = None
+        self.__seen = None
+
+    def changed(self):
+        # a stat; True when records may have been written since the last
+        # read, or the log was rewritten or removed
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return self.__seen is not None
+        return file_stat(st) != self.__seen
+
+    def read(self):
+        try:
+            with open(self.path, "rb") as f:
+                st = os.fstat(f.fileno())
+                file_id = (st.st_dev, st.st_ino)
+                if file_id != self.__file_id or st.st_size < self.offset:
+                    self.offset = 0
+                    self.__file_id = file_id
+                f.seek(self.offset)
+                data = f.read()
+                self.__seen = file_stat(os.fstat(f.fileno()))
+        except FileNotFoundError:
+            self.reset()
+            return []
+        # a record still being written is read once its line is complete
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        return [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+
+    def append(self, record):
+        # True when the record counts as read, False when it will be read
+        # back because records it has not read came before it
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "ab") as f:
+            st = os.fstat(f.fileno())
+            caught_up = (st.st_dev, st.st_ino) == self.__file_id and (
+                st.st_size == self.offset
+            )
+            if self.__file_id is None and st.st_size == 0:
+                caught_up = True
+                self.__file_id = (st.st_dev, st.st_ino)
+            f.write((json.dumps(record) + "\n").encode("utf-8"))
+            if caught_up:
+                self.offset = f.tell()
+        if caught_up:
+            self.__seen = file_stat(self.path.stat())
+        return caught_up
+
+    def rewrite(self, records):
+        # replaces the log with these records, the changes a compaction did
+        # not fold in; the next read returns them again
+        records = list(records)
+        if not records:
+            self.path.unlink(missing_ok=True)
+        else:
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp_path, "w") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+            os.replace(tmp_path, self.path)
+        self.reset()
@@ -0,0 +1,20 @@
+import numpy as np
+
+
+def normalize_rows(matrix):
+    # unit-length float32 rows turn cosine similarity into a dot product
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+def top_k_indices(scores, k):
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+    # everything tied with the k-th score is kept so ties resolve by index
+    candidates = np.flatnonzero(scores >= kth_score)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order[:k]]
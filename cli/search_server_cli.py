@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from lib.batch_search import BATCH_MAX_SIZE, BATCH_MAX_WAIT
+from lib.quantization import PRECISIONS
+from lib.search_client import find_server
+from lib.search_server import SERVER_HOST, SERVER_PORT, serve
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search Server CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="load the index and models once and serve queries"
+    )
+    serve_parser.add_argument(
+        "--host", type=str, default=SERVER_HOST, help="address to listen on"
+    )
+    serve_parser.add_argument(
+        "--port", type=int, default=SERVER_PORT, help="port to listen on, 0 for any"
+    )
+    serve_parser.add_argument(
+        "--precision", choices=PRECISIONS, default="float32", help="embedding storage"
+    )
+    serve_parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="micro-batch concurrent chunked semantic queries",
+    )
+    serve_parser.add_argument(
+        "--batch-size", type=int, default=BATCH_MAX_SIZE, help="queries per batch"
+    )
+    serve_parser.add_argument(
+        "--batch-wait-ms",
+        type=float,
+        default=BATCH_MAX_WAIT * 1000,
+        help="how long a batch waits for more queries",
+    )
+
+    status_parser = subparsers.add_parser("status", help="check for a running server")
+    status_parser.add_argument(
+        "--precision", choices=PRECISIONS, default="float32", help="embedding storage"
+    )
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "serve":
+            serve(
+                args.host,
+                args.port,
+                args.precision,
+                args.batch_wait_ms / 1000 if args.batch else None,
+                args.batch_size,
+            )
+        case "status":
+            client = find_server(args.precision)
+            if client is None:
+                print("No search server running")
+            else:
+                try:
+                    health = client.health()
+                except (ValueError, ConnectionError) as e:
+                    print(e)
+                    return
+                print(f"Search server {client.url} (pid {health['pid']})")
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
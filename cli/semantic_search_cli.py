@@ -1,23 +1,29 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 
 from utils.utils import load_movies
+from lib.ann_index import ANN_NPROBE
+from lib.batch_search import BATCH_MAX_SIZE, BATCH_MAX_WAIT, batch_benchmark
+from lib.embedding_cache import EMBED_BATCH_SIZE, EMBED_WORKERS
+from lib.index_search import InvertedIndex
+from lib.quantization import PRECISIONS
+from lib.search_client import find_server
 from lib.semantic_search import (
     ChunkedSemanticSearch,
     SemanticSearch,
+    ann_benchmark_command,
+    quantization_benchmark_command,
     embed_query_text,
     embed_text,
+    load_persisted_query_cache,
     overlap_chunk,
     semantic_chunk,
     verify_embeddings,
     verify_model,
 )
 
-import transformers
-
-transformers.logging.set_verbosity_error()
-
 
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
@@ -38,6 +44,21 @@ def main():
     search_parser.add_argument(
         "--limit", type=int, default=5, help="number of results to return"
     )
+    search_parser.add_argument(
+        "--precision", choices=PRECISIONS, default="float32", help="embedding storage"
+    )
+    search_parser.add_argument(
+        "--rescore", type=int, default=None, help="rescore this many in float32"
+    )
+    search_parser.add_argument(
+        "--cursor", type=str, help="the next page cursor printed by an earlier search"
+    )
+    search_parser.add_argument(
+        "--query-cache", action="store_true", help="reuse query embeddings across runs"
+    )
+    search_parser.add_argument(
+        "--local", action="store_true", help="search here even if a server is running"
+    )
 
     chunk_parser = subparsers.add_parser("chunk", help="chunk input text")
     chunk_parser.add_argument("text", type=str, help="text to be chunked")
@@ -59,7 +80,20 @@ def main():
         "--overlap", type=int, default=0, help="specify overlap for chunking"
     )
 
-    subparsers.add_parser("embed_chunks", help="embed chunks from a provided text")
+    embed_chunks_parser = subparsers.add_parser(
+        "embed_chunks", help="embed chunks from a provided text"
+    )
+    embed_chunks_parser.add_argument(
+        "--batch-size", type=int, default=EMBED_BATCH_SIZE, help="chunks per batch"
+    )
+    embed_chunks_parser.add_argument(
+        "--workers", type=int, default=EMBED_WORKERS, help="batches encoded at once"
+    )
+    embed_chunks_parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="re-chunk the catalog; unchanged chunks come from the embedding cache",
+    )
 
     search_chunked_parser = subparsers.add_parser(
         "search_chunked", help="semantically search with chunking"
@@ -68,8 +102,128 @@ def main():
     search_chunked_parser.add_argument(
         "--limit", type=int, default=5, help="number of results to return"
     )
+    search_chunked_parser.add_argument(
+        "--ann", action="store_true", help="search the IVF index instead of every chunk"
+    )
+    search_chunked_parser.add_argument(
+        "--nprobe", type=int, default=ANN_NPROBE, help="IVF lists scanned per query"
+    )
+    search_chunked_parser.add_argument(
+        "--precision", choices=PRECISIONS, default="float32", help="embedding storage"
+    )
+    search_chunked_parser.add_argument(
+        "--rescore", type=int, default=None, help="rescore this many in float32"
+    )
+    search_chunked_parser.add_argument(
+        "--cursor", type=str, help="the next page cursor printed by an earlier search"
+    )
+    search_chunked_parser.add_argument(
+        "--ids", type=int, nargs="+", default=None, help="only rank these movies"
+    )
+    search_chunked_parser.add_argument(
+        "--where",
+        type=str,
+        default=None,
+        help="only rank movies matching a boolean keyword query",
+    )
+    search_chunked_parser.add_argument(
+        "--query-cache", action="store_true", help="reuse query embeddings across runs"
+    )
+    search_chunked_parser.add_argument(
+        "--local", action="store_true", help="search here even if a server is running"
+    )
+
+    build_ann_parser = subparsers.add_parser(
+        "build_ann", help="build the IVF index over the chunk embeddings"
+    )
+    build_ann_parser.add_argument(
+        "--lists", type=int, default=None, help="number of IVF lists"
+    )
+
+    ann_bench_parser = subparsers.add_parser(
+        "ann_bench", help="compare IVF search against exact chunk search"
+    )
+    ann_bench_parser.add_argument("queries", type=str, nargs="*", help="query texts")
+    ann_bench_parser.add_argument(
+        "--nprobe", type=int, nargs="+", default=[1, 4, 8, 16], help="nprobe values"
+    )
+    ann_bench_parser.add_argument(
+        "--limit", type=int, default=5, help="recall is measured at this many results"
+    )
+    ann_bench_parser.add_argument(
+        "--repeat", type=int, default=3, help="timed runs per query"
+    )
+
+    add_chunks_parser = subparsers.add_parser(
+        "add_chunks", help="embed the chunks of a new document"
+    )
+    add_chunks_parser.add_argument("document", type=str, help="JSON document")
+
+    update_chunks_parser = subparsers.add_parser(
+        "update_chunks", help="re-embed the chunks of a changed document"
+    )
+    update_chunks_parser.add_argument("document", type=str, help="JSON document")
+
+    delete_chunks_parser = subparsers.add_parser(
+        "delete_chunks", help="drop the chunks of a document"
+    )
+    delete_chunks_parser.add_argument("doc_id", type=int, help="document id")
+
+    subparsers.add_parser(
+        "compact_chunks", help="fold pending chunk changes into the cache"
+    )
+
+    quant_bench_parser = subparsers.add_parser(
+        "quant_bench", help="compare embedding storage precisions"
+    )
+    quant_bench_parser.add_argument("queries", type=str, nargs="*", help="query texts")
+    quant_bench_parser.add_argument(
+        "--precision",
+        choices=PRECISIONS,
+        nargs="+",
+        default=list(PRECISIONS),
+        help="precisions to compare",
+    )
+    quant_bench_parser.add_argument(
+        "--limit", type=int, default=5, help="recall is measured at this many results"
+    )
+    quant_bench_parser.add_argument(
+        "--rescore", type=int, default=50, help="shortlist rescored in float32"
+    )
+    quant_bench_parser.add_argument(
+        "--repeat", type=int, default=3, help="timed runs per query"
+    )
+
+    batch_bench_parser = subparsers.add_parser(
+        "batch_bench", help="compare one-at-a-time and micro-batched chunk search"
+    )
+    batch_bench_parser.add_argument(
+        "--queries", type=int, default=256, help="number of distinct queries"
+    )
+    batch_bench_parser.add_argument(
+        "--clients", type=int, default=64, help="concurrent callers"
+    )
+    batch_bench_parser.add_argument(
+        "--batch-size", type=int, default=BATCH_MAX_SIZE, help="queries per batch"
+    )
+    batch_bench_parser.add_argument(
+        "--wait-ms",
+        type=float,
+        default=BATCH_MAX_WAIT * 1000,
+        help="how long a batch waits for more queries",
+    )
+
+    query_cache_parser = subparsers.add_parser(
+        "query_cache", help="show or clear the saved query embeddings"
+    )
+    query_cache_parser.add_argument(
+        "--clear", action="store_true", help="drop every saved query embedding"
+    )
 
     args = parser.parse_args()
+    query_cache = None
+    if getattr(args, "query_cache", False):
+        query_cache = load_persisted_query_cache()
 
     match args.command:
         case "verify":
@@ -81,16 +235,38 @@ def main():
         case "embedquery":
             embed_query_text(args.query)
         case "search":
-            model = SemanticSearch()
-            movies = load_movies()
-            model.load_or_create_embeddings(movies)
-            results = model.search(args.query, args.limit)
+            client = None if args.local else find_server(args.precision)
+            if client is not None:
+                try:
+                    response = client.semantic(
+                        args.query, args.limit, args.rescore, args.cursor
+                    )
+                except (ValueError, ConnectionError) as e:
+                    print(e)
+                    return
+                results = response["results"]
+                next_cursor = response["cursor"]
+            else:
+                model = SemanticSearch(precision=args.precision)
+                movies = load_movies()
+                model.load_or_create_embeddings(movies)
+                try:
+                    results, next_cursor = model.search_page(
+                        args.query, args.limit, args.cursor, args.rescore
+                    )
+                except ValueError as e:
+                    print(e)
+                    return
             i = 1
             for result in results:
                 print(
                     f"{i}. {result['title']} (score: {result['score']})\n   {result['description']}"
                 )
                 i += 1
+            if next_cursor is not None:
+                print(f"\nNext page: --cursor {next_cursor}")
+            if query_cache is not None:
+                print_query_cache(query_cache)
 
         case "chunk":
             split_text = args.text.split()
@@ -113,26 +289,169 @@ def main():
 
         case "embed_chunks":
             movies = load_movies()
-            chunker = ChunkedSemanticSearch()
-            embeddings = chunker.load_or_create_chunk_embeddings(movies)
+            chunker = ChunkedSemanticSearch(
+                embed_batch_size=args.batch_size, embed_workers=args.workers
+            )
+            if args.rebuild:
+                embeddings = chunker.build_chunk_embeddings(movies)
+            else:
+                embeddings = chunker.load_or_create_chunk_embeddings(movies)
 
             print(f"Generated {len(embeddings)} chunked embeddings")
 
         case "search_chunked":
-            movies = load_movies()
-            chunker = ChunkedSemanticSearch()
-            embeddings = chunker.load_or_create_chunk_embeddings(movies)
-            results = chunker.search_chunks(args.query, args.limit)
+            nprobe = args.nprobe if args.ann else None
+            client = None if args.local else find_server(args.precision)
+            if client is not None:
+                try:
+                    response = client.chunked(
+                        args.query,
+                        args.limit,
+                        nprobe,
+                        args.rescore,
+                        args.ids,
+                        args.where,
+                        args.cursor,
+                    )
+                except (ValueError, ConnectionError) as e:
+                    print(e)
+                    return
+                results = response["results"]
+                next_cursor = response["cursor"]
+            else:
+                movies = load_movies()
+                doc_ids = args.ids
+                if args.where is not None:
+                    index = InvertedIndex()
+                    index.load_or_create(movies)
+                    try:
+                        matches = index.boolean_search(args.where)
+                    except ValueError as e:
+                        print(e)
+                        return
+                    if doc_ids is None:
+                        doc_ids = matches
+                    else:
+                        doc_ids = set(doc_ids).intersection(matches)
+                chunker = ChunkedSemanticSearch(precision=args.precision)
+                chunker.load_or_create_chunk_embeddings(movies)
+                try:
+                    results, next_cursor = chunker.search_chunks_page(
+                        args.query,
+                        args.limit,
+                        args.cursor,
+                        nprobe,
+                        args.rescore,
+                        doc_ids,
+                    )
+                except ValueError as e:
+                    print(e)
+                    return
 
             i = 1
             for result in results:
                 print(f"\n{i}. {result['title']} (score: {result['score']:.4f})")
                 print(f"    {result['document']}...")
                 i += 1
+            if next_cursor is not None:
+                print(f"\nNext page: --cursor {next_cursor}")
+            if query_cache is not None:
+                print_query_cache(query_cache)
+
+        case "build_ann":
+            movies = load_movies()
+            chunker = ChunkedSemanticSearch()
+            chunker.load_or_create_chunk_embeddings(movies)
+            ann_index = chunker.build_ann_index(args.lists)
+            print(
+                f"Built IVF index with {len(ann_index.centroids)} lists over {ann_index.num_rows} chunks"
+            )
+
+        case "ann_bench":
+            report = ann_benchmark_command(
+                args.queries, args.limit, args.nprobe, args.repeat
+            )
+            for row in report:
+                print(
+                    f"nprobe {row['nprobe']}: recall@{args.limit} {row['recall']:.3f}, "
+                    f"exact {row['exact_ms']:.2f}ms, ann {row['ann_ms']:.2f}ms"
+                )
+
+        case "quant_bench":
+            report = quantization_benchmark_command(
+                args.queries, args.limit, args.precision, args.rescore, args.repeat
+            )
+            for row in report:
+                print(
+                    f"{row['precision']:>8}: {row['bytes'] / 1e6:.1f}MB, "
+                    f"{row['ms']:.2f}ms recall@{args.limit} {row['recall']:.3f}, "
+                    f"rescored {row['rescored_ms']:.2f}ms "
+                    f"recall@{args.limit} {row['rescored_recall']:.3f}"
+                )
+
+        case "add_chunks" | "update_chunks" | "delete_chunks":
+            movies = load_movies()
+            chunker = ChunkedSemanticSearch()
+            chunker.load_or_create_chunk_embeddings(movies)
+            try:
+                if args.command == "add_chunks":
+                    chunker.add_document(json.loads(args.document))
+                elif args.command == "update_chunks":
+                    chunker.update_document(json.loads(args.document))
+                else:
+                    chunker.delete_document(args.doc_id)
+            except (KeyError, ValueError) as e:
+                print(f"Could not apply {args.command}: {e}")
+                return
+            print(f"{chunker.pending_changes()} pending chunk changes")
+
+        case "compact_chunks":
+            movies = load_movies()
+            chunker = ChunkedSemanticSearch()
+            chunker.load_or_create_chunk_embeddings(movies)
+            if chunker.compact():
+                print(f"Compacted chunk cache to {len(chunker.chunk_embeddings)} rows")
+            else:
+                print("Nothing to compact")
+
+        case "batch_bench":
+            movies = load_movies()
+            chunker = ChunkedSemanticSearch()
+            chunker.load_or_create_chunk_embeddings(movies)
+            queries = [movie["title"] for movie in movies[: args.queries]]
+            bench = batch_benchmark(
+                chunker,
+                queries,
+                args.clients,
+                args.batch_size,
+                args.wait_ms / 1000,
+            )
+            print(f"sequential: {bench['sequential_qps']:8.1f} queries/sec")
+            print(
+                f"batched:    {bench['batched_qps']:8.1f} queries/sec "
+                f"in {bench['batches']} batches"
+            )
+            print(f"identical results: {bench['match']}")
+
+        case "query_cache":
+            query_cache = load_persisted_query_cache()
+            if args.clear:
+                query_cache.clear()
+                query_cache.save()
+            print(f"{len(query_cache)} saved query embeddings")
 
         case _:
             parser.print_help()
 
 
+def print_query_cache(query_cache):
+    query_cache.save()
+    stats = query_cache.stats()
+    print(
+        f"\nQuery cache: {stats['hits']} hits, {stats['misses']} misses, "
+        f"{stats['size']} saved"
+    )
+
+
 if __name__ == "__main__":
     main()
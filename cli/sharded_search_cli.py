@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from lib.sharded_search import DEFAULT_SHARDS, ShardedSearch, shard_benchmark_command
+from utils.utils import load_movies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Sharded Search CLI")
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=DEFAULT_SHARDS,
+        help="number of worker processes the catalog is split across",
+    )
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    bm25search_parser = subparsers.add_parser(
+        "bm25search", help="Search every shard using BM25"
+    )
+    bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument(
+        "--limit", type=int, default=5, help="number of results"
+    )
+    bm25search_parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="read only the postings that can reach the top results (MaxScore);"
+        " fewer postings, but slower than the default vectorized scorer",
+    )
+
+    search_chunked_parser = subparsers.add_parser(
+        "search_chunked", help="Search every shard's chunk embeddings"
+    )
+    search_chunked_parser.add_argument("query", type=str, help="Search query")
+    search_chunked_parser.add_argument(
+        "--limit", type=int, default=5, help="number of results"
+    )
+
+    bench_parser = subparsers.add_parser(
+        "bench", help="Compare sharded search against a single process"
+    )
+    bench_parser.add_argument(
+        "queries", type=str, nargs="*", help="Queries to benchmark"
+    )
+    bench_parser.add_argument(
+        "--limit", type=int, default=5, help="number of results per query"
+    )
+    bench_parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per query to average over"
+    )
+    bench_parser.add_argument(
+        "--keyword-only",
+        action="store_true",
+        help="skip semantic search, so no model is loaded",
+    )
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "bm25search":
+            movies = load_movies()
+            titles = {movie["id"]: movie["title"] for movie in movies}
+            with ShardedSearch(movies, args.shards, semantic=False) as sharded:
+                results = sharded.bm25_search(args.query, args.limit, args.prune)
+            for i, (doc_id, score) in enumerate(results, 1):
+                print(f"{i}. ({doc_id}) {titles[doc_id]} - Score: {score:.2f}")
+
+        case "search_chunked":
+            with ShardedSearch(load_movies(), args.shards) as sharded:
+                results = sharded.search_chunks(args.query, args.limit)
+            for i, result in enumerate(results, 1):
+                print(f"\n{i}. {result['title']} (score: {result['score']:.4f})")
+                print(f"    {result['document']}...")
+
+        case "bench":
+            report = shard_benchmark_command(
+                args.queries,
+                args.shards,
+                args.limit,
+                args.repeat,
+                semantic=not args.keyword_only,
+            )
+            for name, result in report.items():
+                print(
+                    f"{name:<11} single: {result['single_ms']:8.2f}ms"
+                    f"  {args.shards} shards: {result['sharded_ms']:8.2f}ms"
+                    f"  match: {result['match']}"
+                )
+
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
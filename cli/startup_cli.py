@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+from lib.startup_benchmark import (
+    STARTUP_BUDGET_MS,
+    STARTUP_COMMANDS,
+    startup_benchmark_command,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Startup Time CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    bench_parser = subparsers.add_parser(
+        "bench", help="Time how long CLI commands take to start and run"
+    )
+    bench_parser.add_argument(
+        "cli_command",
+        nargs=argparse.REMAINDER,
+        help="a CLI command to time instead of the defaults, e.g. cache_cli.py status",
+    )
+    bench_parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per command to take the median of"
+    )
+    bench_parser.add_argument(
+        "--budget",
+        type=float,
+        default=STARTUP_BUDGET_MS,
+        help="milliseconds a command may take before the run fails",
+    )
+    bench_parser.add_argument(
+        "--top", type=int, default=3, help="slowest top-level imports to show"
+    )
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "bench":
+            commands = [args.cli_command] if args.cli_command else STARTUP_COMMANDS
+            report = startup_benchmark_command(
+                commands, args.repeat, args.budget, args.top
+            )
+            failed = False
+            for result in report:
+                status = "ok"
+                if result["returncode"]:
+                    status = f"exit {result['returncode']}"
+                elif result["over_budget"]:
+                    status = "over budget"
+                failed = failed or status != "ok"
+                print(
+                    f"{result['command'][:60]:<60} {result['wall_ms']:8.1f}ms"
+                    f"  imports: {result['import_ms']:7.1f}ms  {status}"
+                )
+                for module, cumulative_ms in result["slowest"]:
+                    print(f"    {module:<40} {cumulative_ms:8.1f}ms")
+            # a non-zero exit lets scripts catch startup regressions
+            if failed:
+                sys.exit(1)
+
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,28 @@
 import json
 import string
 import re
+import time
+from functools import cache, lru_cache
 from pathlib import Path
-from nltk.stem import PorterStemmer
 
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
+STEM_CACHE_SIZE = 1 << 16
+# bump whenever tokenize() output changes, so saved indexes get rebuilt
+TOKENIZER_VERSION = 1
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
 
 
 def normalize(scores):
+    # min-max scaling to [0, 1]; a list of equal scores all map to 1.0,
+    # unless they are all 0, which is no match rather than a tie at the top
     if len(scores) == 0:
-        return
-    if min(scores) == max(scores):
-        for score in scores:
-            print(1.0)
-        return
+        return []
     min_score = min(scores)
     max_score = max(scores)
+    if max_score == 0:
+        return [0.0] * len(scores)
+    if min_score == max_score:
+        return [1.0] * len(scores)
 
     normalized_scores = []
     for score in scores:
@@ -50,6 +57,37 @@ def load_movies():
     return data["movies"]
 
 
+def iter_movies(read_size=1 << 16):
+    # decodes one movie at a time from the "movies" list in movies.json
+    decoder = json.JSONDecoder()
+    with open(get_data_file("movies.json"), "r") as f:
+        buffer = ""
+        start = None
+        while start is None:
+            more = f.read(read_size)
+            if not more:
+                raise ValueError("movies.json has no movies list")
+            buffer += more
+            start = re.search(r'"movies"\s*:\s*\[', buffer)
+        pos = start.end()
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                movie, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                more = f.read(read_size)
+                if not more:
+                    raise
+                buffer = buffer[pos:] + more
+                pos = 0
+                continue
+            yield movie
+            pos = end
+
+
 def get_stopwords():
     with open(get_data_file("stopwords.txt"), "r") as f:
         data = f.read()
@@ -58,8 +96,16 @@ def get_stopwords():
 
 
 def get_stem(input):
-    stemmer = PorterStemmer()
-    return stemmer.stem(input)
+    return get_stemmer().stem(input)
+
+
+@cache
+def get_stemmer():
+    # nltk takes a few hundred milliseconds to import, so commands that
+    # never tokenize don't load it
+    from nltk.stem import PorterStemmer
+
+    return PorterStemmer()
 
 
 def clean_input(input):
@@ -68,7 +114,7 @@ def clean_input(input):
     return lower.translate(trans_table)
 
 
-def tokenize(input):
+def tokenize_uncached(input):
     final_tokens = []
     stopwords = get_stopwords()
     tokens = input.split()
@@ -80,6 +126,64 @@ def tokenize(input):
     return final_tokens
 
 
+class Tokenizer:
+    # same output as tokenize_uncached, but the stopwords, stemmer and
+    # punctuation table are set up once and stems are memoized
+    def __init__(self, stopwords=None, stem_cache_size=STEM_CACHE_SIZE):
+        if stopwords is None:
+            stopwords = get_stopwords()
+        self.stopwords = frozenset(stopwords)
+        self.stemmer = get_stemmer()
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.stemmer.stem)
+
+    def tokenize(self, input):
+        final_tokens = []
+        for token in input.split():
+            t = token.lower().translate(PUNCTUATION_TABLE)
+            if t == "" or t in self.stopwords:
+                continue
+            final_tokens.append(self.stem(t))
+        return final_tokens
+
+    def tokenize_many(self, inputs):
+        return [self.tokenize(input) for input in inputs]
+
+
+@cache
+def get_tokenizer():
+    return Tokenizer()
+
+
+def tokenize(input):
+    return get_tokenizer().tokenize(input)
+
+
+def tokenize_many(inputs):
+    return get_tokenizer().tokenize_many(inputs)
+
+
+def tokenizer_benchmark(texts, repeat=1):
+    results = {}
+    for name, run in (
+        ("uncached", lambda: [tokenize_uncached(text) for text in texts]),
+        ("tokenizer", lambda: Tokenizer().tokenize_many(texts)),
+    ):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            tokens = run()
+        elapsed = (time.perf_counter() - start) / repeat
+        total_tokens = sum(len(text_tokens) for text_tokens in tokens)
+        results[name] = {
+            "tokens": tokens,
+            "tokens_per_sec": total_tokens / elapsed if elapsed else 0.0,
+        }
+    return {
+        "uncached_tokens_per_sec": results["uncached"]["tokens_per_sec"],
+        "tokenizer_tokens_per_sec": results["tokenizer"]["tokens_per_sec"],
+        "match": results["uncached"]["tokens"] == results["tokenizer"]["tokens"],
+    }
+
+
 def search_movies(query):
     movie_results = []
     with open(get_data_file("movies.json"), "r") as f: